@@ -1,5 +1,8 @@
-from django.contrib import admin
-from .models import Band, Timer
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.template.response import TemplateResponse
+from .models import Band, Timer, TimerSession, TimerSessionEvent
+from .schedule import ScheduleError, reorder_timers
 
 @admin.register(Band)
 class BandAdmin(admin.ModelAdmin):
@@ -12,7 +15,11 @@ class TimerAdmin(admin.ModelAdmin):
     list_display = ['name', 'band', 'duration_minutes', 'order', 'is_active']
     list_filter = ['band', 'is_active', 'created_at']
     search_fields = ['name', 'band__name']
-    list_editable = ['order', 'is_active']  # 一覧画面で直接編集可能
+    list_select_related = ['band']  # バンド名を行ごとに取得しない
+    # 有効/無効は一覧画面で直接切り替えられる（変更した行のみ保存）。
+    # 順序の変更はバンドの全タイマーに及ぶため、行ごとの保存ではなく「並び替え」アクションで一括保存する
+    list_editable = ['is_active']
+    actions = ['reorder_band']
     
     fieldsets = (
         ('基本情報', {
@@ -22,4 +29,51 @@ class TimerAdmin(admin.ModelAdmin):
             'fields': ('manager1', 'manager2', 'manager3'),
             'classes': ('collapse',)  # 折りたたみ可能
         }),
-    )
\ No newline at end of file
+    )
+    
+    @admin.action(description='選択したタイマーのバンドを並び替え')
+    def reorder_band(self, request, queryset):
+        """選択したタイマーのバンドの全タイマーを、確認画面で指定した順序・有効/無効で一括保存"""
+        band_ids = set(queryset.values_list('band_id', flat=True))
+        if len(band_ids) != 1:
+            self.message_user(request, '並び替えは1つのバンドのタイマーを選択して実行してください', messages.ERROR)
+            return None
+        band = Band.objects.get(id=band_ids.pop())
+        timers = list(Timer.objects.filter(band=band).order_by('order', 'id'))
+        
+        if request.POST.get('post'):
+            try:
+                ordered = sorted(timers, key=lambda t: (int(request.POST[f'order_{t.id}']), t.order, t.id))
+                active = {t.id: f'active_{t.id}' in request.POST for t in timers}
+                reorder_timers(band.id, [t.id for t in ordered], active)
+            except (KeyError, ValueError) as e:
+                self.message_user(request, f'順序の指定が不正です: {e}', messages.ERROR)
+            except ScheduleError as e:
+                self.message_user(request, str(e), messages.ERROR)
+            else:
+                self.message_user(request, f'{band.name} のタイマー{len(timers)}件の順序を更新しました', messages.SUCCESS)
+            return None
+        
+        return TemplateResponse(request, 'admin/timer_core/timer/reorder.html', {
+            **self.admin_site.each_context(request),
+            'title': f'{band.name} の並び替え',
+            'opts': self.model._meta,
+            'band': band,
+            'timers': timers,
+            'queryset': queryset,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'media': self.media,
+        })
+
+@admin.register(TimerSession)
+class TimerSessionAdmin(admin.ModelAdmin):
+    list_display = ['session_id', 'band', 'timer', 'status', 'version', 'updated_at']
+    list_filter = ['status']
+    list_select_related = ['band', 'timer__band']  # Timer.__str__ がバンド名を使う
+    search_fields = ['session_id']
+
+@admin.register(TimerSessionEvent)
+class TimerSessionEventAdmin(admin.ModelAdmin):
+    list_display = ['session_id', 'event', 'at_ms', 'version']
+    list_filter = ['event']
+    search_fields = ['session_id']
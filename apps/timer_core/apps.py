@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TimerCoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.timer_core'
+
+    def ready(self):
+        # 計測・キャッシュ無効化・構成バージョン更新のシグナル受信を登録
+        from . import metrics, metadata_cache, schedule  # noqa: F401
@@ -0,0 +1,28 @@
+"""
+タイマー操作のバックエンド（TIMER_BACKEND で選択）
+
+  redis    Redisのセッション + 外部スケジューラ（run_timer_scheduler）・Celeryタスク。複数プロセス対応
+  asyncio  daphneプロセス内のasyncioエンジン。Redis・Celery不要（単一プロセスの小規模会場向け。
+           保存・復元はなく、再起動でセッションは失われる）
+
+ビュー・Consumerは get_backend() 経由で操作する。配信（broadcast.py）はバックエンドに依らず共通。
+"""
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+BACKENDS = {
+    'redis': 'apps.timer_core.backends.redis_celery.RedisCeleryBackend',
+    'asyncio': 'apps.timer_core.backends.asyncio_engine.AsyncioBackend',
+}
+
+_instances = {}
+
+
+def get_backend():
+    """設定されたバックエンド（プロセス内で1インスタンス）"""
+    name = settings.TIMER_BACKEND
+    backend = _instances.get(name)
+    if backend is None:
+        backend = _instances[name] = import_string(BACKENDS.get(name, name))()
+    return backend
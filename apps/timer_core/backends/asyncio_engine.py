@@ -0,0 +1,259 @@
+"""
+daphneプロセス内で完結するタイマーエンジン（TIMER_BACKEND='asyncio'）
+
+セッションはプロセス内の辞書に Redis ハッシュと同じフィールドで保持し（to_session_data をそのまま使う）、
+完了は loop.call_at で終了時刻ちょうどに発火させてチャンネルレイヤーで配信する。
+Celery・Redis・スケジューラプロセスへの往復がない代わりに、daphneは1プロセスで動かすこと。
+
+永続化（persistence.py の write-behind）と起動時の復元（rehydrate）はない。
+実行中・一時停止中のセッションとランシートは、daphneの再起動・デプロイですべて失われる。
+
+すべての操作はイベントループ上で実行されるため、状態の更新はそれ自体が原子的。
+"""
+
+from collections import defaultdict
+import asyncio
+import logging
+from .base import TimerBackend
+from ..broadcast import abroadcast_session
+from ..metrics import COMPLETION_LAG, record_lookup
+from ..runsheet import RUNSHEET_TIMEOUT, arunsheet_timers, build_timeline
+from ..session_store import (
+    NOT_FOUND, SESSION_TIMEOUT, TRANSITION_ERRORS, TransitionError, new_session_id, now_ms, to_session_data,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioBackend(TimerBackend):
+    """プロセス内の辞書とイベントループのタイマーで動くバックエンド（保存・復元なし。再起動でセッションは失われる）"""
+
+    def __init__(self):
+        self.sessions = {}                 # session_id → ハッシュ相当の辞書
+        self.band_index = defaultdict(set)  # 稼働中（実行中・一時停止中）のみ
+        self.timer_index = defaultdict(set)
+        self.runsheets = {}                # band_id → [session_id, ...]
+        self.handles = {}                  # session_id → 完了または破棄のTimerHandle
+
+    # ---- 内部処理 ----
+
+    def _call_at(self, session_id, at_ms, callback):
+        """at_ms（epochミリ秒）に callback(session_id) を実行（既存の予定は取り消す）"""
+        self._cancel(session_id)
+        loop = asyncio.get_running_loop()
+        delay = max(0, at_ms - now_ms()) / 1000
+        self.handles[session_id] = loop.call_at(loop.time() + delay, callback, session_id)
+
+    def _cancel(self, session_id):
+        handle = self.handles.pop(session_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _discard(self, session_id):
+        """保持期間を過ぎたセッションを破棄"""
+        self.handles.pop(session_id, None)
+        raw = self.sessions.pop(session_id, None)
+        if raw is not None:
+            self._unindex(session_id, raw)
+
+    def _expire_in(self, session_id, seconds):
+        self._call_at(session_id, now_ms() + seconds * 1000, self._discard)
+
+    def _index(self, session_id, raw):
+        self.band_index[raw['band_id']].add(session_id)
+        self.timer_index[raw['timer_id']].add(session_id)
+
+    def _unindex(self, session_id, raw):
+        self.band_index[raw['band_id']].discard(session_id)
+        self.timer_index[raw['timer_id']].discard(session_id)
+
+    def _run(self, session_id, raw):
+        """実行中にして終了時刻に完了を予約"""
+        raw['status'] = 'running'
+        self._index(session_id, raw)
+        self._call_at(session_id, raw['end_ms'], self._on_deadline)
+
+    def _data(self, session_id):
+        session_data = to_session_data(self.sessions.get(session_id))
+        if session_data is not None:
+            session_data['session_id'] = session_id
+        return session_data
+
+    def _start(self, session_id, timer_id, total_seconds, band_id):
+        now = now_ms()
+        raw = {
+            'timer_id': timer_id, 'band_id': band_id or 0, 'start_ms': now,
+            'end_ms': now + total_seconds * 1000, 'total_s': total_seconds, 'v': 1,
+        }
+        self._cancel(session_id)
+        self.sessions[session_id] = raw
+        self._run(session_id, raw)
+        return self._data(session_id)
+
+    def _pause(self, session_id):
+        raw = self.sessions.get(session_id)
+        if raw is None:
+            raise TransitionError(TRANSITION_ERRORS['not_found'])
+        if raw['status'] != 'running':
+            raise TransitionError(TRANSITION_ERRORS['not_running'])
+        now = now_ms()
+        raw.update(status='paused', paused_ms=now, v=raw['v'] + 1)
+        self._expire_in(session_id, max(0, raw['end_ms'] - now) / 1000 + SESSION_TIMEOUT)
+        return self._data(session_id)
+
+    def _resume(self, session_id):
+        raw = self.sessions.get(session_id)
+        if raw is None:
+            raise TransitionError(TRANSITION_ERRORS['not_found'])
+        if raw['status'] != 'paused':
+            raise TransitionError(TRANSITION_ERRORS['not_paused'])
+        raw['end_ms'] += now_ms() - raw.pop('paused_ms')
+        raw['v'] += 1
+        self._run(session_id, raw)
+        return self._data(session_id)
+
+    def _complete(self, session_id, force=False):
+        """
+        完了にする（session_store の完了スクリプトと同じ規則）
+        次区間があれば、この区間の終了時刻ちょうど（スキップ時は現在時刻）から開始する
+        """
+        raw = self.sessions.get(session_id)
+        now = now_ms()
+        if raw is None or raw['status'] not in (('running', 'paused') if force else ('running',)):
+            return None
+        boundary = now if force else raw['end_ms']
+        if boundary > now:
+            return None
+        raw.pop('paused_ms', None)
+        raw.update(status='completed', done_ms=now, v=raw['v'] + 1)
+        self._unindex(session_id, raw)
+        self._expire_in(session_id, SESSION_TIMEOUT)
+
+        next_raw = self.sessions.get(raw.get('next'))
+        if next_raw is not None and next_raw['status'] == 'scheduled':
+            next_raw.update(start_ms=boundary, end_ms=boundary + next_raw['total_s'] * 1000,
+                            v=next_raw['v'] + 1)
+            self._run(raw['next'], next_raw)
+        return self._data(session_id)
+
+    async def _announce(self, session_id, session_data):
+        await abroadcast_session(session_id, session_data, 'completed')
+        next_data = self._data(session_data.get('next_session_id'))
+        if next_data and next_data['status'] == 'running':
+            await abroadcast_session(next_data['session_id'], next_data, 'started')
+
+    def _on_deadline(self, session_id):
+        self.handles.pop(session_id, None)
+        raw = self.sessions.get(session_id)
+        if raw is not None and raw['status'] == 'running' and raw['end_ms'] > now_ms():
+            # ループの時計（monotonic）と実時刻のずれで早く発火した場合は張り直す
+            self._call_at(session_id, raw['end_ms'], self._on_deadline)
+            return
+        session_data = self._complete(session_id)
+        if session_data is None:
+            return
+        lag_ms = now_ms() - session_data['end_ms']
+        COMPLETION_LAG.observe(max(0, lag_ms) / 1000)
+        logger.info(f"タイマー完了: session_id={session_id}, lag={lag_ms}ms")
+        asyncio.ensure_future(self._announce(session_id, session_data))
+
+    # ---- セッション操作 ----
+
+    async def start_session(self, session_id, timer_id, total_seconds, band_id=None):
+        return self._start(session_id, timer_id, total_seconds, band_id)
+
+    async def pause_session(self, session_id):
+        return self._pause(session_id)
+
+    async def resume_session(self, session_id):
+        return self._resume(session_id)
+
+    async def get_session_status(self, session_id):
+        session_data = to_session_data(self.sessions.get(session_id))
+        record_lookup(session_data is not None)
+        return session_data or dict(NOT_FOUND)
+
+    async def list_band_sessions(self, band_id):
+        sessions = [self._data(session_id) for session_id in self.band_index.get(int(band_id), ())]
+        return sorted(sessions, key=lambda s: s['start_ms'])
+
+    async def start_sessions(self, specs):
+        return [self._start(*spec) for spec in specs]
+
+    async def transition_sessions(self, action, session_ids):
+        transition = {'pause': self._pause, 'resume': self._resume}[action]
+        sessions, errors = [], {}
+        for session_id in session_ids:
+            try:
+                sessions.append(transition(session_id))
+            except TransitionError as e:
+                errors[session_id] = str(e)
+        return sessions, errors
+
+    async def resolve_session_ids(self, timer_ids=None, band_ids=None, all_bands=False):
+        if all_bands:
+            return sorted(set().union(*self.band_index.values()))
+        session_ids = set()
+        for timer_id in timer_ids or []:
+            session_ids |= self.timer_index.get(int(timer_id), set())
+        for band_id in band_ids or []:
+            session_ids |= self.band_index.get(int(band_id), set())
+        return sorted(session_ids)
+
+    # ---- ランシート ----
+
+    async def get_runsheet(self, band_id):
+        session_ids = self.runsheets.get(int(band_id))
+        if session_ids is None:
+            return None
+        return build_timeline(band_id, session_ids, [self.sessions.get(s) for s in session_ids])
+
+    async def _current_session_id(self, band_id):
+        runsheet = await self.get_runsheet(band_id)
+        if runsheet is None or runsheet['current_index'] is None:
+            raise TransitionError('実行中のランシートがありません')
+        return runsheet['segments'][runsheet['current_index']]['session_id']
+
+    async def start_runsheet(self, band_id):
+        band_id = int(band_id)
+        current = await self.get_runsheet(band_id)
+        if current is not None and current['status'] in ('running', 'paused'):
+            raise TransitionError('ランシートは実行中です')
+        timers = await arunsheet_timers(band_id)
+
+        session_ids = [new_session_id(band_id) for _ in timers]
+        cursor = now_ms()
+        for index, (session_id, timer) in enumerate(zip(session_ids, timers)):
+            total = timer.duration_minutes * 60
+            raw = {
+                'status': 'scheduled', 'timer_id': timer.id, 'band_id': band_id, 'start_ms': cursor,
+                'end_ms': cursor + total * 1000, 'total_s': total, 'v': 1,
+            }
+            if index < len(timers) - 1:
+                raw['next'] = session_ids[index + 1]
+            self.sessions[session_id] = raw
+            self._expire_in(session_id, RUNSHEET_TIMEOUT)
+            cursor = raw['end_ms']
+        self.runsheets[band_id] = session_ids
+        self._run(session_ids[0], self.sessions[session_ids[0]])
+
+        await abroadcast_session(session_ids[0], self._data(session_ids[0]), 'started')
+        return await self.get_runsheet(band_id)
+
+    async def pause_runsheet(self, band_id):
+        session_id = await self._current_session_id(band_id)
+        await abroadcast_session(session_id, self._pause(session_id), 'paused')
+        return await self.get_runsheet(band_id)
+
+    async def resume_runsheet(self, band_id):
+        session_id = await self._current_session_id(band_id)
+        await abroadcast_session(session_id, self._resume(session_id), 'resumed')
+        return await self.get_runsheet(band_id)
+
+    async def skip_runsheet(self, band_id):
+        session_id = await self._current_session_id(band_id)
+        session_data = self._complete(session_id, force=True)
+        if session_data is None:
+            raise TransitionError('タイマーが実行中ではありません')
+        await self._announce(session_id, session_data)
+        return await self.get_runsheet(band_id)
@@ -0,0 +1,62 @@
+from abc import ABC, abstractmethod
+
+
+class TimerBackend(ABC):
+    """
+    タイマー操作の基底クラス（すべて非同期）
+    セッションは session_store.to_session_data と同じ形の辞書で返し、
+    遷移できない場合は TransitionError を送出する
+    すべての操作を実装していないサブクラスはインスタンス化できない
+    """
+
+    @abstractmethod
+    async def start_session(self, session_id, timer_id, total_seconds, band_id=None):
+        """セッションを開始"""
+
+    @abstractmethod
+    async def pause_session(self, session_id):
+        """一時停止"""
+
+    @abstractmethod
+    async def resume_session(self, session_id):
+        """再開"""
+
+    @abstractmethod
+    async def get_session_status(self, session_id):
+        """セッションの状態。なければ NOT_FOUND"""
+
+    @abstractmethod
+    async def list_band_sessions(self, band_id):
+        """バンドの稼働中セッション一覧"""
+
+    @abstractmethod
+    async def start_sessions(self, specs):
+        """一括開始。specs: [(session_id, timer_id, total_seconds, band_id), ...]"""
+
+    @abstractmethod
+    async def transition_sessions(self, action, session_ids):
+        """一括一時停止・再開。(成功一覧, session_id → エラーメッセージ) を返す"""
+
+    @abstractmethod
+    async def resolve_session_ids(self, timer_ids=None, band_ids=None, all_bands=False):
+        """一括操作の対象（タイマー・バンド・全バンド指定）の稼働中セッションID"""
+
+    @abstractmethod
+    async def get_runsheet(self, band_id):
+        """ランシートの時間割（runsheet.build_timeline の形）。なければNone"""
+
+    @abstractmethod
+    async def start_runsheet(self, band_id):
+        """ランシートを開始"""
+
+    @abstractmethod
+    async def pause_runsheet(self, band_id):
+        """ランシートを一時停止"""
+
+    @abstractmethod
+    async def resume_runsheet(self, band_id):
+        """ランシートを再開"""
+
+    @abstractmethod
+    async def skip_runsheet(self, band_id):
+        """ランシートの実行中区間をスキップ"""
@@ -0,0 +1,49 @@
+from .base import TimerBackend
+from .. import runsheet, session_store
+
+
+class RedisCeleryBackend(TimerBackend):
+    """
+    既定のバックエンド
+    セッションはRedis（Luaスクリプトで原子的に遷移）、完了検知は run_timer_scheduler、
+    バックグラウンド処理は Celery タスク（tasks.py）が担う
+    """
+
+    async def start_session(self, session_id, timer_id, total_seconds, band_id=None):
+        return await session_store.astart_session(session_id, timer_id, total_seconds, band_id)
+
+    async def pause_session(self, session_id):
+        return await session_store.apause_session(session_id)
+
+    async def resume_session(self, session_id):
+        return await session_store.aresume_session(session_id)
+
+    async def get_session_status(self, session_id):
+        return await session_store.aget_session_status(session_id)
+
+    async def list_band_sessions(self, band_id):
+        return await session_store.alist_band_sessions(band_id)
+
+    async def start_sessions(self, specs):
+        return await session_store.astart_sessions(specs)
+
+    async def transition_sessions(self, action, session_ids):
+        return await session_store.atransition_sessions(action, session_ids)
+
+    async def resolve_session_ids(self, timer_ids=None, band_ids=None, all_bands=False):
+        return await session_store.aresolve_session_ids(timer_ids, band_ids, all_bands)
+
+    async def get_runsheet(self, band_id):
+        return await runsheet.aget_runsheet(band_id)
+
+    async def start_runsheet(self, band_id):
+        return await runsheet.astart_runsheet(band_id)
+
+    async def pause_runsheet(self, band_id):
+        return await runsheet.apause_runsheet(band_id)
+
+    async def resume_runsheet(self, band_id):
+        return await runsheet.aresume_runsheet(band_id)
+
+    async def skip_runsheet(self, band_id):
+        return await runsheet.askip_runsheet(band_id)
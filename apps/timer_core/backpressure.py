@@ -0,0 +1,128 @@
+"""
+WebSocket接続ごとの受信レート制限と送信キュー（consumers.py）
+
+受信はトークンバケットで制限し、超過分はパースせずに破棄する。
+送信はグループメッセージを上限付きのキューに積み、接続ごとの送信タスクが順に送る。
+同じセッションの timer_update が未送信のまま溜まった場合は最新の状態だけを残す
+（遅いクライアントが途中の状態を受け取る必要はない）。
+
+送信済みでクライアントの受信確認（ack）がないフレーム数は AckWindow で制限する。
+サーバー側のソケットへの書き込みはバッファされてすぐ終わるため、送信が詰まったかは
+送信キューの長さだけでは分からない。上限に達したら ack が届くまで送信を止め、
+その間に溢れた送信キューで遅いクライアントを検知する。
+"""
+
+from collections import OrderedDict
+import asyncio
+import time
+
+
+class TokenBucket:
+    """rate 件/秒で補充され、最大 burst 件まで溜まるトークンバケット"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        """トークンを1つ使う。なければFalse"""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class QueueFull(Exception):
+    """送信待ちが上限に達した（置き換えできないフレームで溢れた）"""
+
+
+class OutboundQueue:
+    """
+    送信待ちフレームのキュー（上限 maxsize）
+    key を指定したフレームは、同じ key の未送信フレームがあればその位置で置き換える
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._frames = OrderedDict()
+        self._seq = 0
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """フレームを積む。置き換えた場合はTrue（古いフレームは破棄）"""
+        if key is not None and key in self._frames:
+            self._frames[key] = frame
+            return True
+        if len(self._frames) >= self.maxsize:
+            raise QueueFull
+        if key is None:
+            key = (None, self._seq)
+            self._seq += 1
+        self._frames[key] = frame
+        self._ready.set()
+        return False
+
+    async def get(self):
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        _, frame = self._frames.popitem(last=False)
+        return frame
+
+
+class AckWindow:
+    """
+    送信済み・受信未確認のフレーム数の上限（size）
+    クライアントは受信したメッセージの累計数を ack で返す
+    上限は最初の ack を受け取ってから適用する（ack を返さない旧クライアントは送信キューの上限のみ）
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.sent = 0
+        self.acked = 0
+        self.enabled = False
+        self._open = asyncio.Event()
+        self._open.set()
+
+    @property
+    def in_flight(self):
+        return self.sent - self.acked
+
+    def on_send(self):
+        """1フレーム送信した"""
+        self.sent += 1
+        if self.enabled and self.in_flight >= self.size:
+            self._open.clear()
+
+    def ack(self, received):
+        """受信累計数を反映。不正な値（整数以外・減少・送信数超え）ならFalse"""
+        if type(received) is not int or not self.acked <= received <= self.sent:
+            return False
+        self.acked = received
+        self.enabled = True
+        if self.in_flight < self.size:
+            self._open.set()
+        else:
+            self._open.clear()
+        return True
+
+    async def wait(self):
+        """未確認のフレームが上限未満になるまで待つ"""
+        await self._open.wait()
@@ -0,0 +1,368 @@
+"""
+同時セッション数・WebSocket配信の負荷計測
+
+プロセス内で完結する構成（fakeredis + インメモリのチャンネルレイヤー、または実Redis + ShardedChannelLayer）で
+以下を計測する。manage.py bench_timers から実行する。
+
+  - 状態取得APIのレイテンシ（p50/p99）
+  - 一時停止・再開の配信レイテンシ（遷移からConsumerが受信するまで）
+  - 完了検知の遅れ（Consumerが完了通知を受信した時刻 - end_ms）
+  - セッション操作（開始・状態取得・一時停止・再開）の処理数/秒
+  - ブローカー（Celery）メッセージ数/秒、チャンネルレイヤー送信数/秒
+  - セッションあたりのメモリ（redisバックエンドのみ）
+
+--backend でタイマーバックエンド（redis / asyncio）、--wire-format で配信形式（json / msgpack）を
+切り替えて比較できる。--redis-url を複数指定すると、ノード数を1台から指定台数まで増やしながら
+セッションと本番と同じ ShardedChannelLayer を各ノード数で構成し、処理数/秒と配信レイテンシを比較する。
+--shards（fakeredis の台数）でも同様にセッションを分散するが、チャンネルレイヤーはインメモリのまま。
+
+作成する計測用のバンド・保存されるセッションは、専用のテストデータベース（test_<DB名>）に書き込み、
+終了時に削除する（設定のデータベースには書き込まない）。
+"""
+
+from asgiref.sync import sync_to_async
+from celery.signals import before_task_publish
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import AsyncClient, override_settings
+from django.test.utils import setup_databases, teardown_databases
+import asyncio
+import json
+import random
+import threading
+import time
+from . import redis_client
+from .models import Band
+from .routing import websocket_urlpatterns
+from .backends import get_backend
+from .redis_client import session_shard
+from .session_store import LIVE_SESSIONS_KEY, acomplete_session, new_session_id, session_key, now_ms
+from .broadcast import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, abroadcast_session, msgpack
+from .scheduler import flush_events, run_scheduler
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+SHARDED_CHANNEL_LAYER = 'apps.timer_core.sharding.ShardedChannelLayer'
+
+
+def percentile(values, pct):
+    """パーセンタイル（最近傍法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def use_redis(redis_urls=None, shards=1):
+    """
+    計測用のRedisクライアントを設定し、ノードのURL一覧を返す
+    URL指定がなければ shards 台分の fakeredis サーバーを使う
+    """
+    if redis_urls:
+        redis_client.override_clients(
+            redis_client._default_sync_client, redis_client._default_async_client
+        )
+        return list(redis_urls)
+
+    try:
+        import fakeredis
+    except ImportError:
+        raise RuntimeError('fakeredis[lua] が必要です（または --redis-url を指定）')
+    servers = {f'fakeredis://{index}': fakeredis.FakeServer() for index in range(shards)}
+    redis_client.override_clients(
+        lambda url: fakeredis.FakeRedis(server=servers[url], decode_responses=True),
+        lambda url: fakeredis.FakeAsyncRedis(server=servers[url], decode_responses=True)
+    )
+    return list(servers)
+
+
+def channel_layers(redis_urls=None):
+    """
+    計測に使うチャンネルレイヤーの設定
+    実Redisのノードがあれば本番と同じ ShardedChannelLayer をそのノードで構成し、なければインメモリ
+    """
+    if not redis_urls:
+        return IN_MEMORY_CHANNEL_LAYERS
+    hosts = [
+        {'address': url, 'max_connections': settings.TIMER_REDIS_POOLS['channels'], 'timeout': settings.TIMER_REDIS_POOL_TIMEOUT}
+        for url in redis_urls
+    ]
+    return {'default': {'BACKEND': SHARDED_CHANNEL_LAYER, 'CONFIG': {'hosts': hosts}}}
+
+
+class Counters:
+    """計測中のメッセージ数"""
+
+    def __init__(self):
+        self.broker_messages = 0
+        self.group_sends = 0
+        self.failures = {}  # 計測名 → 失敗数（失敗したものはレイテンシに含めない）
+
+    def fail(self, label):
+        self.failures[label] = self.failures.get(label, 0) + 1
+
+    def on_publish(self, **kwargs):
+        self.broker_messages += 1
+
+
+class BandClient:
+    """1つのWebSocket接続。受信したメッセージを受信時刻とともに記録する"""
+
+    def __init__(self, application, band_id, wire_format='json'):
+        subprotocol = MSGPACK_SUBPROTOCOL if wire_format == 'msgpack' else JSON_SUBPROTOCOL
+        self.communicator = WebsocketCommunicator(application, f'/ws/timer/{band_id}/', subprotocols=[subprotocol])
+        self.received = []
+        self.received_bytes = 0
+        self.reader = None
+        self.count = 0  # 受信したメッセージの累計（connection_established を含む）
+        self.acked = 0
+        self.ack_window = 0
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError('WebSocket接続に失敗しました')
+        message = await self.communicator.receive_from()
+        established = msgpack.unpackb(message) if isinstance(message, bytes) else json.loads(message)
+        self.count = 1
+        self.ack_window = established.get('ack_window', 0)
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        while True:
+            message = await self.communicator.receive_from(timeout=3600)
+            self.count += 1
+            self.received_bytes += len(message)
+            decoded = msgpack.unpackb(message) if isinstance(message, bytes) else json.loads(message)
+            self.received.append((now_ms(), decoded))
+            # ブラウザのクライアントと同じく、未確認が上限の半分に達したら受信累計数を返す
+            if self.ack_window and self.count - self.acked >= max(1, self.ack_window // 2):
+                self.acked = self.count
+                await self.communicator.send_to(text_data=json.dumps({'type': 'ack', 'received': self.count}))
+
+    async def close(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+def session_memory(session_ids):
+    """セッション1件あたりのメモリ（MEMORY USAGE非対応ならフィールド長からの概算）"""
+    sample = session_ids[:100]
+    try:
+        usages = [
+            redis_client.get_redis(session_shard(session_id)).memory_usage(session_key(session_id)) or 0
+            for session_id in sample
+        ]
+        return sum(usages) / len(usages), '実測'
+    except Exception:
+        sizes = []
+        for session_id in sample:
+            fields = redis_client.get_redis(session_shard(session_id)).hgetall(session_key(session_id))
+            sizes.append(sum(len(k) + len(v) for k, v in fields.items()))
+        return sum(sizes) / len(sizes), '概算'
+
+
+def shard_sessions():
+    """ノードごとの稼働中セッション数"""
+    return [redis_client.get_redis(shard).scard(LIVE_SESSIONS_KEY) for shard in redis_client.shard_urls()]
+
+
+def start_scheduler(stop):
+    """
+    実運用と同じスケジューラのループ（run_scheduler）を別スレッドで動かす
+    次の終了時刻まで待つ処理もそのまま計測に含める。配信はベンチマークのイベントループ上で行われる
+    """
+    return asyncio.ensure_future(sync_to_async(run_scheduler, thread_sensitive=False)(stop.is_set))
+
+
+async def _run(options, stdout):
+    backend = get_backend()
+    counters = Counters()
+    channel_layer = get_channel_layer()
+    original_group_send = channel_layer.group_send
+
+    async def counting_group_send(group, message):
+        counters.group_sends += 1
+        await original_group_send(group, message)
+
+    channel_layer.group_send = counting_group_send
+    before_task_publish.connect(counters.on_publish, weak=False)
+
+    # 購読するバンドは存在するものに限られるため、計測用のバンドを作成する（終了時に削除）
+    bands = options['bands']
+    band_ids = [(await Band.objects.acreate(name=f'計測用バンド{index + 1}')).id for index in range(bands)]
+    application = URLRouter(websocket_urlpatterns)
+    http = AsyncClient()
+    started_at = time.monotonic()
+    results = {}
+
+    # 1. WebSocketクライアント接続
+    clients = [BandClient(application, band_id, options['wire_format']) for band_id in band_ids
+               for _ in range(options['clients'])]
+    for client in clients:
+        await client.connect()
+
+    # 2. セッション開始（2〜4のセッション操作の処理数/秒を計測）
+    operations_started_at = time.monotonic()
+    session_ids = [new_session_id(band_ids[index % bands]) for index in range(options['sessions'])]
+    start_latencies = []
+    for index, session_id in enumerate(session_ids):
+        t0 = time.perf_counter()
+        session_data = await backend.start_session(session_id, index + 1, 3600, band_ids[index % bands])
+        await abroadcast_session(session_id, session_data, 'started')
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        if not session_data or session_data['status'] != 'running':
+            counters.fail('開始')
+            continue
+        start_latencies.append(elapsed_ms)
+    results['開始 (ms)'] = start_latencies
+
+    # 3. 状態取得API（同時実行数を制限して並行リクエスト）
+    semaphore = asyncio.Semaphore(options['concurrency'])
+    status_latencies = []
+
+    async def fetch_status(session_id):
+        async with semaphore:
+            t0 = time.perf_counter()
+            response = await http.get(f'/api/timer-status/{session_id}/')
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            if response.status_code != 200 or not response.json().get('success'):
+                counters.fail('状態取得API')
+                return
+            status_latencies.append(elapsed_ms)
+
+    await asyncio.gather(*[
+        fetch_status(random.choice(session_ids)) for _ in range(options['status_requests'])
+    ])
+    results['状態取得API (ms)'] = status_latencies
+
+    # 4. 一時停止・再開の繰り返しと配信レイテンシ
+    sent = {}
+    for session_id in random.sample(session_ids, min(options['churn'], len(session_ids))):
+        for transition, event in ((backend.pause_session, 'paused'), (backend.resume_session, 'resumed')):
+            session_data = await transition(session_id)
+            sent[(session_id, session_data['version'])] = now_ms()
+            await abroadcast_session(session_id, session_data, event)
+    operations = len(start_latencies) + len(status_latencies) + len(sent)
+    operations_per_second = operations / (time.monotonic() - operations_started_at)
+    await asyncio.sleep(0.5)
+
+    fanout = []
+    for client in clients:
+        for received_ms, message in client.received:
+            data = message.get('data') or {}
+            key = (data.get('session_id'), data.get('version'))
+            if key in sent:
+                fanout.append(received_ms - sent[key])
+    results['配信レイテンシ (ms)'] = fanout
+
+    # 5. 完了検知の遅れ（短いタイマーを完了させる。redisはスケジューラ、asyncioはエンジン自身が検知）
+    stop = threading.Event()
+    if options['backend'] == 'redis':
+        scheduler = start_scheduler(stop)
+    short_ids = {}
+    for index in range(options['completions']):
+        session_id = new_session_id(band_ids[index % bands])
+        session_data = await backend.start_session(session_id, index + 1, 1, band_ids[index % bands])
+        short_ids[session_id] = session_data['end_ms']
+    await asyncio.sleep(1 + options['scheduler_interval'] + 1)
+    stop.set()
+    if options['backend'] == 'redis':
+        await scheduler
+
+    lags = []
+    for client in clients:
+        for received_ms, message in client.received:
+            data = message.get('data') or {}
+            if message.get('type') == 'timer_completed' and data.get('session_id') in short_ids:
+                lags.append(received_ms - short_ids[data['session_id']])
+    results['完了検知の遅れ (ms)'] = lags
+
+    elapsed = time.monotonic() - started_at
+    for client in clients:
+        await client.close()
+    before_task_publish.disconnect(counters.on_publish)
+    channel_layer.group_send = original_group_send
+    if options['backend'] == 'redis':
+        # 次のノード数での計測に残さないよう、開始したセッションはスキップで完了させる
+        counts = await sync_to_async(shard_sessions)()
+        memory, method = session_memory(session_ids)
+        for session_id in session_ids + list(short_ids):
+            await acomplete_session(session_id, force=True)
+        await sync_to_async(flush_events)()  # 次の計測開始時の復元で戻さないよう、完了をDBにも反映
+    if hasattr(channel_layer, 'close_pools'):
+        await channel_layer.close_pools()
+    await Band.objects.filter(id__in=band_ids).adelete()
+
+    # 結果出力
+    nodes = f"ノード数={len(redis_client.shard_urls())}, " if options['backend'] == 'redis' else ''
+    stdout.write(f"バックエンド={options['backend']}, 配信形式={options['wire_format']}, セッション数={options['sessions']}, バンド数={bands}, "
+                 f"接続数={len(clients)}, {nodes}チャンネルレイヤー={type(channel_layer).__name__}, 経過={elapsed:.1f}s")
+    for label, values in results.items():
+        if values:
+            stdout.write(f"  {label}: n={len(values)}, p50={percentile(values, 50):.2f}, "
+                         f"p99={percentile(values, 99):.2f}, max={max(values):.2f}")
+        else:
+            stdout.write(f"  {label}: 計測値なし")
+    for label, count in counters.failures.items():
+        stdout.write(f"  {label}: 失敗 {count}件（計測値から除外）")
+    stdout.write(f"  セッション操作: {operations_per_second:.1f} ops/s")
+    stdout.write(f"  ブローカーメッセージ: {counters.broker_messages / elapsed:.1f}/s")
+    stdout.write(f"  チャンネルレイヤー送信: {counters.group_sends / elapsed:.1f}/s")
+    frames = sum(len(client.received) for client in clients)
+    received_bytes = sum(client.received_bytes for client in clients)
+    stdout.write(f"  受信フレーム: {frames}件, 平均 {received_bytes / max(frames, 1):.0f} bytes")
+    if options['backend'] == 'redis':
+        stdout.write(f"  セッションあたりのメモリ: {memory:.0f} bytes（{method}）")
+        stdout.write(f"  ノード別の稼働中セッション: {' / '.join(map(str, counts))}")
+    return {'operations_per_second': operations_per_second, 'fanout': fanout, 'results': results}
+
+
+def run_benchmark(stdout, **options):
+    """
+    ベンチマーク実行（専用のテストデータベースを作成し、終了時に削除する）
+    redisバックエンドはノード数を1台から指定台数まで増やして計測し、ノード数ごとの比較を出力する
+    """
+    options.setdefault('backend', 'redis')
+    options.setdefault('wire_format', 'json')
+    if options['wire_format'] == 'msgpack' and msgpack is None:
+        raise RuntimeError('--wire-format msgpack には msgpack が必要です')
+    overrides = {
+        'TIMER_BACKEND': options['backend'],
+        # テストクライアントの Host（testserver）を受け付ける（拒否された400を計測しないため）
+        'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'],
+        # スケジューラの最大待機秒数
+        'TIMER_SCHEDULER_INTERVAL': options.get('scheduler_interval', settings.TIMER_SCHEDULER_INTERVAL),
+        # 計測用の接続は一度に張るため、新規接続の受け入れ制限は外す
+        'TIMER_WS_ADMIT_BURST': options['bands'] * options['clients'],
+    }
+    runs = [{'CHANNEL_LAYERS': IN_MEMORY_CHANNEL_LAYERS}]
+    if options['backend'] == 'redis':
+        redis_urls = options.get('redis_url')
+        node_urls = use_redis(redis_urls, options.get('shards') or 1)
+        runs = [
+            {
+                'TIMER_REDIS_SHARDS': node_urls[:count],
+                'CHANNEL_LAYERS': channel_layers(node_urls[:count] if redis_urls else None),
+            }
+            for count in range(1, len(node_urls) + 1)
+        ]
+
+    old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+    try:
+        summary = []
+        for run in runs:
+            with override_settings(**overrides, **run):
+                summary.append((len(run.get('TIMER_REDIS_SHARDS', [])), asyncio.run(_run(options, stdout))))
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+    if len(summary) > 1:
+        stdout.write('ノード数ごとの比較')
+        for count, result in summary:
+            fanout = result['fanout']
+            latency = f"p50={percentile(fanout, 50):.2f}ms, p99={percentile(fanout, 99):.2f}ms" if fanout else '計測値なし'
+            stdout.write(f"  {count}台: セッション操作 {result['operations_per_second']:.1f} ops/s, 配信レイテンシ {latency}")
+    return summary
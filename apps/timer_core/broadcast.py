@@ -0,0 +1,135 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import json
+import logging
+
+try:
+    import msgpack  # channels-redis の依存。なければJSONのみ
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# WebSocketのサブプロトコル（接続時にクライアントが選ぶ。指定なしはJSON）
+JSON_SUBPROTOCOL = 'timer.json'
+MSGPACK_SUBPROTOCOL = 'timer.msgpack'
+
+
+def band_group_name(band_id):
+    """バンドごとのWebSocketグループ名"""
+    return f'timer_band_{band_id}'
+
+
+def session_payload(session_id, session_data, event):
+    """クライアントへ送るセッション状態"""
+    return {
+        'event': event,  # started / paused / resumed / tick / completed
+        'session_id': session_id,
+        'status': session_data.get('status'),
+        'timer_id': session_data.get('timer_id'),
+        'band_id': session_data.get('band_id'),
+        'end_ms': session_data.get('end_ms'),
+        'total_seconds': session_data.get('total_seconds'),
+        'remaining_seconds': session_data.get('remaining_seconds'),
+        'version': session_data.get('version'),
+        'next_session_id': session_data.get('next_session_id'),  # ランシートの次区間
+    }
+
+
+def encode_json(content):
+    return json.dumps(content, separators=(',', ':'))
+
+
+def encode_msgpack(content):
+    return msgpack.packb(content)
+
+
+def encoded_message(message_type, data):
+    """
+    グループ送信用のメッセージ
+    送信側で1回だけエンコードし、Consumerは各ソケットへそのまま送る（ソケットごとのjson.dumpsなし）
+    複数バンドを購読する接続で振り分けられるよう band_id を付ける
+    """
+    content = {'type': message_type, 'band_id': data.get('band_id'), 'data': data}
+    message = {'type': message_type, 'text': encode_json(content)}
+    if msgpack is not None:
+        message['bytes'] = encode_msgpack(content)
+    return message
+
+
+def _message(session_id, session_data, event):
+    message_type = 'timer_completed' if event == 'completed' else 'timer_update'
+    message = encoded_message(message_type, session_payload(session_id, session_data, event))
+    # 送信が遅れている接続で、同じセッションの古い timer_update を置き換えるためのキー
+    message['session_id'] = session_id
+    return message
+
+
+async def abroadcast_session(session_id, session_data, event):
+    """セッション状態の変化をバンドグループへ配信（非同期）"""
+    band_id = session_data.get('band_id')
+    if not band_id:
+        return
+    try:
+        await get_channel_layer().group_send(
+            band_group_name(band_id),
+            _message(session_id, session_data, event)
+        )
+    except Exception as e:
+        logger.error(f"WebSocket配信エラー: session_id={session_id}, error={e}")
+
+
+def broadcast_session(session_id, session_data, event):
+    """セッション状態の変化をバンドグループへ配信（Celeryタスク用）"""
+    band_id = session_data.get('band_id')
+    if not band_id:
+        return
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            band_group_name(band_id),
+            _message(session_id, session_data, event)
+        )
+    except Exception as e:
+        # 配信失敗でタイマー本体の処理は止めない
+        logger.error(f"WebSocket配信エラー: session_id={session_id}, error={e}")
+
+
+def _batch_messages(sessions, event):
+    """一括操作の結果をバンドごとに1メッセージへまとめる"""
+    by_band = {}
+    for session_data in sessions:
+        band_id = session_data.get('band_id')
+        if band_id:
+            by_band.setdefault(band_id, []).append(
+                session_payload(session_data['session_id'], session_data, event)
+            )
+    return {
+        band_id: encoded_message('timer_batch_update', {'event': event, 'band_id': band_id, 'sessions': payloads})
+        for band_id, payloads in by_band.items()
+    }
+
+
+async def abroadcast_batch(sessions, event):
+    """一括操作の結果をバンドごとに1回だけ配信（非同期）"""
+    channel_layer = get_channel_layer()
+    for band_id, message in _batch_messages(sessions, event).items():
+        try:
+            await channel_layer.group_send(band_group_name(band_id), message)
+        except Exception as e:
+            logger.error(f"WebSocket一括配信エラー: band_id={band_id}, error={e}")
+
+
+def broadcast_batch(sessions, event):
+    """一括操作の結果をバンドごとに1回だけ配信（Celeryタスク用）"""
+    async_to_sync(abroadcast_batch)(sessions, event)
+
+
+def broadcast_schedule(band_id, timers, version=None):
+    """バンドのタイマー構成（順序・有効/無効）の変更を1回だけ配信"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            band_group_name(band_id),
+            encoded_message('timer_schedule_changed', {'band_id': band_id, 'version': version, 'timers': timers})
+        )
+    except Exception as e:
+        logger.error(f"WebSocket構成変更配信エラー: band_id={band_id}, error={e}")
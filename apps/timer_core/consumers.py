@@ -1,96 +1,418 @@
+from urllib.parse import parse_qs
+import asyncio
 import json
 import logging
+import random
+from django.conf import settings
+from django.core import signing
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Band
+from .backpressure import AckWindow, OutboundQueue, QueueFull, TokenBucket
+from .broadcast import (
+    JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, band_group_name, encode_json, encode_msgpack, msgpack,
+    session_payload,
+)
+from .metrics import WEBSOCKET_CLOSED, WEBSOCKET_CONNECTIONS, WEBSOCKET_FRAMES_DROPPED, WEBSOCKET_SOCKETS
+from .metadata_cache import aget_band_info
+from .backends import get_backend
+from .session_store import now_ms
 
 logger = logging.getLogger(__name__)
 
+# サーバーから切断する場合のクローズコード
+CLOSE_MESSAGE_TOO_BIG = 1009  # TIMER_WS_MAX_MESSAGE_BYTES を超えるフレーム
+CLOSE_TRY_AGAIN = 1013        # 新規接続の受け入れ超過（retry_after_ms 後に再接続）
+CLOSE_UNKNOWN_BAND = 4404     # ws/timer/<band_id>/ のバンドが存在しない
+CLOSE_SLOW_CONSUMER = 4408    # 送信待ちが TIMER_WS_SEND_QUEUE_SIZE を超えた
+CLOSE_RATE_LIMITED = 4429     # 受信レート超過が続いた
+
+RESUME_SALT = 'timer.ws.resume'
+
+_admission = None
+
+
+def admission():
+    """プロセスあたりの新規接続の受け入れ枠（トークンバケット）"""
+    global _admission
+    rate, burst = settings.TIMER_WS_ADMIT_RATE, settings.TIMER_WS_ADMIT_BURST
+    if _admission is None or (_admission.rate, _admission.burst) != (rate, burst):
+        _admission = TokenBucket(rate, burst)
+    return _admission
+
+
+def retry_after_ms():
+    """再接続までの待ち時間のヒント（クライアントごとにばらつかせる）"""
+    return random.randint(settings.TIMER_WS_RETRY_MIN_MS, settings.TIMER_WS_RETRY_MAX_MS)
+
+
+def resume_token(band_ids):
+    """購読中のバンドを署名付きで渡す再開トークン"""
+    return signing.dumps(sorted(int(band_id) for band_id in band_ids), salt=RESUME_SALT)
+
+
+def resume_band_ids(token):
+    """再開トークンからバンド一覧を取り出す。不正・期限切れならNone"""
+    try:
+        band_ids = signing.loads(token, salt=RESUME_SALT, max_age=settings.TIMER_WS_RESUME_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    return [str(band_id) for band_id in band_ids]
+
+
+async def avalidate_band_ids(band_ids):
+    """
+    購読するバンドIDを検証し、(存在するバンドID（str、重複なし）, 不正・不明なID) を返す
+    存在確認はメタデータキャッシュ（既知のバンドはDB往復なし）
+    """
+    known, unknown = [], []
+    for band_id in band_ids:
+        if not str(band_id).isdigit() or await aget_band_info(band_id) is None:
+            unknown.append(band_id)
+        elif str(int(band_id)) not in known:
+            known.append(str(int(band_id)))
+    return known, unknown
+
+
 class TimerConsumer(AsyncWebsocketConsumer):
-    """タイマー用WebSocketコンシューマー"""
+    """
+    タイマー用WebSocketコンシューマー
+    
+    ws/timer/<band_id>/ はそのバンドを購読した状態で接続する。
+    ws/timer/ は購読なしで接続し、1つの接続で複数バンドを購読・解除できる（進行管理の一覧画面向け）。
+      {"type": "subscribe", "band_ids": [1, 2, 3]} / {"type": "unsubscribe", "band_ids": [2]}
+    配信メッセージには band_id が付くので、クライアントはバンドごとに振り分ける。
+    
+    1つの接続がグループ全体の配信を遅らせないよう、受信はトークンバケットで制限し、
+    グループメッセージは送信キューに積むだけにして接続ごとの送信タスクで送る（backpressure.py）。
+    クライアントは受信したメッセージの累計数を {"type": "ack", "received": N} で返す
+    （connection_established の ack_window の半分を受信するごと）。ack を返したことのある接続は、
+    受信確認のないフレームが ack_window に達すると送信を止め、その間に送信キューが溢れると 4408 で切断する。
+    ack を一度も返さない接続（デプロイ前にキャッシュされた画面・ブラウザ以外のクライアント）には
+    受信確認の上限を適用せず、送信キューの上限（同じセッションの更新は置き換え）のみで制限する。
+    
+    再接続: connection_established の resume_token を ?resume= に付けて接続すると購読を復元する。
+    続けて {"type": "resume", "versions": {session_id: version}} を送ると、
+    それ以降に変化したセッションだけを timer_delta で返す。
+    新規接続はプロセスごとに受け入れ数を制限し、超過時は retry_after_ms を送って切断する。
+    """
     
     async def connect(self):
         """WebSocket接続時の処理"""
-        self.band_id = self.scope['url_route']['kwargs']['band_id']
-        self.room_group_name = f'timer_band_{self.band_id}'
+        self.band_id = self.scope['url_route']['kwargs'].get('band_id')
+        self.band_ids = set()
+        self.inbound = TokenBucket(settings.TIMER_WS_RATE, settings.TIMER_WS_BURST)
+        self.dropped = 0
+        self.outbound = OutboundQueue(settings.TIMER_WS_SEND_QUEUE_SIZE)
+        self.window = AckWindow(settings.TIMER_WS_ACK_WINDOW)
+        self.closing = False
+        self.counted = False
         
-        # グループに参加
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # 接続を受け入れ（サブプロトコル timer.msgpack を選んだクライアントにはバイナリフレームで送る）
+        subprotocols = self.scope.get('subprotocols') or []
+        self.binary = MSGPACK_SUBPROTOCOL in subprotocols and msgpack is not None
+        if self.binary:
+            await self.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+        elif JSON_SUBPROTOCOL in subprotocols:
+            await self.accept(subprotocol=JSON_SUBPROTOCOL)
+        else:
+            await self.accept()
         
-        # 接続を受け入れ
-        await self.accept()
+        # 受け入れ超過（再接続の集中）。グループ参加の前に、待ち時間のヒントを渡して切断
+        if not admission().consume():
+            await self.send_message({
+                'type': 'retry',
+                'message': '接続が集中しています。しばらくしてから再接続してください',
+                'retry_after_ms': retry_after_ms()
+            })
+            await self.close_for('admission', CLOSE_TRY_AGAIN)
+            return
+        self.sender = asyncio.ensure_future(self.send_frames())
+        WEBSOCKET_SOCKETS.inc()
+        self.counted = True
         
-        logger.info(f"WebSocket接続: band_id={self.band_id}, channel={self.channel_name}")
+        # URLのバンドが存在しなければ切断
+        if self.band_id is not None and not (await avalidate_band_ids([self.band_id]))[0]:
+            await self.send_message({
+                'type': 'error',
+                'message': f'バンド {self.band_id} は存在しません'
+            })
+            await self.close_for('unknown_band', CLOSE_UNKNOWN_BAND)
+            return
+        
+        # グループに参加（再開トークンがあれば前回の購読も復元。削除済みのバンドは除く）
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        resumed = resume_band_ids(query['resume'][0]) if 'resume' in query else None
+        band_ids = [self.band_id] if self.band_id is not None else []
+        band_ids += (resumed or [])[:settings.TIMER_WS_MAX_SUBSCRIPTIONS]
+        for band_id in (await avalidate_band_ids(band_ids))[0]:
+            await self.subscribe_band(band_id)
+        
+        logger.info(f"WebSocket接続: band_id={self.band_id}, resumed={resumed is not None}, channel={self.channel_name}")
         
         # 接続確認メッセージ送信
-        await self.send(text_data=json.dumps({
+        if self.band_id is not None:
+            message = f'バンド {self.band_id} のタイマーに接続しました'
+        else:
+            message = 'タイマーに接続しました（subscribe でバンドを購読してください）'
+        await self.send_message({
             'type': 'connection_established',
-            'message': f'バンド {self.band_id} のタイマーに接続しました',
-            'band_id': self.band_id
-        }))
+            'message': message,
+            'band_id': self.band_id,
+            'band_ids': sorted(int(band_id) for band_id in self.band_ids),
+            'resumed': resumed is not None,  # True なら resume で差分を要求できる
+            'resume_token': resume_token(self.band_ids),
+            'retry_after_ms': retry_after_ms(),  # 切断された場合に再接続するまでの待ち時間
+            'ack_window': self.window.size,  # 受信確認なしで送るフレーム数の上限
+            'server_ms': now_ms()  # 時刻合わせの初期値（正確な値は ping/pong で推定）
+        })
 
     async def disconnect(self, close_code):
         """WebSocket切断時の処理"""
-        # グループから離脱
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        # 購読中の全グループから離脱
+        for band_id in list(getattr(self, 'band_ids', ())):
+            await self.unsubscribe_band(band_id)
+        if getattr(self, 'sender', None) is not None:
+            self.sender.cancel()
+        if getattr(self, 'counted', False):
+            WEBSOCKET_SOCKETS.dec()
         
         logger.info(f"WebSocket切断: band_id={self.band_id}, code={close_code}")
 
-    async def receive(self, text_data):
+    async def subscribe_band(self, band_id):
+        """バンドのグループに参加（band_id は avalidate_band_ids で検証済みのもの）"""
+        if band_id in self.band_ids:
+            return
+        await self.channel_layer.group_add(band_group_name(band_id), self.channel_name)
+        self.band_ids.add(band_id)
+        WEBSOCKET_CONNECTIONS.labels(band_id).inc()
+
+    async def unsubscribe_band(self, band_id):
+        """バンドのグループから離脱（購読していなければ何もしない）"""
+        band_id = str(band_id)
+        if band_id not in self.band_ids:
+            return
+        await self.channel_layer.group_discard(band_group_name(band_id), self.channel_name)
+        self.band_ids.discard(band_id)
+        WEBSOCKET_CONNECTIONS.labels(band_id).dec()
+
+    async def update_subscriptions(self, message_type, band_ids):
+        """
+        subscribe / unsubscribe の処理（1接続あたりの購読数に上限あり）
+        subscribe は不正・不明なバンドIDが1つでもあれば購読せずにエラーを返す
+        """
+        if not isinstance(band_ids, list):
+            raise TypeError('band_ids must be a list')
+        if message_type == 'subscribe':
+            limit = settings.TIMER_WS_MAX_SUBSCRIPTIONS
+            if len(band_ids) > limit:
+                await self.send_message({
+                    'type': 'error',
+                    'message': f'購読できるバンドは{limit}件までです'
+                })
+                return
+            known, unknown = await avalidate_band_ids(band_ids)
+            if unknown:
+                await self.send_message({
+                    'type': 'error',
+                    'message': '存在しないバンドです',
+                    'band_ids': unknown
+                })
+                return
+            if len(self.band_ids | set(known)) > limit:
+                await self.send_message({
+                    'type': 'error',
+                    'message': f'購読できるバンドは{limit}件までです'
+                })
+                return
+            for band_id in known:
+                await self.subscribe_band(band_id)
+        else:
+            for band_id in band_ids:
+                await self.unsubscribe_band(band_id)
+        await self.send_message({
+            'type': 'subscriptions',
+            'band_ids': sorted(int(band_id) for band_id in self.band_ids),
+            'resume_token': resume_token(self.band_ids)
+        })
+
+    async def send_message(self, content):
+        """ソケットの形式（JSON / msgpack）でエンコードして送信（応答は送信を止めない）"""
+        self.window.on_send()
+        if self.binary:
+            await self.send(bytes_data=encode_msgpack(content))
+        else:
+            await self.send(text_data=encode_json(content))
+
+    def encoded_frame(self, event):
+        """グループメッセージをソケットの形式のフレーム (text, bytes) にする"""
+        if self.binary and 'bytes' in event:
+            return None, event['bytes']
+        if 'text' in event:
+            return event['text'], None
+        # エンコード前の形式（旧バージョンの送信側）
+        content = {'type': event['type'], 'band_id': event['data'].get('band_id'), 'data': event['data']}
+        if self.binary:
+            return None, encode_msgpack(content)
+        return encode_json(content), None
+
+    async def send_encoded(self, event):
+        """
+        送信側でエンコード済みのグループメッセージを送信キューに積む
+        同じセッションの timer_update が未送信なら最新の状態で置き換える
+        """
+        if self.closing:
+            return
+        key = event.get('session_id') if event['type'] == 'timer_update' else None
+        try:
+            if self.outbound.put(self.encoded_frame(event), key):
+                WEBSOCKET_FRAMES_DROPPED.labels('outbound').inc()
+        except QueueFull:
+            await self.close_for('slow_consumer', CLOSE_SLOW_CONSUMER)
+
+    async def send_frames(self):
+        """
+        送信キューのフレームを順に送る（接続ごとのタスク）
+        受信確認のないフレームが上限に達している間は送らず、キューに残す（置き換えは続く）
+        """
+        while True:
+            await self.window.wait()
+            text_data, bytes_data = await self.outbound.get()
+            self.window.on_send()
+            await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    async def close_for(self, reason, code):
+        """制限を超えた接続をクローズコード付きで切断"""
+        if self.closing:
+            return
+        self.closing = True
+        WEBSOCKET_CLOSED.labels(reason).inc()
+        logger.warning(f"WebSocket切断（{reason}）: band_ids={sorted(self.band_ids)}, channel={self.channel_name}")
+        await self.close(code=code)
+
+    async def admit(self, text_data, bytes_data):
+        """受信フレームを処理するか（サイズ・レートの制限。パース前に判定する）"""
+        if self.closing:
+            return False
+        size = len(text_data if text_data is not None else bytes_data or b'')
+        if size > settings.TIMER_WS_MAX_MESSAGE_BYTES:
+            await self.close_for('message_too_big', CLOSE_MESSAGE_TOO_BIG)
+            return False
+        if self.inbound.full:
+            # しばらく制限内に収まっていれば破棄数をリセット
+            self.dropped = 0
+        if self.inbound.consume():
+            return True
+        self.dropped += 1
+        WEBSOCKET_FRAMES_DROPPED.labels('inbound').inc()
+        if self.dropped >= settings.TIMER_WS_MAX_DROPPED:
+            await self.close_for('rate_limited', CLOSE_RATE_LIMITED)
+        return False
+
+    async def receive(self, text_data=None, bytes_data=None):
         """クライアントからのメッセージ受信"""
+        received_ms = now_ms()
+        if not await self.admit(text_data, bytes_data):
+            return
         try:
-            text_data_json = json.loads(text_data)
+            if bytes_data is not None and msgpack is not None:
+                text_data_json = msgpack.unpackb(bytes_data)
+            else:
+                text_data_json = json.loads(text_data)
             message_type = text_data_json.get('type')
             
             if message_type == 'ping':
-                # ピングに対してポング応答
-                await self.send(text_data=json.dumps({
+                # 時刻合わせ（NTP方式）。クライアントは送信時刻・受信時刻と合わせて
+                # offset = ((server_recv - timestamp) + (server_send - 受信時刻)) / 2
+                # rtt = (受信時刻 - timestamp) - (server_send - server_recv) を求める
+                await self.send_message({
                     'type': 'pong',
-                    'timestamp': text_data_json.get('timestamp')
-                }))
+                    'timestamp': text_data_json.get('timestamp'),
+                    'server_recv_ms': received_ms,
+                    'server_send_ms': now_ms()
+                })
+                
+            elif message_type == 'ack':
+                if not self.window.ack(text_data_json.get('received')):
+                    raise ValueError('invalid ack')
+                
+            elif message_type == 'resume':
+                await self.send_delta(text_data_json.get('versions') or {})
+                
+            elif message_type in ('subscribe', 'unsubscribe'):
+                await self.update_subscriptions(message_type, text_data_json.get('band_ids') or [])
                 
             elif message_type == 'timer_status_request':
-                # タイマー状態要求（将来の実装用）
-                await self.send(text_data=json.dumps({
+                # 購読中のバンドの稼働中セッション一覧を返す（複数購読時は band_id を指定）
+                band_id = text_data_json.get('band_id') or self.band_id
+                if band_id is None:
+                    raise ValueError('band_id is required')
+                if str(band_id) not in self.band_ids:
+                    await self.send_message({
+                        'type': 'error',
+                        'message': f'バンド {band_id} を購読していません',
+                        'band_ids': [band_id]
+                    })
+                    return
+                await self.send_message({
                     'type': 'timer_status_response',
-                    'message': 'タイマー状態機能は開発中です'
-                }))
+                    'band_id': band_id,
+                    'sessions': await get_backend().list_band_sessions(band_id)
+                })
                 
-        except json.JSONDecodeError:
-            # JSONパースエラー
-            await self.send(text_data=json.dumps({
+        except (ValueError, TypeError, AttributeError):
+            # JSON・msgpackのパースエラー、オブジェクト以外
+            await self.send_message({
                 'type': 'error',
                 'message': '不正なメッセージ形式です'
-            }))
+            })
+
+    async def send_delta(self, versions):
+        """
+        再接続時の差分（クライアントが最後に受け取ったバージョンより新しいセッションのみ）
+        購読中のバンドの稼働中セッションと、クライアントが知っているセッションを確認する
+        """
+        known = {
+            str(session_id): int(version)
+            for session_id, version in list(versions.items())[:settings.TIMER_WS_RESUME_MAX_SESSIONS]
+        }
+        backend = get_backend()
+        sessions, removed, live = [], [], set()
+        for band_id in sorted(self.band_ids):
+            for session_data in await backend.list_band_sessions(band_id):
+                session_id = session_data['session_id']
+                live.add(session_id)
+                if session_data['version'] > known.get(session_id, 0):
+                    event = 'resync' if session_id in known else 'started'
+                    sessions.append(session_payload(session_id, session_data, event))
+        for session_id, version in known.items():
+            if session_id in live:
+                continue
+            # 切断中に完了したセッション等
+            session_data = await backend.get_session_status(session_id)
+            if session_data['status'] == 'not_found':
+                removed.append(session_id)
+            elif session_data['version'] > version and str(session_data['band_id']) in self.band_ids:
+                sessions.append(session_payload(session_id, session_data, 'resync'))
+        await self.send_message({'type': 'timer_delta', 'sessions': sessions, 'removed': removed})
 
     async def timer_update(self, event):
         """
         グループからのタイマー更新メッセージを送信
-        Celeryタスクから呼び出される予定
+        開始・一時停止・再開・定期通知（broadcast.py 経由）
         """
-        await self.send(text_data=json.dumps({
-            'type': 'timer_update',
-            'data': event['data']
-        }))
+        await self.send_encoded(event)
+
+    async def timer_batch_update(self, event):
+        """一括操作（複数セッション）の更新通知。バンドごとに1通"""
+        await self.send_encoded(event)
 
     async def timer_completed(self, event):
         """タイマー完了通知"""
-        await self.send(text_data=json.dumps({
-            'type': 'timer_completed',
-            'data': event['data']
-        }))
-
-    @database_sync_to_async
-    def get_band_info(self, band_id):
-        """バンド情報取得（非同期対応）"""
-        try:
-            band = Band.objects.get(id=band_id)
-            return {'id': band.id, 'name': band.name}
-        except Band.DoesNotExist:
-            return None
\ No newline at end of file
+        await self.send_encoded(event)
+
+    async def timer_schedule_changed(self, event):
+        """バンドのタイマー構成（順序・有効/無効）の変更通知"""
+        await self.send_encoded(event)
+
+    async def get_band_info(self, band_id):
+        """バンド情報取得（プロセス内キャッシュ。DB往復なし）"""
+        return await aget_band_info(band_id)
@@ -0,0 +1,110 @@
+"""
+終了通知キーの失効による完了検知（TIMER_COMPLETION_MODE='keyspace'）
+
+実行中セッションには DEADLINE_KEY（TTL=残り時間）が張られている（session_store.py）。
+一時停止で削除、再開で残り時間のTTLで張り直すため、待機中のセッションに周期処理は発生しない。
+Redisのキー失効通知（__keyevent@<db>__:expired）を購読し、失効したキーのセッションを完了させる。
+
+Pub/Subは取りこぼし得るため、TIMER_EXPIRY_SWEEP_INTERVAL 秒ごとに終了時刻インデックスも確認する。
+失効通知はノードごとに発行されるため、Redisノードが複数の場合はノードごとに購読する。
+"""
+
+from django.conf import settings
+import logging
+import threading
+import time
+from .redis_client import get_redis, shard_urls
+from .session_store import DEADLINE_KEY
+from .scheduler import complete_due, process_due, flush_events, prune_indexes, rehydrate
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_PREFIX = DEADLINE_KEY.format('')
+RECONNECT_SECONDS = 1
+
+
+def deadline_session_id(key):
+    """終了通知キーからsession_idを取り出す。対象外のキーならNone"""
+    if key.startswith(DEADLINE_PREFIX):
+        return key[len(DEADLINE_PREFIX):]
+    return None
+
+
+def enable_expiry_notifications(client):
+    """キー失効通知を有効化（CONFIGが禁止された環境では設定済みである前提で続行）"""
+    try:
+        flags = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        if 'E' not in flags or ('x' not in flags and 'A' not in flags):
+            client.config_set('notify-keyspace-events', flags + 'Ex')
+    except Exception as e:
+        logger.warning(f"notify-keyspace-events を設定できません（Exを設定してください）: {e}")
+
+
+def expired_channel(client):
+    db = client.connection_pool.connection_kwargs.get('db', 0)
+    return f'__keyevent@{db}__:expired'
+
+
+def handle_expired(key):
+    """失効したキーが終了通知キーならセッションを完了させる"""
+    session_id = deadline_session_id(key)
+    if session_id is None:
+        return
+    if complete_due(session_id) is None:
+        # 時計のずれで終了時刻前に失効した場合等。インデックスの確認で完了させる
+        logger.debug(f"失効通知を保留: session_id={session_id}")
+
+
+def _listen(shard, stop):
+    """ノードのキー失効通知を受信し続ける（切断時は再接続）"""
+    client = get_redis(shard)
+    enable_expiry_notifications(client)
+    channel = expired_channel(client)
+    while not stop():
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            while not stop():
+                message = pubsub.get_message(timeout=RECONNECT_SECONDS)
+                if message:
+                    handle_expired(message['data'])
+        except Exception as e:
+            logger.error(f"失効通知の受信エラー: shard={shard}, error={e}")
+            time.sleep(RECONNECT_SECONDS)
+
+
+def run_expiry_listener(stop=lambda: False):
+    """
+    キー失効通知の購読ループ
+    Redisノードごとに受信スレッドを起動し、このスレッドは定期的な確認とイベント保存を行う
+    """
+    sweep_interval = settings.TIMER_EXPIRY_SWEEP_INTERVAL
+    prune_interval = settings.TIMER_INDEX_PRUNE_INTERVAL
+    next_prune = time.monotonic() + prune_interval
+    shards = shard_urls()
+
+    logger.info(f"タイマー失効通知リスナー開始: shards={len(shards)}, sweep={sweep_interval}s")
+    rehydrate()
+
+    listeners = [
+        threading.Thread(target=_listen, args=(shard, stop), name=f'timer-expiry-{index}', daemon=True)
+        for index, shard in enumerate(shards)
+    ]
+    for listener in listeners:
+        listener.start()
+
+    while not stop():
+        try:
+            # 取りこぼし対策と、停止中に期限切れとなったセッションの完了
+            while process_due() >= settings.TIMER_SCHEDULER_BATCH_SIZE:
+                pass
+            flush_events()
+        except Exception as e:
+            logger.error(f"終了時刻インデックスの確認エラー: {e}")
+        if time.monotonic() >= next_prune:
+            prune_indexes()
+            next_prune = time.monotonic() + prune_interval
+        time.sleep(sweep_interval)
+
+    for listener in listeners:
+        listener.join()
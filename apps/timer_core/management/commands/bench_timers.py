@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from apps.timer_core.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = '同時セッション・WebSocket配信の負荷計測（fakeredis、または実Redisのノード数ごと。データは専用のテストデータベースに書き込む）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=1000, help='同時セッション数')
+        parser.add_argument('--bands', type=int, default=20, help='バンド数')
+        parser.add_argument('--clients', type=int, default=10, help='バンドあたりのWebSocket接続数')
+        parser.add_argument('--status-requests', type=int, default=2000, help='状態取得APIのリクエスト数')
+        parser.add_argument('--concurrency', type=int, default=50, help='状態取得APIの同時実行数')
+        parser.add_argument('--churn', type=int, default=200, help='一時停止→再開するセッション数')
+        parser.add_argument('--completions', type=int, default=200, help='完了検知を計測するセッション数')
+        parser.add_argument('--scheduler-interval', type=float, default=0.1, help='スケジューラの最大待機秒数（TIMER_SCHEDULER_INTERVAL）')
+        parser.add_argument('--backend', choices=['redis', 'asyncio'], default='redis',
+                            help='タイマーバックエンド（TIMER_BACKEND）')
+        parser.add_argument('--wire-format', choices=['json', 'msgpack'], default='json',
+                            help='WebSocketの配信形式（サブプロトコルで選択）')
+        parser.add_argument('--redis-url', action='append', default=None,
+                            help='実Redisで計測する場合のURL（複数指定で1台から指定台数までノード数ごとに計測。省略時はfakeredis）')
+        parser.add_argument('--shards', type=int, default=1, help='fakeredis で計測する場合のノード数')
+
+    def handle(self, *args, **options):
+        run_benchmark(self.stdout, **options)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from apps.timer_core.persistence import rehydrate_sessions
+
+
+class Command(BaseCommand):
+    help = '保存済みの稼働中セッションをRedisへ復元（Redis再起動後など）'
+
+    def handle(self, *args, **options):
+        total, restored = rehydrate_sessions()
+        self.stdout.write(f'セッション復元: 対象={total}, 新規作成={restored}')
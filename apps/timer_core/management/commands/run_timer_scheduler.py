@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.timer_core.expiry import run_expiry_listener
+from apps.timer_core.metrics import start_metrics_server
+from apps.timer_core.scheduler import run_scheduler
+
+
+class Command(BaseCommand):
+    help = 'タイマー完了検知を起動（TIMER_COMPLETION_MODE: scheduler=終了時刻インデックス, keyspace=キー失効通知）'
+
+    def handle(self, *args, **options):
+        start_metrics_server()
+        try:
+            if settings.TIMER_COMPLETION_MODE == 'keyspace':
+                run_expiry_listener()
+            else:
+                run_scheduler()
+        except KeyboardInterrupt:
+            self.stdout.write('スケジューラを停止しました')
@@ -0,0 +1,237 @@
+"""
+バンド・タイマー情報のプロセス内キャッシュ
+
+バンド名・タイマー時間はほぼ変更されないため、操作APIやWebSocket接続のたびに
+DBへ問い合わせないよう、プロセス内のLRU（件数上限・TTL付き）に保持する。
+
+Band/Timer の post_save・post_delete で自プロセスのキャッシュを無効化し、
+コミット後に Redis Pub/Sub で他プロセス（daphne・Celeryワーカー等）へも無効化を通知する。
+通知を取りこぼしても TTL で必ず期限切れになる。
+asyncioバックエンド（単一プロセス）ではプロセス間の通知を行わない。
+"""
+
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import logging
+import threading
+import time
+from .models import Band, Timer
+from .redis_client import get_redis
+from .metrics import METADATA_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+INVALIDATE_CHANNEL = 'timer_metadata_invalidate'
+LISTENER_RETRY_SECONDS = 1
+
+
+class LRUCache:
+    """件数上限とTTL付きのLRU（スレッドセーフ）"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_bands = LRUCache(settings.TIMER_METADATA_CACHE_SIZE, settings.TIMER_METADATA_CACHE_TTL)
+_timers = LRUCache(settings.TIMER_METADATA_CACHE_SIZE, settings.TIMER_METADATA_CACHE_TTL)
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def band_info(band):
+    return {'id': band.id, 'name': band.name}
+
+
+def timer_info(timer):
+    return {
+        'id': timer.id,
+        'name': timer.name,
+        'band_id': timer.band_id,
+        'band_name': timer.band.name,
+        'duration_minutes': timer.duration_minutes,
+        'order': timer.order,
+        'is_active': timer.is_active,
+    }
+
+
+def _lookup(cache, kind, key):
+    _ensure_listener()
+    value = cache.get(key)
+    METADATA_CACHE_LOOKUPS.labels(kind, 'miss' if value is None else 'hit').inc()
+    return value
+
+
+def get_band_info(band_id):
+    """バンド情報（キャッシュになければDBから取得）。存在しなければNone"""
+    if band_id is None:
+        return None
+    band_id = int(band_id)
+    info = _lookup(_bands, 'band', band_id)
+    if info is None:
+        band = Band.objects.filter(id=band_id).only('id', 'name').first()
+        if band is None:
+            return None
+        info = band_info(band)
+        _bands.set(band_id, info)
+    return info
+
+
+def get_timer_info(timer_id):
+    """タイマー情報（バンド名を含む）。存在しなければNone"""
+    if timer_id is None:
+        return None
+    timer_id = int(timer_id)
+    info = _lookup(_timers, 'timer', timer_id)
+    if info is None:
+        timer = Timer.objects.select_related('band').filter(id=timer_id).first()
+        if timer is None:
+            return None
+        info = timer_info(timer)
+        _timers.set(timer_id, info)
+    return info
+
+
+async def aget_band_info(band_id):
+    if band_id is None:
+        return None
+    band_id = int(band_id)
+    info = _lookup(_bands, 'band', band_id)
+    if info is None:
+        band = await Band.objects.filter(id=band_id).only('id', 'name').afirst()
+        if band is None:
+            return None
+        info = band_info(band)
+        _bands.set(band_id, info)
+    return info
+
+
+async def aget_timer_info(timer_id):
+    if timer_id is None:
+        return None
+    timer_id = int(timer_id)
+    info = _lookup(_timers, 'timer', timer_id)
+    if info is None:
+        timer = await Timer.objects.select_related('band').filter(id=timer_id).afirst()
+        if timer is None:
+            return None
+        info = timer_info(timer)
+        _timers.set(timer_id, info)
+    return info
+
+
+# ---- 無効化 ----
+
+def apply_invalidation(message):
+    """無効化メッセージ（'band:<id>' / 'band_timers:<id>' / 'timer:<id>'）を自プロセスのキャッシュに反映"""
+    kind, _, raw_id = message.partition(':')
+    try:
+        object_id = int(raw_id)
+    except ValueError:
+        return
+    if kind == 'band':
+        # バンド名を含むタイマー情報もまとめて無効化
+        _bands.delete(object_id)
+        _timers.delete_where(lambda info: info['band_id'] == object_id)
+    elif kind == 'band_timers':
+        # 一括更新（bulk_update はシグナルを発火しない）したバンドのタイマー情報
+        _timers.delete_where(lambda info: info['band_id'] == object_id)
+    elif kind == 'timer':
+        _timers.delete(object_id)
+
+
+def _cross_process():
+    return settings.TIMER_BACKEND != 'asyncio'
+
+
+def invalidate(kind, object_id):
+    """自プロセスを即時無効化し、コミット後に他プロセスへ通知"""
+    message = f'{kind}:{object_id}'
+    apply_invalidation(message)
+    if not _cross_process():
+        return
+
+    def publish():
+        try:
+            get_redis().publish(INVALIDATE_CHANNEL, message)
+        except Exception as e:
+            logger.error(f"キャッシュ無効化の通知エラー: {message}, error={e}")
+
+    transaction.on_commit(publish)
+
+
+def clear():
+    _bands.clear()
+    _timers.clear()
+
+
+def _listen():
+    """他プロセスからの無効化通知を受信し続ける（切断時は全消去して再接続）"""
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                apply_invalidation(message['data'])
+        except Exception as e:
+            logger.error(f"キャッシュ無効化の受信エラー: {e}")
+        # 取りこぼした通知があり得るため全消去
+        clear()
+        time.sleep(LISTENER_RETRY_SECONDS)
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is not None or not _cross_process():
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen, name='timer-metadata-invalidation', daemon=True)
+            _listener.start()
+
+
+@receiver([post_save, post_delete], sender=Band)
+def _on_band_changed(sender, instance, **kwargs):
+    invalidate('band', instance.id)
+
+
+@receiver([post_save, post_delete], sender=Timer)
+def _on_timer_changed(sender, instance, **kwargs):
+    invalidate('timer', instance.id)
@@ -0,0 +1,197 @@
+"""
+タイマーのホットパス計測（Prometheus形式）
+
+daphne プロセスの値は /metrics で公開する。
+Celeryワーカーとスケジューラは別プロセスのため、TIMER_METRICS_PORT を設定すると
+それぞれ専用のHTTPサーバーで公開する（prefork時は PROMETHEUS_MULTIPROC_DIR を設定）。
+"""
+
+from celery.signals import before_task_publish, task_prerun, task_postrun, worker_ready
+from django.conf import settings
+from functools import wraps
+from prometheus_client import (
+    REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, start_http_server, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# 1ms〜10sを中心にしたバケット
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+API_LATENCY = Histogram(
+    'timer_api_request_seconds', 'APIビューの処理時間', ['view'], buckets=LATENCY_BUCKETS
+)
+TASK_DURATION = Histogram(
+    'timer_task_duration_seconds', 'Celeryタスクの実行時間', ['task'], buckets=LATENCY_BUCKETS
+)
+TASK_QUEUE_WAIT = Histogram(
+    'timer_task_queue_wait_seconds', 'Celeryタスクの送信から実行開始までの待ち時間', ['task'],
+    buckets=LATENCY_BUCKETS
+)
+SESSION_LOOKUPS = Counter(
+    'timer_session_store_lookups_total', 'セッションストアの参照数', ['result']  # hit / miss
+)
+METADATA_CACHE_LOOKUPS = Counter(
+    'timer_metadata_cache_lookups_total', 'バンド・タイマー情報キャッシュの参照数', ['kind', 'result']
+)
+COMPLETION_LAG = Histogram(
+    'timer_completion_lag_seconds', '完了検知の遅れ（検知時刻 - end_ms）', buckets=LATENCY_BUCKETS
+)
+# バンドのラベルは存在を確認したバンド（consumers.avalidate_band_ids）のみ付ける
+WEBSOCKET_CONNECTIONS = Gauge(
+    'timer_websocket_connections', 'バンドを購読中のWebSocket接続数', ['band'], multiprocess_mode='livesum'
+)
+WEBSOCKET_SOCKETS = Gauge(
+    'timer_websocket_sockets', '接続中のWebSocket数（購読の有無によらない）', multiprocess_mode='livesum'
+)
+WEBSOCKET_FRAMES_DROPPED = Counter(
+    'timer_websocket_frames_dropped_total', '破棄したWebSocketフレーム数', ['direction']  # inbound: レート超過 / outbound: 新しい状態で置き換え
+)
+WEBSOCKET_CLOSED = Counter(
+    'timer_websocket_closed_total', 'サーバーから切断したWebSocket数', ['reason']
+)
+
+# Redisコネクションプール（redis_pools.py。role: session / cache / channels）
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+REDIS_POOL_WAIT = Histogram(
+    'timer_redis_pool_wait_seconds', 'Redisコネクションの取得待ち時間（接続を含む）', ['role'],
+    buckets=POOL_WAIT_BUCKETS
+)
+REDIS_POOL_IN_USE = Gauge(
+    'timer_redis_pool_connections_in_use', '使用中のRedisコネクション数', ['role'], multiprocess_mode='livesum'
+)
+REDIS_POOL_EXHAUSTED = Counter(
+    'timer_redis_pool_exhausted_total', 'プールの上限に達し待ち時間内にコネクションを取得できなかった回数', ['role']
+)
+
+PUBLISHED_AT_HEADER = 'timer_published_at'
+
+
+def observe_view(view_func):
+    """APIビューの処理時間を記録するデコレータ（同期・非同期どちらにも使える）"""
+    name = view_func.__name__
+    histogram = API_LATENCY.labels(name)
+
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await view_func(request, *args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def record_lookup(found):
+    SESSION_LOOKUPS.labels('hit' if found else 'miss').inc()
+
+
+class LiveSessionCollector:
+    """
+    稼働中・実行中セッション数（取得時にRedisのインデックスをSCARD/ZCARDで数える。SCANなし）
+    失効したメンバーの除去はスケジューラが定期的に行う（session_store.prune_live_sessions）
+    """
+
+    def describe(self):
+        # 登録時にRedisへ接続しないよう、メトリクス名のみ返す
+        return [
+            GaugeMetricFamily('timer_live_sessions', '稼働中（実行中・一時停止中）のセッション数'),
+            GaugeMetricFamily('timer_running_sessions', '終了時刻インデックスに登録中のセッション数'),
+            GaugeMetricFamily('timer_band_live_sessions', 'バンドごとの稼働中セッション数', labels=['band']),
+        ]
+
+    def collect(self):
+        from .models import Band
+        from .redis_client import band_shard, get_redis, group_by_shard, shard_urls
+        from .session_store import DEADLINES_KEY, LIVE_SESSIONS_KEY, band_index_key
+
+        live = GaugeMetricFamily('timer_live_sessions', '稼働中（実行中・一時停止中）のセッション数')
+        running = GaugeMetricFamily('timer_running_sessions', '終了時刻インデックスに登録中のセッション数')
+        band_live = GaugeMetricFamily('timer_band_live_sessions', 'バンドごとの稼働中セッション数', labels=['band'])
+        live_count = running_count = 0
+        try:
+            for shard in shard_urls():
+                pipe = get_redis(shard).pipeline(transaction=False)
+                pipe.scard(LIVE_SESSIONS_KEY)
+                pipe.zcard(DEADLINES_KEY)
+                shard_live, shard_running = pipe.execute()
+                live_count += shard_live
+                running_count += shard_running
+            # バンド別インデックスはバンドの担当ノードにある（ノードごとにパイプライン1回）
+            band_ids = list(Band.objects.values_list('id', flat=True))
+            for shard, shard_band_ids in group_by_shard(band_ids, band_shard).items():
+                pipe = get_redis(shard).pipeline(transaction=False)
+                for band_id in shard_band_ids:
+                    pipe.scard(band_index_key(band_id))
+                for band_id, count in zip(shard_band_ids, pipe.execute()):
+                    band_live.add_metric([str(band_id)], count)
+        except Exception as e:
+            logger.error(f"メトリクス取得エラー: {e}")
+            return
+        live.add_metric([], live_count)
+        running.add_metric([], running_count)
+        yield live
+        yield running
+        yield band_live
+
+
+REGISTRY.register(LiveSessionCollector())
+
+
+# ---- Celeryタスク計測 ----
+
+_task_started = {}
+
+
+@before_task_publish.connect
+def _on_publish(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def _on_prerun(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, PUBLISHED_AT_HEADER, None)
+    if published_at:
+        TASK_QUEUE_WAIT.labels(task.name).observe(max(0, time.time() - published_at))
+
+
+@task_postrun.connect
+def _on_postrun(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name).observe(time.perf_counter() - started)
+
+
+def start_metrics_server(port=None):
+    """別プロセス（Celeryワーカー・スケジューラ）用のメトリクスHTTPサーバー"""
+    port = port or settings.TIMER_METRICS_PORT
+    if not port:
+        return
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    logger.info(f"メトリクスサーバー起動: port={port}")
+
+
+@worker_ready.connect
+def _on_worker_ready(**kwargs):
+    start_metrics_server()
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.20 on 2026-10-18 14:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timer_core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimerSessionEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=64, verbose_name='セッションID')),
+                ('event', models.CharField(choices=[('scheduled', '待機'), ('started', '開始'), ('paused', '一時停止'), ('resumed', '再開'), ('completed', '完了'), ('skipped', 'スキップ')], max_length=20, verbose_name='イベント')),
+                ('at_ms', models.BigIntegerField(verbose_name='発生時刻')),
+                ('version', models.IntegerField(verbose_name='バージョン')),
+            ],
+            options={
+                'verbose_name': 'セッションイベント',
+                'verbose_name_plural': 'セッションイベント一覧',
+                'ordering': ['at_ms'],
+                'indexes': [models.Index(fields=['session_id', 'at_ms'], name='timer_core__session_36e391_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TimerSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=64, unique=True, verbose_name='セッションID')),
+                ('status', models.CharField(choices=[('scheduled', '待機中'), ('running', '実行中'), ('paused', '一時停止中'), ('completed', '完了')], max_length=20, verbose_name='状態')),
+                ('start_ms', models.BigIntegerField(verbose_name='開始時刻')),
+                ('end_ms', models.BigIntegerField(verbose_name='終了時刻')),
+                ('total_seconds', models.IntegerField(verbose_name='合計秒数')),
+                ('paused_ms', models.BigIntegerField(blank=True, null=True, verbose_name='一時停止時刻')),
+                ('done_ms', models.BigIntegerField(blank=True, null=True, verbose_name='完了時刻')),
+                ('version', models.IntegerField(default=1, verbose_name='バージョン')),
+                ('next_session_id', models.CharField(blank=True, max_length=64, verbose_name='次区間のセッションID')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('band', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sessions', to='timer_core.band', verbose_name='バンド')),
+                ('timer', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sessions', to='timer_core.timer', verbose_name='タイマー')),
+            ],
+            options={
+                'verbose_name': 'タイマーセッション',
+                'verbose_name_plural': 'タイマーセッション一覧',
+            },
+        ),
+    ]
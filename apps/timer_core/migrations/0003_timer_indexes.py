@@ -0,0 +1,21 @@
+# Generated by Django 4.2.20 on 2026-10-18 14:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timer_core', '0002_timer_sessions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='band',
+            index=models.Index(fields=['name'], name='band_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timer',
+            index=models.Index(fields=['band', 'order'], name='timer_band_order_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timer_core', '0003_timer_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='schedule_version',
+            field=models.PositiveIntegerField(default=1, editable=False, verbose_name='構成バージョン'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timer_core', '0004_band_schedule_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='timersession',
+            name='status',
+            field=models.CharField(choices=[('scheduled', '待機中'), ('running', '実行中'), ('paused', '一時停止中'), ('completed', '完了'), ('expired', '失効')], max_length=20, verbose_name='状態'),
+        ),
+        migrations.AlterField(
+            model_name='timersessionevent',
+            name='event',
+            field=models.CharField(choices=[('scheduled', '待機'), ('started', '開始'), ('paused', '一時停止'), ('resumed', '再開'), ('completed', '完了'), ('skipped', 'スキップ'), ('expired', '失効')], max_length=20, verbose_name='イベント'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.20 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timer_core', '0005_session_expired'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='timersession',
+            index=models.Index(fields=['status', 'start_ms'], name='session_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timersession',
+            index=models.Index(fields=['start_ms'], name='session_start_idx'),
+        ),
+    ]
@@ -5,14 +5,29 @@ class Band(models.Model):
     name = models.CharField('バンド名', max_length=100)
     description = models.TextField('説明', blank=True)
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
+    # バンド・タイマーの変更ごとに増える（タイマー構成APIのETag）。schedule.py が更新する
+    schedule_version = models.PositiveIntegerField('構成バージョン', default=1, editable=False)
     
     class Meta:
         verbose_name = 'バンド'
         verbose_name_plural = 'バンド一覧'
+        indexes = [models.Index(fields=['name'], name='band_name_idx')]  # メイン画面のバンド名順
     
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # 構成バージョンは schedule.py がF式で進める。既存行の保存で手元の古い値を書き戻さないよう更新対象から外す
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != 'schedule_version'
+                ]
+            kwargs['update_fields'] = [name for name in update_fields if name != 'schedule_version']
+        super().save(*args, **kwargs)
+
 class Timer(models.Model):
     """タイマー情報"""
     band = models.ForeignKey(Band, on_delete=models.CASCADE, verbose_name='バンド')
@@ -32,6 +47,81 @@ class Timer(models.Model):
         verbose_name = 'タイマー'
         verbose_name_plural = 'タイマー一覧'
         ordering = ['band', 'order']  # バンド別、順序順でソート
+        indexes = [
+            # バンド内order順（既定の並び順・並び替え。有効なタイマーのみの取得もこの索引で行を絞る）
+            models.Index(fields=['band', 'order'], name='timer_band_order_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.band.name} - {self.name} ({self.duration_minutes}分)"
\ No newline at end of file
+        # 一覧で使う場合は select_related('band') すること（行ごとにバンドを取得しないため）
+        return f"{self.band.name} - {self.name} ({self.duration_minutes}分)"
+class TimerSession(models.Model):
+    """
+    タイマーセッションの保存状態（Redisのセッションの写し）
+    persistence.py がイベントをまとめて反映する。時刻はepochミリ秒
+    """
+    STATUS_CHOICES = [
+        ('scheduled', '待機中'),
+        ('running', '実行中'),
+        ('paused', '一時停止中'),
+        ('completed', '完了'),
+        ('expired', '失効'),  # Redis上で期限切れになった一時停止中・待機中のセッション（復元時に判定）
+    ]
+
+    session_id = models.CharField('セッションID', max_length=64, unique=True)
+    timer = models.ForeignKey(
+        Timer, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False,
+        related_name='sessions', verbose_name='タイマー'
+    )
+    band = models.ForeignKey(
+        Band, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False,
+        related_name='sessions', verbose_name='バンド'
+    )
+    status = models.CharField('状態', max_length=20, choices=STATUS_CHOICES)
+    start_ms = models.BigIntegerField('開始時刻')
+    end_ms = models.BigIntegerField('終了時刻')
+    total_seconds = models.IntegerField('合計秒数')
+    paused_ms = models.BigIntegerField('一時停止時刻', null=True, blank=True)
+    done_ms = models.BigIntegerField('完了時刻', null=True, blank=True)
+    version = models.IntegerField('バージョン', default=1)
+    next_session_id = models.CharField('次区間のセッションID', max_length=64, blank=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+    class Meta:
+        verbose_name = 'タイマーセッション'
+        verbose_name_plural = 'タイマーセッション一覧'
+        indexes = [
+            # 起動時の復元・失効判定（状態で絞る。待機中の失効判定は開始時刻の範囲も絞る。履歴全体を読まない）
+            models.Index(fields=['status', 'start_ms'], name='session_status_start_idx'),
+            # 復元時のランシート区間（状態によらず保持期間内の開始時刻で絞る）
+            models.Index(fields=['start_ms'], name='session_start_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} ({self.status})"
+
+class TimerSessionEvent(models.Model):
+    """タイマーセッションの操作履歴（開始・一時停止・再開・完了・失効）"""
+    EVENT_CHOICES = [
+        ('scheduled', '待機'),
+        ('started', '開始'),
+        ('paused', '一時停止'),
+        ('resumed', '再開'),
+        ('completed', '完了'),
+        ('skipped', 'スキップ'),
+        ('expired', '失効'),
+    ]
+
+    session_id = models.CharField('セッションID', max_length=64)
+    event = models.CharField('イベント', max_length=20, choices=EVENT_CHOICES)
+    at_ms = models.BigIntegerField('発生時刻')
+    version = models.IntegerField('バージョン')
+
+    class Meta:
+        verbose_name = 'セッションイベント'
+        verbose_name_plural = 'セッションイベント一覧'
+        ordering = ['at_ms']
+        indexes = [models.Index(fields=['session_id', 'at_ms'])]
+
+    def __str__(self):
+        return f"{self.session_id} {self.event}"
@@ -0,0 +1,286 @@
+"""
+セッションイベントのPostgresへの非同期一括保存（write-behind）
+
+遷移スクリプトが EVENTS_KEY に積んだイベントを、スケジューラが定期的に取り出し、
+1トランザクションで TimerSession（最新状態の写し）と TimerSessionEvent（履歴）へ保存する。
+操作API・Celeryタスク・残り時間配信の処理中にDB書き込みは発生しない。
+
+起動時（スケジューラ・Celeryワーカー）は rehydrate_sessions で、保存済みの稼働中セッションから
+Redisのセッション・終了時刻インデックス・稼働中インデックス・ランシートを一括で復元する。
+Redis上の期限を過ぎた一時停止中・待機中のセッションは復元せず、失効（expired）として記録する。
+Redisノードが複数の場合、イベントはノードごとに取り出し、復元は各セッションの担当ノードへ行う
+（ノード構成を変更した後の復元で、担当が移ったバンドの稼働中セッションも新しいノードに作られる）。
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+import logging
+import time
+from .models import TimerSession, TimerSessionEvent
+from .redis_client import get_redis, band_shard, group_by_shard, session_shard, shard_urls, LuaScript
+from .runsheet import RUNSHEET_TIMEOUT, runsheet_key
+from .session_store import (
+    DEADLINES_KEY, EVENTS_KEY, LIVE_SESSIONS_KEY, SESSION_TIMEOUT, band_index_key, deadline_key,
+    timer_index_key, session_key, now_ms, to_session_data,
+)
+
+logger = logging.getLogger(__name__)
+
+SESSION_UPDATE_FIELDS = [
+    'timer', 'band', 'status', 'start_ms', 'end_ms', 'total_seconds', 'paused_ms', 'done_ms',
+    'version', 'next_session_id', 'updated_at',
+]
+
+
+def parse_event(record):
+    """'session_id|event|at_ms|v' を TimerSessionEvent に変換"""
+    session_id, event, at_ms, version = record.split('|')
+    return TimerSessionEvent(session_id=session_id, event=event, at_ms=int(at_ms), version=int(version))
+
+
+def to_timer_session(session_id, session_data):
+    return TimerSession(
+        session_id=session_id,
+        timer_id=session_data['timer_id'],
+        band_id=session_data['band_id'] or None,
+        status=session_data['status'],
+        start_ms=session_data['start_ms'],
+        end_ms=session_data['end_ms'],
+        total_seconds=session_data['total_seconds'],
+        paused_ms=session_data.get('paused_ms'),
+        done_ms=session_data.get('done_ms'),
+        version=session_data['version'],
+        next_session_id=session_data.get('next_session_id', ''),
+    )
+
+
+def pop_events(limit, client=None):
+    """未保存イベントを先頭から最大limit件取り出す（LRANGE + LTRIM を原子的に）"""
+    pipe = (client or get_redis()).pipeline(transaction=True)
+    pipe.lrange(EVENTS_KEY, 0, limit - 1)
+    pipe.ltrim(EVENTS_KEY, limit, -1)
+    records, _ = pipe.execute()
+    return records
+
+
+def flush_session_events(limit=None):
+    """
+    全ノードのイベントを一括保存し、保存件数を返す（ノードごとに最大limit件）
+    セッションの状態は保存時点のRedisの値（最新）で上書きする
+    """
+    limit = limit or settings.TIMER_EVENT_FLUSH_BATCH_SIZE
+    return sum(_flush_shard(get_redis(shard), limit) for shard in shard_urls())
+
+
+def _flush_shard(client, limit):
+    records = pop_events(limit, client)
+    if not records:
+        return 0
+
+    events = [parse_event(record) for record in records]
+    session_ids = list(dict.fromkeys(event.session_id for event in events))
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(session_key(session_id))
+    sessions = [
+        to_timer_session(session_id, session_data)
+        for session_id, session_data in zip(session_ids, map(to_session_data, pipe.execute()))
+        if session_data is not None
+    ]
+
+    try:
+        with transaction.atomic():
+            TimerSession.objects.bulk_create(
+                sessions, update_conflicts=True, unique_fields=['session_id'],
+                update_fields=SESSION_UPDATE_FIELDS,
+            )
+            TimerSessionEvent.objects.bulk_create(events)
+    except Exception as e:
+        # 保存に失敗したイベントは先頭に戻し、次回に再試行する
+        logger.error(f"セッションイベント保存エラー: {len(records)}件, error={e}")
+        client.lpush(EVENTS_KEY, *reversed(records))
+        raise
+
+    logger.debug(f"セッションイベント保存: events={len(events)}, sessions={len(sessions)}")
+    return len(events)
+
+
+# ---- 起動時の復元 ----
+
+# Redisにないセッションのみ保存状態から作成し、全セッションのインデックスを張り直す
+# （Redisに残っているセッションはRedis側を正とする）
+# 停止中に終了時刻を過ぎたセッションは過去の終了時刻で登録され、スケジューラが即座に完了させる
+# 一時停止中・待機中のセッションの期限は作成時の期限（絶対時刻）のまま延ばさない
+# KEYS: 終了時刻インデックス, 全体インデックス,
+#       (セッション, 終了通知キー, バンド別インデックス, タイマー別インデックス) * N
+# ARGV: now_ms, timeout_s, scheduled_timeout_s,
+#       (session_id, status, timer_id, band_id, start_ms, end_ms, total_s, paused_ms, v, next) * N
+REHYDRATE_SCRIPT = LuaScript("""
+local now = tonumber(ARGV[1])
+local restored = 0
+for i = 4, #ARGV, 10 do
+    local sid = ARGV[i]
+    local k = 3 + (i - 4) / 10 * 4
+    local key = KEYS[k]
+    if redis.call('EXISTS', key) == 0 then
+        local status = ARGV[i + 1]
+        local end_ms = tonumber(ARGV[i + 5])
+        redis.call('HSET', key, 'status', status, 'timer_id', ARGV[i + 2], 'band_id', ARGV[i + 3],
+            'start_ms', ARGV[i + 4], 'end_ms', end_ms, 'total_s', ARGV[i + 6], 'v', ARGV[i + 8])
+        if ARGV[i + 7] ~= '' then redis.call('HSET', key, 'paused_ms', ARGV[i + 7]) end
+        if ARGV[i + 9] ~= '' then redis.call('HSET', key, 'next', ARGV[i + 9]) end
+        if status == 'running' then
+            redis.call('PEXPIRE', key, math.max(end_ms - now, 0) + ARGV[2] * 1000)
+        elseif status == 'paused' then
+            redis.call('PEXPIREAT', key, end_ms + ARGV[2] * 1000)
+        else
+            redis.call('PEXPIREAT', key, tonumber(ARGV[i + 4]) + ARGV[3] * 1000)
+        end
+        restored = restored + 1
+    end
+    local f = redis.call('HMGET', key, 'status', 'end_ms')
+    if f[1] == 'running' then
+        redis.call('ZADD', KEYS[1], f[2], sid)
+        redis.call('SET', KEYS[k + 1], 1, 'PX', math.max(tonumber(f[2]) - now, 1))
+    end
+    if f[1] == 'running' or f[1] == 'paused' then
+        redis.call('SADD', KEYS[k + 2], sid)
+        redis.call('SADD', KEYS[k + 3], sid)
+        redis.call('SADD', KEYS[2], sid)
+    end
+end
+return restored
+""")
+
+# Redisにないランシート本体のみ作成（期限はランシート開始から RUNSHEET_TIMEOUT）
+# KEYS: ランシート * N
+# ARGV: now_ms, runsheet_timeout_s, (band_id, session_ids, start_ms, planned_end_ms) * N
+REHYDRATE_RUNSHEET_SCRIPT = LuaScript("""
+local now = tonumber(ARGV[1])
+local restored = 0
+for i = 3, #ARGV, 4 do
+    local key = KEYS[(i - 3) / 4 + 1]
+    local expire_at = tonumber(ARGV[i + 2]) + ARGV[2] * 1000
+    if expire_at > now and redis.call('EXISTS', key) == 0 then
+        redis.call('HSET', key, 'sessions', ARGV[i + 1], 'start_ms', ARGV[i + 2], 'planned_end_ms', ARGV[i + 3])
+        redis.call('PEXPIREAT', key, expire_at)
+        restored = restored + 1
+    end
+end
+return restored
+""")
+
+REHYDRATE_FIELDS = (
+    'session_id', 'status', 'timer_id', 'band_id', 'start_ms', 'end_ms', 'total_seconds', 'paused_ms',
+    'version', 'next_session_id',
+)
+LIVE_STATUSES = ('running', 'paused', 'scheduled')
+
+
+def expire_stale_sessions(now=None):
+    """
+    Redis上の期限（一時停止中は終了予定 + SESSION_TIMEOUT、待機中は開始 + RUNSHEET_TIMEOUT）を
+    過ぎた保存済みセッションを失効（expired）にし、失効イベントを記録する。失効件数を返す
+    失効したセッションは以降の復元対象にならない
+    """
+    now = now or now_ms()
+    stale = TimerSession.objects.filter(
+        Q(status='paused', end_ms__lt=now - SESSION_TIMEOUT * 1000)
+        | Q(status='scheduled', start_ms__lt=now - RUNSHEET_TIMEOUT * 1000)
+    )
+    with transaction.atomic():
+        rows = list(stale.select_for_update().values_list('id', 'session_id', 'version'))
+        if not rows:
+            return 0
+        TimerSessionEvent.objects.bulk_create(
+            TimerSessionEvent(session_id=session_id, event='expired', at_ms=now, version=version + 1)
+            for _, session_id, version in rows
+        )
+        TimerSession.objects.filter(id__in=[pk for pk, _, _ in rows]).update(
+            status='expired', done_ms=now, version=F('version') + 1,
+        )
+    logger.info(f"セッション失効: {len(rows)}件")
+    return len(rows)
+
+
+def build_runsheets(rows):
+    """
+    保存済みの区間（next_session_id で連結）から、実行中・一時停止中の区間を含むランシートを組み立てる
+    rows は REHYDRATE_FIELDS の並び（完了済みの区間を含む）
+    {band_id: (区間のセッションID（順序どおり）, ランシート開始時刻, 予定終了時刻)} を返す
+    """
+    by_id = {row[0]: row for row in rows}
+    following = {row[0]: row[9] for row in rows if row[9]}
+    preceding = {next_id: session_id for session_id, next_id in following.items()}
+    runsheets = {}
+    for session_id, status, _, band_id, *_ in rows:
+        if status not in ('running', 'paused') or not band_id:
+            continue
+        if session_id not in following and session_id not in preceding:
+            continue  # 単独のセッション
+        head, seen = session_id, {session_id}
+        while head in preceding and preceding[head] not in seen:
+            head = preceding[head]
+            seen.add(head)
+        session_ids = [head]
+        while session_ids[-1] in following and following[session_ids[-1]] not in session_ids:
+            session_ids.append(following[session_ids[-1]])
+        start_ms = by_id[head][4]
+        tail = by_id.get(session_ids[-1])
+        if band_id not in runsheets or start_ms > runsheets[band_id][1]:
+            runsheets[band_id] = (session_ids, start_ms, tail[5] if tail else start_ms)
+    return runsheets
+
+
+def rehydrate_sessions(chunk_size=None):
+    """
+    保存済みの稼働中・待機中セッションとランシートをRedisへ一括復元し、(対象件数, 新規作成件数) を返す
+    期限切れのセッションは先に失効させる
+    DBは失効の判定・更新と、復元対象（ランシートの完了済み区間を含む）の1クエリ。
+    Redisはノードごとに chunk_size 件ずつスクリプト1回
+    """
+    chunk_size = chunk_size or settings.TIMER_REHYDRATE_CHUNK_SIZE
+    started = time.perf_counter()
+    now = now_ms()
+    expired = expire_stale_sessions(now)
+    # ランシートの区間は完了済みのものも連結をたどるために読む（ランシートの保持期間内のみ）
+    all_rows = list(
+        TimerSession.objects.filter(
+            Q(status__in=LIVE_STATUSES)
+            | (Q(start_ms__gte=now - RUNSHEET_TIMEOUT * 1000) & ~Q(next_session_id=''))
+        ).values_list(*REHYDRATE_FIELDS)
+    )
+    rows = [row for row in all_rows if row[1] in LIVE_STATUSES]
+
+    restored = 0
+    for shard, shard_rows in group_by_shard(rows, lambda row: session_shard(row[0])).items():
+        client = get_redis(shard)
+        for offset in range(0, len(shard_rows), chunk_size):
+            keys = [DEADLINES_KEY, LIVE_SESSIONS_KEY]
+            args = [now, SESSION_TIMEOUT, RUNSHEET_TIMEOUT]
+            for session_id, status, timer_id, band_id, start_ms, end_ms, total_s, paused_ms, v, next_id \
+                    in shard_rows[offset:offset + chunk_size]:
+                keys += [session_key(session_id), deadline_key(session_id), band_index_key(band_id or 0),
+                         timer_index_key(timer_id or 0)]
+                args += [session_id, status, timer_id or 0, band_id or 0, start_ms, end_ms, total_s,
+                         '' if paused_ms is None else paused_ms, v, next_id]
+            restored += REHYDRATE_SCRIPT(client, keys, args)
+
+    runsheets = list(build_runsheets(all_rows).items())
+    restored_runsheets = 0
+    for shard, shard_runsheets in group_by_shard(runsheets, lambda item: band_shard(item[0])).items():
+        client = get_redis(shard)
+        for offset in range(0, len(shard_runsheets), chunk_size):
+            keys, args = [], [now, RUNSHEET_TIMEOUT]
+            for band_id, (session_ids, start_ms, planned_end_ms) in shard_runsheets[offset:offset + chunk_size]:
+                keys.append(runsheet_key(band_id))
+                args += [band_id, ','.join(session_ids), start_ms, planned_end_ms]
+            restored_runsheets += REHYDRATE_RUNSHEET_SCRIPT(client, keys, args)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(
+        f"セッション復元: 対象={len(rows)}, 新規作成={restored}, 失効={expired}, "
+        f"ランシート={len(runsheets)}(新規作成={restored_runsheets}), {elapsed_ms:.0f}ms"
+    )
+    return len(rows), restored
@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import weakref
+from redis.exceptions import NoScriptError
+from django.conf import settings
+from . import redis_pools
+from .sharding import HashRing, band_shard_key
+
+# プロセス内で共有するRedisクライアント（ノードのURLごと。プールは redis_pools の 'session'）
+_sync_clients = {}
+# redis.asyncio のクライアントはイベントループごとに保持する（ループ → {URL: クライアント}）
+_async_clients = weakref.WeakKeyDictionary()
+_ring = None
+
+
+# ---- ノードの振り分け（sharding.py のハッシュリング） ----
+
+def shard_urls():
+    """全ノードのURL（TIMER_REDIS_SHARDS）"""
+    return list(settings.TIMER_REDIS_SHARDS)
+
+
+def _shard_ring():
+    global _ring
+    urls = shard_urls()
+    if _ring is None or _ring.nodes != urls:
+        _ring = HashRing(urls)
+    return _ring
+
+
+def band_shard(band_id):
+    """バンドを担当するノードのURL"""
+    return _shard_ring().node_for(band_shard_key(band_id or 0))
+
+
+def session_band_id(session_id):
+    """session_id（'<band_id>.<uuid>'。session_store.new_session_id）からband_idを取り出す。旧形式ならNone"""
+    prefix, sep, _ = str(session_id).partition('.')
+    if sep and prefix.isdigit():
+        return int(prefix)
+    return None
+
+
+def session_shard(session_id):
+    """セッションを担当するノードのURL（バンドと同じノード。旧形式のIDは先頭ノード）"""
+    band_id = session_band_id(session_id)
+    return band_shard(band_id) if band_id is not None else shard_urls()[0]
+
+
+def group_by_shard(items, shard_of):
+    """{URL: [item, ...]}（各ノード内では元の順序を保つ）"""
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_of(item), []).append(item)
+    return groups
+
+
+# ---- クライアント ----
+
+def get_redis(shard=None):
+    """同期Redisクライアント取得（Celeryタスク・管理コマンド用）。shard省略時は先頭ノード"""
+    shard = shard or shard_urls()[0]
+    client = _sync_clients.get(shard)
+    if client is None:
+        client = _sync_client_factory(shard)
+        _sync_clients[shard] = client
+    return client
+
+
+def get_async_redis(shard=None):
+    """非同期Redisクライアント取得（async view / Consumer用）"""
+    shard = shard or shard_urls()[0]
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = _async_clients[loop] = {}
+    client = clients.get(shard)
+    if client is None:
+        client = clients[shard] = _async_client_factory(shard)
+    return client
+
+
+def _default_sync_client(url):
+    return redis_pools.sync_client(url, 'session', decode_responses=True)
+
+
+def _default_async_client(url):
+    return redis_pools.async_client(url, 'session', decode_responses=True)
+
+
+_sync_client_factory = _default_sync_client
+_async_client_factory = _default_async_client
+
+
+def override_clients(sync_client_factory, async_client_factory):
+    """
+    クライアントを差し替える（ベンチマーク・テスト用）
+    どちらもノードのURLを受け取る。async_client_factory はイベントループごとに呼ばれる
+    """
+    global _sync_client_factory, _async_client_factory
+    _sync_client_factory = sync_client_factory
+    _async_client_factory = async_client_factory
+    _sync_clients.clear()
+    _async_clients.clear()
+
+
+class LuaScript:
+    """
+    同期・非同期どちらのクライアントからも実行できるLuaスクリプト
+    EVALSHAで実行し、未登録（NOSCRIPT）の場合のみ本文を送る
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    def __call__(self, client, keys, args):
+        try:
+            return client.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return client.eval(self.source, len(keys), *keys, *args)
+
+    async def acall(self, client, keys, args):
+        try:
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await client.eval(self.source, len(keys), *keys, *args)
+
+
+def _script_calls(pipe, calls):
+    for script, keys, args in calls:
+        pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+
+def run_scripts(client, calls):
+    """
+    複数のスクリプト呼び出しを1つのパイプラインで実行（往復1回）
+    calls: [(LuaScript, keys, args), ...]
+    """
+    pipe = client.pipeline(transaction=False)
+    _script_calls(pipe, calls)
+    results = pipe.execute(raise_on_error=False)
+
+    # Redis再起動などでスクリプトが未登録の場合は登録して該当分だけ再実行
+    retry = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+    if retry:
+        for script in {calls[i][0] for i in retry}:
+            client.script_load(script.source)
+        pipe = client.pipeline(transaction=False)
+        _script_calls(pipe, [calls[i] for i in retry])
+        for i, result in zip(retry, pipe.execute(raise_on_error=False)):
+            results[i] = result
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+async def arun_scripts(client, calls):
+    pipe = client.pipeline(transaction=False)
+    _script_calls(pipe, calls)
+    results = await pipe.execute(raise_on_error=False)
+
+    retry = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+    if retry:
+        for script in {calls[i][0] for i in retry}:
+            await client.script_load(script.source)
+        pipe = client.pipeline(transaction=False)
+        _script_calls(pipe, [calls[i] for i in retry])
+        for i, result in zip(retry, await pipe.execute(raise_on_error=False)):
+            results[i] = result
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
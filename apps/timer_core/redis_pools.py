@@ -0,0 +1,103 @@
+"""
+用途別のRedisコネクションプール
+
+タイマーセッション・キャッシュ・チャンネルレイヤーは、用途（role）ごとに上限付きのブロッキングプールを使う。
+上限（TIMER_REDIS_POOLS）まで使用中の場合は TIMER_REDIS_POOL_TIMEOUT 秒まで空きを待つ。
+取得待ち時間・使用中の数・枯渇（待ち時間内に取得できなかった）回数をメトリクスに記録する。
+
+Celeryのブローカー・結果バックエンドは kombu / Celery 自身のプールを使うため、
+上限のみ設定で揃える（config/settings/base.py の CELERY_*）。
+"""
+
+from django.conf import settings
+import time
+import redis
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError
+from .metrics import REDIS_POOL_WAIT, REDIS_POOL_IN_USE, REDIS_POOL_EXHAUSTED
+
+DEFAULT_ROLE = 'session'
+
+
+def pool_options(role):
+    """用途の上限・待ち時間（プール生成時の引数）"""
+    return {'max_connections': settings.TIMER_REDIS_POOLS[role], 'timeout': settings.TIMER_REDIS_POOL_TIMEOUT}
+
+
+def _exhausted(pool, start):
+    """取得エラーが上限による待ち時間切れか（接続エラーは待たずに失敗する）"""
+    return pool.timeout is not None and time.perf_counter() - start >= pool.timeout
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """取得待ち時間・使用中の数を記録するブロッキングプール（同期）"""
+
+    def __init__(self, *args, role=DEFAULT_ROLE, **kwargs):
+        self.role = role
+        self._wait = REDIS_POOL_WAIT.labels(role)
+        self._in_use = REDIS_POOL_IN_USE.labels(role)
+        self._held = set()  # 使用中として数えたコネクション（接続失敗時に親クラスが返却する分は数えない）
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            if _exhausted(self, start):
+                REDIS_POOL_EXHAUSTED.labels(self.role).inc()
+            raise
+        finally:
+            self._wait.observe(time.perf_counter() - start)
+        self._held.add(connection)
+        self._in_use.inc()
+        return connection
+
+    def release(self, connection):
+        if connection in self._held:
+            self._held.discard(connection)
+            self._in_use.dec()
+        super().release(connection)
+
+
+class AsyncInstrumentedConnectionPool(aioredis.BlockingConnectionPool):
+    """取得待ち時間・使用中の数を記録するブロッキングプール（redis.asyncio）"""
+
+    def __init__(self, *args, role=DEFAULT_ROLE, **kwargs):
+        self.role = role
+        self._wait = REDIS_POOL_WAIT.labels(role)
+        self._in_use = REDIS_POOL_IN_USE.labels(role)
+        self._held = set()  # 使用中として数えたコネクション（接続失敗時に親クラスが返却する分は数えない）
+        super().__init__(*args, **kwargs)
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            if _exhausted(self, start):
+                REDIS_POOL_EXHAUSTED.labels(self.role).inc()
+            raise
+        finally:
+            self._wait.observe(time.perf_counter() - start)
+        self._held.add(connection)
+        self._in_use.inc()
+        return connection
+
+    async def release(self, connection):
+        if connection in self._held:
+            self._held.discard(connection)
+            self._in_use.dec()
+        await super().release(connection)
+
+
+def sync_client(url, role=DEFAULT_ROLE, **kwargs):
+    """用途のプールを使う同期クライアント"""
+    pool = InstrumentedConnectionPool.from_url(url, role=role, **pool_options(role), **kwargs)
+    return redis.Redis(connection_pool=pool)
+
+
+def async_client(url, role=DEFAULT_ROLE, **kwargs):
+    """用途のプールを使う非同期クライアント（イベントループごとに作る）"""
+    pool = AsyncInstrumentedConnectionPool.from_url(url, role=role, **pool_options(role), **kwargs)
+    return aioredis.Redis(connection_pool=pool)
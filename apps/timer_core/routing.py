@@ -2,5 +2,6 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/timer/(?P<band_id>\w+)/$', consumers.TimerConsumer.as_asgi()),
+    re_path(r'ws/timer/(?P<band_id>\d+)/$', consumers.TimerConsumer.as_asgi()),
+    re_path(r'ws/timer/$', consumers.TimerConsumer.as_asgi()),  # 複数バンドの購読（subscribe / unsubscribe）
 ]
\ No newline at end of file
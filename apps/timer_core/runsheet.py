@@ -0,0 +1,212 @@
+"""
+リハーサルのランシート（バンドのタイマーを順序どおりに自動で進める）
+
+開始時にバンドの有効なタイマーを order 順に並べ、全区間のセッションを一括作成する。
+先頭区間のみ実行中とし、後続は scheduled として next で連結する。
+区間の終了はスケジューラが検知し、完了スクリプト内で次区間を
+「前区間の終了時刻ちょうど」を開始時刻として起動する（HTTP往復による遅れなし）。
+スケジューラへの登録は常に実行中の1区間のみ。
+一時停止・再開・スキップは実行中区間に対して行い、後続区間は自動的にずれる。
+ランシートと全区間のセッションはバンドの担当ノードに置く（区間の連結が1ノードのスクリプトで完結する）。
+"""
+
+from .models import Timer
+from .redis_client import get_async_redis, band_shard, LuaScript
+from .session_store import (
+    DEADLINES_KEY, EVENTS_KEY, LIVE_SESSIONS_KEY, SESSION_TIMEOUT, TransitionError, band_index_key,
+    deadline_key, timer_index_key, session_key, now_ms,
+    new_session_id, to_session_data, aload_session, apause_session, aresume_session, acomplete_session,
+)
+from .broadcast import abroadcast_session
+
+RUNSHEET_KEY = 'timer_runsheet:{}'
+RUNSHEET_TIMEOUT = 86400  # 待機中の区間・ランシート本体の保持期間（24時間）
+
+
+def runsheet_key(band_id):
+    """バンドのランシートのRedisキー"""
+    return RUNSHEET_KEY.format(band_id)
+
+
+# 全区間のセッションを一括作成（実行中のランシートがあれば作成しない）
+# 既存ランシートの区間のキーは呼び出し側が読んで渡す。読んだ後にランシートが変わっていれば 'retry'
+# KEYS: ランシート, 終了時刻インデックス, バンド別インデックス, 全体インデックス, イベント,
+#       先頭区間の終了通知キー, 先頭区間のタイマー別インデックス, 各区間のセッション * N, 既存区間のセッション * M
+# ARGV: band_id, now_ms, session_timeout_s, runsheet_timeout_s, 既存区間（カンマ区切り）,
+#       (session_id, timer_id, total_s) * N
+START_RUNSHEET_SCRIPT = LuaScript("""
+local n = (#ARGV - 5) / 3
+if (redis.call('HGET', KEYS[1], 'sessions') or '') ~= ARGV[5] then return 'retry' end
+for i = 8 + n, #KEYS do
+    local st = redis.call('HGET', KEYS[i], 'status')
+    if st == 'running' or st == 'paused' then return 'already_running' end
+end
+local band = ARGV[1]
+local now = tonumber(ARGV[2])
+local ids = {}
+local t = now
+for i = 0, n - 1 do
+    local sid = ARGV[6 + i * 3]
+    local key = KEYS[8 + i]
+    local total = tonumber(ARGV[8 + i * 3])
+    local end_ms = t + total * 1000
+    redis.call('DEL', key)
+    redis.call('HSET', key, 'status', i == 0 and 'running' or 'scheduled', 'timer_id', ARGV[7 + i * 3],
+        'band_id', band, 'start_ms', t, 'end_ms', end_ms, 'total_s', total, 'v', 1)
+    if i < n - 1 then
+        redis.call('HSET', key, 'next', ARGV[9 + i * 3])
+    end
+    if i == 0 then
+        redis.call('PEXPIRE', key, total * 1000 + ARGV[3] * 1000)
+        redis.call('ZADD', KEYS[2], end_ms, sid)
+        redis.call('SET', KEYS[6], 1, 'PX', math.max(total * 1000, 1))
+        redis.call('SADD', KEYS[3], sid)
+        redis.call('SADD', KEYS[7], sid)
+        redis.call('SADD', KEYS[4], sid)
+    else
+        redis.call('EXPIRE', key, ARGV[4])
+    end
+    redis.call('RPUSH', KEYS[5], sid .. (i == 0 and '|started|' or '|scheduled|') .. now .. '|1')
+    ids[#ids + 1] = sid
+    t = end_ms
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'sessions', table.concat(ids, ','), 'start_ms', now, 'planned_end_ms', t)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 'OK'
+""")
+
+
+def build_timeline(band_id, session_ids, raws, now=None):
+    """
+    各区間の状態から時間割を組み立てる
+    待機中区間の開始・終了は、直前区間の（見込み）終了時刻から順に算出する
+    """
+    now = now or now_ms()
+    segments = []
+    current_index = None
+    cursor = None
+    for index, (session_id, raw) in enumerate(zip(session_ids, raws)):
+        session_data = to_session_data(raw, now) or {'status': 'expired'}
+        session_data['session_id'] = session_id
+        status = session_data['status']
+
+        if status == 'running':
+            cursor = session_data['end_ms']
+        elif status == 'paused':
+            cursor = now + session_data['remaining_seconds'] * 1000
+        elif status == 'scheduled' and cursor is not None:
+            session_data['start_ms'] = cursor
+            session_data['end_ms'] = cursor + session_data['total_seconds'] * 1000
+            cursor = session_data['end_ms']
+        elif status == 'completed':
+            cursor = session_data['done_ms']
+
+        if current_index is None and status in ('running', 'paused'):
+            current_index = index
+        segments.append(session_data)
+
+    if current_index is not None:
+        status = segments[current_index]['status']
+    elif segments and all(s['status'] == 'completed' for s in segments):
+        status = 'completed'
+    else:
+        status = 'stopped'
+
+    return {
+        'band_id': band_id,
+        'status': status,
+        'current_index': current_index,
+        'total': len(segments),
+        'planned_end_ms': cursor,
+        'segments': segments,
+    }
+
+
+async def aget_runsheet(band_id):
+    """ランシートの現在の時間割を取得。なければNone"""
+    client = get_async_redis(band_shard(band_id))
+    sessions = await client.hget(runsheet_key(band_id), 'sessions')
+    if not sessions:
+        return None
+    session_ids = sessions.split(',')
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(session_key(session_id))
+    return build_timeline(band_id, session_ids, await pipe.execute())
+
+
+async def arunsheet_timers(band_id):
+    """ランシートの区間となるタイマー（有効なもの、order順）"""
+    timers = [
+        timer async for timer in Timer.objects.filter(band_id=band_id, is_active=True)
+        .only('id', 'duration_minutes').order_by('order')
+    ]
+    if not timers:
+        raise TransitionError('有効なタイマーがありません')
+    return timers
+
+
+async def astart_runsheet(band_id):
+    """バンドの有効なタイマーをorder順に一括で開始"""
+    timers = await arunsheet_timers(band_id)
+
+    session_ids = [new_session_id(band_id) for _ in timers]
+    client = get_async_redis(band_shard(band_id))
+    keys = [runsheet_key(band_id), DEADLINES_KEY, band_index_key(band_id), LIVE_SESSIONS_KEY, EVENTS_KEY,
+            deadline_key(session_ids[0]), timer_index_key(timers[0].id)]
+    keys += [session_key(session_id) for session_id in session_ids]
+    result = 'retry'
+    while result == 'retry':
+        current = await client.hget(runsheet_key(band_id), 'sessions') or ''
+        args = [band_id, now_ms(), SESSION_TIMEOUT, RUNSHEET_TIMEOUT, current]
+        for session_id, timer in zip(session_ids, timers):
+            args += [session_id, timer.id, timer.duration_minutes * 60]
+        current_keys = [session_key(session_id) for session_id in current.split(',') if session_id]
+        result = await START_RUNSHEET_SCRIPT.acall(client, keys + current_keys, args)
+    if result == 'already_running':
+        raise TransitionError('ランシートは実行中です')
+
+    runsheet = await aget_runsheet(band_id)
+    first = runsheet['segments'][0]
+    await abroadcast_session(first['session_id'], first, 'started')
+    return runsheet
+
+
+async def _current_session_id(band_id):
+    runsheet = await aget_runsheet(band_id)
+    if runsheet is None or runsheet['current_index'] is None:
+        raise TransitionError('実行中のランシートがありません')
+    return runsheet['segments'][runsheet['current_index']]['session_id']
+
+
+async def apause_runsheet(band_id):
+    """ランシート全体を一時停止（実行中区間を停止すれば後続も止まる）"""
+    session_id = await _current_session_id(band_id)
+    session_data = await apause_session(session_id)
+    await abroadcast_session(session_id, session_data, 'paused')
+    return await aget_runsheet(band_id)
+
+
+async def aresume_runsheet(band_id):
+    """ランシート全体を再開"""
+    session_id = await _current_session_id(band_id)
+    session_data = await aresume_session(session_id)
+    await abroadcast_session(session_id, session_data, 'resumed')
+    return await aget_runsheet(band_id)
+
+
+async def askip_runsheet(band_id):
+    """実行中区間を即時完了し、次区間を今から開始"""
+    session_id = await _current_session_id(band_id)
+    session_data = await acomplete_session(session_id, force=True)
+    if session_data is None:
+        raise TransitionError('タイマーが実行中ではありません')
+    await abroadcast_session(session_id, session_data, 'completed')
+
+    next_session_id = session_data.get('next_session_id')
+    if next_session_id:
+        next_data = await aload_session(next_session_id)
+        if next_data and next_data['status'] == 'running':
+            await abroadcast_session(next_session_id, next_data, 'started')
+    return await aget_runsheet(band_id)
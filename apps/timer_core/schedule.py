@@ -0,0 +1,198 @@
+"""
+バンドのタイマー構成（順序・有効/無効）の一括変更と、構成API（/api/schedule/）の取得処理
+
+並び替えは管理画面のアクションと並び替えAPIの共通処理。
+バンドの全タイマーを新しい順序で受け取り、変更のある行だけを1回の bulk_update で更新する
+（行ごとの save() をしないため post_save は発火しない）。
+メタデータキャッシュの無効化と、バンドのWebSocketグループへの構成変更通知はバンドごとに1回、コミット後に行う。
+
+バンドの構成バージョン（Band.schedule_version）は Band/Timer の保存・削除（シグナル）と
+並び替えで増やす。構成APIはページ内のバンドのバージョンからETagを作り、
+一致すればタイマーを読まずに304を返す。
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+import base64
+import hashlib
+import json
+import logging
+from .models import Band, Timer
+from .broadcast import broadcast_schedule
+from . import metadata_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleError(Exception):
+    """並び替えの指定がバンドのタイマー構成と合わない"""
+
+
+def schedule_payload(timer):
+    """クライアントへ送るタイマー構成（1件）"""
+    return {
+        'id': timer.id,
+        'name': timer.name,
+        'duration_minutes': timer.duration_minutes,
+        'order': timer.order,
+        'is_active': timer.is_active,
+    }
+
+
+def bump_versions(band_ids):
+    """バンドの構成バージョンを1つ進める"""
+    Band.objects.filter(id__in=band_ids).update(schedule_version=F('schedule_version') + 1)
+
+
+def _parse_ids(values, label):
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        raise ScheduleError(f'{label}が不正です')
+
+
+def reorder_timers(band_id, timer_ids, active=None):
+    """
+    バンドのタイマーを timer_ids の順に 1 から振り直す
+    timer_ids はバンドの全タイマーを過不足なく含むこと。active（{timer_id: bool}）で有効/無効も同時に変更できる
+    更新後のタイマー構成（order順）を返す
+    """
+    timer_ids = _parse_ids(timer_ids, 'タイマーID')
+    active = active or {}
+    if not isinstance(active, dict):
+        raise ScheduleError('is_activeが不正です')
+    active = dict(zip(_parse_ids(active.keys(), 'タイマーID'), map(bool, active.values())))
+    if len(set(timer_ids)) != len(timer_ids):
+        raise ScheduleError('タイマーIDが重複しています')
+
+    with transaction.atomic():
+        timers = {timer.id: timer for timer in Timer.objects.select_for_update().filter(band_id=band_id)}
+        if set(timer_ids) != set(timers):
+            raise ScheduleError('バンドの全タイマーを指定してください')
+        unknown = set(active) - set(timers)
+        if unknown:
+            raise ScheduleError(f'バンドに存在しないタイマーです: {sorted(unknown)}')
+
+        changed = []
+        for order, timer_id in enumerate(timer_ids, start=1):
+            timer = timers[timer_id]
+            is_active = active.get(timer_id, timer.is_active)
+            if (timer.order, timer.is_active) != (order, is_active):
+                timer.order, timer.is_active = order, is_active
+                changed.append(timer)
+        if changed:
+            Timer.objects.bulk_update(changed, ['order', 'is_active'])
+
+        schedule = [schedule_payload(timers[timer_id]) for timer_id in timer_ids]
+        if changed:
+            bump_versions([band_id])
+            version = Band.objects.filter(id=band_id).values_list('schedule_version', flat=True).first()
+            metadata_cache.invalidate('band_timers', band_id)
+            transaction.on_commit(lambda: broadcast_schedule(band_id, schedule, version))
+
+    logger.info(f"タイマー並び替え: band_id={band_id}, 更新={len(changed)}/{len(timer_ids)}")
+    return schedule
+
+
+# ---- 構成API ----
+
+# 選択できるタイマーの項目（fields 指定なしは全項目。id は常に含める）
+SCHEDULE_FIELDS = ('id', 'name', 'duration_minutes', 'order', 'manager1', 'manager2', 'manager3')
+
+
+def encode_cursor(band):
+    """ページ末尾のバンド（名前, id）から次ページのカーソル"""
+    raw = json.dumps([band['name'], band['id']], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        name, band_id = json.loads(raw)
+        return str(name), int(band_id)
+    except (ValueError, TypeError):
+        raise ScheduleError('カーソルが不正です')
+
+
+def schedule_params(query):
+    """クエリ文字列（bands / fields / limit / cursor）を検証して aschedule_page の引数にする"""
+    fields = [f for f in query.get('fields', '').split(',') if f] or list(SCHEDULE_FIELDS)
+    unknown = set(fields) - set(SCHEDULE_FIELDS)
+    if unknown:
+        raise ScheduleError(f'不明な項目です: {", ".join(sorted(unknown))}')
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    try:
+        limit = int(query.get('limit', settings.TIMER_SCHEDULE_PAGE_SIZE))
+    except ValueError:
+        raise ScheduleError('limitが不正です')
+    if not 1 <= limit <= settings.TIMER_SCHEDULE_PAGE_MAX:
+        raise ScheduleError(f'limitは1〜{settings.TIMER_SCHEDULE_PAGE_MAX}で指定してください')
+    band_ids = _parse_ids([b for b in query.get('bands', '').split(',') if b], 'バンドID') or None
+    cursor = decode_cursor(query['cursor']) if query.get('cursor') else None
+    return {'fields': fields, 'limit': limit, 'band_ids': band_ids, 'cursor': cursor}
+
+
+async def aschedule_page(fields, limit, band_ids=None, cursor=None):
+    """
+    バンドの1ページ（バンド名・id順のキーセットページング）
+    (バンドの一覧, 次ページのカーソル) を返す。タイマーはまだ読まない
+    """
+    bands = Band.objects.order_by('name', 'id').values('id', 'name', 'schedule_version')
+    if band_ids is not None:
+        bands = bands.filter(id__in=band_ids)
+    if cursor is not None:
+        name, band_id = cursor
+        bands = bands.filter(Q(name__gt=name) | Q(name=name, id__gt=band_id))
+    page = [band async for band in bands[:limit + 1]]
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def schedule_etag(bands, fields, next_cursor):
+    """
+    ページの強いETag
+    本文はバンドの構成バージョン・選択項目・次ページの有無だけで決まる（同じETagなら同じ本文）
+    """
+    key = json.dumps([fields, [(band['id'], band['schedule_version']) for band in bands], next_cursor])
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+async def aschedule_bands(bands, fields):
+    """ページのバンドに有効なタイマー（order順、選択項目のみ）を付ける"""
+    timers = {band['id']: [] for band in bands}
+    rows = (
+        Timer.objects.filter(band_id__in=list(timers), is_active=True)
+        .order_by('band_id', 'order', 'id').values('band_id', *fields)
+    )
+    async for row in rows:
+        band_id = row['band_id'] if 'band_id' in fields else row.pop('band_id')
+        timers[band_id].append(row)
+    return [
+        {'id': band['id'], 'name': band['name'], 'version': band['schedule_version'], 'timers': timers[band['id']]}
+        for band in bands
+    ]
+
+
+# ---- 構成バージョンの更新 ----
+
+@receiver(post_init, sender=Timer)
+def _remember_band(sender, instance, **kwargs):
+    # 別のバンドへ移したときに移動元のバージョンも進めるため
+    # （only() で band_id を読まなかった場合に追加のクエリを発行しないよう __dict__ から取る）
+    instance._schedule_band_id = instance.__dict__.get('band_id')
+
+
+@receiver(post_save, sender=Band)
+def _on_band_saved(sender, instance, **kwargs):
+    bump_versions([instance.id])
+
+
+@receiver([post_save, post_delete], sender=Timer)
+def _on_timer_changed(sender, instance, **kwargs):
+    bump_versions({instance.band_id, getattr(instance, '_schedule_band_id', None)} - {None})
+    instance._schedule_band_id = instance.band_id
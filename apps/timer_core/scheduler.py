@@ -0,0 +1,190 @@
+"""
+タイマー終了時刻の集中スケジューラ
+
+実行中セッションの終了時刻は Redis のソート済みセット（DEADLINES_KEY）に
+まとめて保持し、1つのループが期限切れのものをバッチで取り出して完了させる。
+セッション数に比例したCeleryメッセージは発生しない。
+セッションイベントのDB保存（persistence.py）と、稼働中インデックスの失効メンバーの除去もこのループで定期的に行う。
+Redisノードが複数の場合は、ノードごとの終了時刻インデックスを順に処理する。
+"""
+
+from django.conf import settings
+import logging
+import time
+from .redis_client import get_redis, shard_urls, LuaScript
+from .session_store import (
+    DEADLINES_KEY, session_key, now_ms, to_session_data, load_session, load_sessions, complete_session,
+    complete_sessions, prune_live_sessions,
+)
+from .broadcast import broadcast_session
+from .metrics import COMPLETION_LAG
+from .persistence import flush_session_events, rehydrate_sessions
+
+logger = logging.getLogger(__name__)
+
+# 期限切れのメンバーを取り出し、スコアを now + リース期間に進める（複数スケジューラが動いても二重処理しない）
+# メンバーを削除するのは完了スクリプト。完了させる前にプロセスやRedisへの接続が落ちても、
+# リース期間が過ぎれば再び取り出される
+# ARGV: now_ms, limit, lease_ms
+POP_DUE_SCRIPT = LuaScript("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+local lease_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], 'XX', lease_until, due[i])
+end
+return due
+""")
+
+
+def pop_due(limit, now=None, shard=None):
+    """
+    ノードの期限切れセッションを最大limit件取り出す（リース付き）。[(session_id, end_ms), ...]
+    取り出したものは complete_sessions で完了させる（完了しなければ TIMER_SCHEDULER_LEASE 秒後に再び取り出される）
+    """
+    now = now if now is not None else now_ms()
+    lease_ms = int(settings.TIMER_SCHEDULER_LEASE * 1000)
+    due = POP_DUE_SCRIPT(get_redis(shard), [DEADLINES_KEY], [now, limit, lease_ms])
+    return [(due[i], int(float(due[i + 1]))) for i in range(0, len(due), 2)]
+
+
+def next_deadline():
+    """全ノードで最も早い終了時刻（epochミリ秒）。なければNone"""
+    deadlines = []
+    for shard in shard_urls():
+        head = get_redis(shard).zrange(DEADLINES_KEY, 0, 0, withscores=True)
+        if head:
+            deadlines.append(int(head[0][1]))
+    return min(deadlines, default=None)
+
+
+def announce_completion(session_id, session_data, next_data=None):
+    """
+    完了を配信。ランシートの次区間（完了スクリプト内で起動済み）があれば開始も配信
+    next_data（読み込み済みの次区間）を省略した場合はここで読み込む
+    """
+    broadcast_session(session_id, session_data, 'completed')
+
+    next_session_id = session_data.get('next_session_id')
+    if next_session_id:
+        next_data = next_data or load_session(next_session_id)
+        if next_data and next_data['status'] == 'running':
+            broadcast_session(next_session_id, next_data, 'started')
+
+
+def process_due(limit=None):
+    """
+    期限切れセッションをノードごとにまとめて完了させる。処理件数を返す
+    完了・次区間の読み込みはそれぞれノードごとに1つのパイプラインで行う
+    """
+    limit = limit or settings.TIMER_SCHEDULER_BATCH_SIZE
+    processed = 0
+    for shard in shard_urls():
+        due = pop_due(limit, shard=shard)
+        # 完了スクリプトがインデックスから取り除く（取り出した直後に一時停止された等、実行中でないものも取り除く）
+        completed = complete_sessions([session_id for session_id, _ in due], shard)
+        next_sessions = load_sessions(
+            [data['next_session_id'] for _, data in completed if data.get('next_session_id')], shard
+        )
+        for session_id, session_data in completed:
+            _observe_completion(session_id, session_data)
+            announce_completion(session_id, session_data, next_sessions.get(session_data.get('next_session_id')))
+        processed += len(due)
+    return processed
+
+
+def _observe_completion(session_id, session_data):
+    lag_ms = now_ms() - session_data['end_ms']
+    COMPLETION_LAG.observe(max(0, lag_ms) / 1000)
+    logger.info(f"タイマー完了: session_id={session_id}, lag={lag_ms}ms")
+
+
+def complete_due(session_id):
+    """終了時刻を過ぎたセッションを完了にして配信。完了にできなければNone"""
+    session_data = complete_session(session_id)
+    if session_data is None:
+        return None
+    _observe_completion(session_id, session_data)
+    announce_completion(session_id, session_data)
+    return session_data
+
+
+def flush_events():
+    """溜まったセッションイベントをまとめてDBへ保存（write-behind）"""
+    try:
+        while flush_session_events() >= settings.TIMER_EVENT_FLUSH_BATCH_SIZE:
+            pass
+    except Exception:
+        pass  # ログ出力済み。次回再試行
+
+
+def prune_indexes():
+    """TTLで失効したメンバーを全ノードの全体・バンド別インデックスから取り除く"""
+    try:
+        for shard in shard_urls():
+            prune_live_sessions(shard)
+    except Exception as e:
+        logger.error(f"インデックス整理エラー: {e}")
+
+
+def rehydrate():
+    """Redis・スケジューラ再起動に備え、保存済みの稼働中セッションを復元（停止中に期限切れのものは直後に完了）"""
+    try:
+        rehydrate_sessions()
+    except Exception as e:
+        logger.error(f"セッション復元エラー: {e}")
+
+
+def broadcast_ticks():
+    """実行中セッションの残り時間をまとめて配信（TIMER_PUSH_TICKS 有効時）"""
+    for shard in shard_urls():
+        client = get_redis(shard)
+        session_ids = client.zrange(DEADLINES_KEY, 0, -1)
+        if not session_ids:
+            continue
+        pipe = client.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.hgetall(session_key(session_id))
+        for session_id, raw in zip(session_ids, pipe.execute()):
+            session_data = to_session_data(raw)
+            if session_data:
+                broadcast_session(session_id, session_data, 'tick')
+
+
+def run_scheduler(stop=lambda: False):
+    """
+    スケジューラのメインループ
+    次の終了時刻まで（最大 TIMER_SCHEDULER_INTERVAL 秒）待機し、期限切れを処理する
+    """
+    interval = settings.TIMER_SCHEDULER_INTERVAL
+    tick_seconds = settings.TIMER_TICK_SECONDS
+    next_tick = time.monotonic() + tick_seconds
+    flush_interval = settings.TIMER_EVENT_FLUSH_INTERVAL
+    next_flush = time.monotonic() + flush_interval
+    prune_interval = settings.TIMER_INDEX_PRUNE_INTERVAL
+    next_prune = time.monotonic() + prune_interval
+
+    logger.info(f"タイマースケジューラ開始: interval={interval}s")
+    rehydrate()
+
+    while not stop():
+        # バッチが満杯なら続けて処理
+        while process_due() >= settings.TIMER_SCHEDULER_BATCH_SIZE:
+            pass
+
+        if settings.TIMER_PUSH_TICKS and time.monotonic() >= next_tick:
+            broadcast_ticks()
+            next_tick = time.monotonic() + tick_seconds
+
+        if time.monotonic() >= next_flush:
+            flush_events()
+            next_flush = time.monotonic() + flush_interval
+
+        if time.monotonic() >= next_prune:
+            prune_indexes()
+            next_prune = time.monotonic() + prune_interval
+
+        wait = interval
+        deadline = next_deadline()
+        if deadline is not None:
+            wait = min(interval, max(0, (deadline - now_ms()) / 1000))
+        time.sleep(wait)
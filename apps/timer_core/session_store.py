@@ -0,0 +1,710 @@
+"""
+タイマーセッションの保存と状態遷移
+
+セッションは Redis ハッシュ（timer_session:{id}）に整数（epochミリ秒）で保持する。
+開始・一時停止・再開・完了はLuaスクリプトでサーバー側で原子的に適用し、
+終了時刻インデックス（DEADLINES_KEY）と、バンド別・タイマー別の
+稼働中セッションインデックス（Redisセット）も同じスクリプト内で更新する。
+
+  status    running / paused / completed / scheduled（ランシートの後続区間）
+  timer_id  タイマーID
+  band_id   バンドID
+  start_ms  開始時刻
+  end_ms    終了時刻（一時停止中は停止時点の値のまま）
+  total_s   合計秒数
+  paused_ms 一時停止した時刻（一時停止中のみ）
+  done_ms   完了した時刻（完了後のみ）
+  v         状態のバージョン（遷移ごとに+1）
+  next      ランシートの次区間のsession_id（runsheet.py）
+
+各スクリプトは遷移と同時にイベント（session_id|event|時刻|v）を EVENTS_KEY に積む。
+Postgresへの保存は persistence.py がまとめて行う（リクエスト処理中にDB書き込みはしない）。
+
+Redisノードが複数（TIMER_REDIS_SHARDS）の場合、セッションは band_id で振り分けたノードに置く。
+session_id の先頭に band_id が入っているため（new_session_id）、IDだけで担当ノードが決まる。
+終了時刻・イベント・全体インデックスはノードごとにあり、スケジューラは全ノードを順に処理する。
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from .redis_client import (
+    get_redis, get_async_redis, LuaScript, run_scripts, arun_scripts,
+    band_shard, session_band_id, session_shard, shard_urls, group_by_shard,
+)
+from .metrics import record_lookup
+
+logger = logging.getLogger(__name__)
+
+SESSION_TIMEOUT = 3600  # 終了（停止）後も1時間保持（十分なリハーサル時間）
+
+# 実行中セッションの終了時刻インデックス（score=終了時刻のepochミリ秒, member=session_id）
+DEADLINES_KEY = 'timer_deadlines'
+
+# 稼働中（実行中・一時停止中）セッションのインデックス
+BAND_INDEX_KEY = 'timer_band_sessions:{}'
+TIMER_INDEX_KEY = 'timer_timer_sessions:{}'
+LIVE_SESSIONS_KEY = 'timer_live_sessions'  # 全バンド分
+# インデックスから外すのは完了スクリプトのみ。TTLで失効したメンバーは参照時（_prune_index）と
+# スケジューラの定期処理（prune_live_sessions）で取り除く
+LIVE_STATUSES = ('running', 'paused')
+
+# 実行中セッションの終了通知用キー（TTL=残り時間。TIMER_COMPLETION_MODE='keyspace' で expiry.py が購読）
+DEADLINE_KEY = 'timer_deadline:{}'
+
+# 未保存のセッションイベント（Redisリスト。persistence.py が取り出してDBへ一括保存）
+EVENTS_KEY = 'timer_session_events'
+
+INT_FIELDS = ('timer_id', 'band_id', 'start_ms', 'end_ms', 'total_s', 'paused_ms', 'done_ms', 'v')
+
+
+class TransitionError(Exception):
+    """状態遷移できない場合のエラー（メッセージはそのままAPIで返す）"""
+
+
+# スクリプトが返すエラーコード → APIメッセージ
+TRANSITION_ERRORS = {
+    'not_found': 'セッションが見つかりません',
+    'not_running': 'タイマーが実行中ではありません',
+    'not_paused': 'タイマーが一時停止中ではありません',
+}
+
+NOT_FOUND = {'status': 'not_found', 'message': 'セッションが見つかりません'}
+
+
+def session_key(session_id):
+    """セッションのRedisキー"""
+    return f"timer_session:{session_id}"
+
+
+def new_session_id(band_id=None):
+    """セッションID生成（先頭にband_idを付け、IDだけで担当のRedisノードが決まるようにする）"""
+    return f'{band_id or 0}.{uuid.uuid4().hex}'
+
+
+def now_ms():
+    """現在時刻（epochミリ秒）"""
+    return int(time.time() * 1000)
+
+
+def band_index_key(band_id):
+    """バンド別の稼働中セッションインデックス"""
+    return BAND_INDEX_KEY.format(band_id)
+
+
+def timer_index_key(timer_id):
+    """タイマー別の稼働中セッションインデックス"""
+    return TIMER_INDEX_KEY.format(timer_id)
+
+
+def deadline_key(session_id):
+    """実行中セッションの終了通知用キー"""
+    return DEADLINE_KEY.format(session_id)
+
+
+# ---- Luaスクリプト（KEYS[1]=セッション, KEYS[2]=終了時刻インデックス） ----
+# スクリプトが触るキーはすべて KEYS で渡す（スクリプト内でキー名を組み立てない）
+
+# ARGV: session_id, now_ms, timer_id, band_id, total_s, timeout_s
+# KEYS[3]=バンド別インデックス, KEYS[4]=タイマー別インデックス, KEYS[5]=全体インデックス,
+# KEYS[6]=終了通知キー, KEYS[7]=イベント
+START_SCRIPT = LuaScript("""
+local now = tonumber(ARGV[2])
+local total = tonumber(ARGV[5])
+local end_ms = now + total * 1000
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'status', 'running', 'timer_id', ARGV[3], 'band_id', ARGV[4],
+    'start_ms', now, 'end_ms', end_ms, 'total_s', total, 'v', 1)
+redis.call('PEXPIRE', KEYS[1], total * 1000 + ARGV[6] * 1000)
+redis.call('ZADD', KEYS[2], end_ms, ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[1])
+redis.call('SET', KEYS[6], 1, 'PX', math.max(total * 1000, 1))
+redis.call('RPUSH', KEYS[7], ARGV[1] .. '|started|' .. now .. '|1')
+return redis.call('HGETALL', KEYS[1])
+""")
+
+# ARGV: session_id, now_ms, timeout_s
+# KEYS[3]=終了通知キー, KEYS[4]=イベント
+PAUSE_SCRIPT = LuaScript("""
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then return 'not_found' end
+if status ~= 'running' then return 'not_running' end
+local now = tonumber(ARGV[2])
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'end_ms')) - now
+if remaining < 0 then remaining = 0 end
+redis.call('HSET', KEYS[1], 'status', 'paused', 'paused_ms', now)
+local v = redis.call('HINCRBY', KEYS[1], 'v', 1)
+redis.call('PEXPIRE', KEYS[1], remaining + ARGV[3] * 1000)
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+redis.call('RPUSH', KEYS[4], ARGV[1] .. '|paused|' .. now .. '|' .. v)
+return redis.call('HGETALL', KEYS[1])
+""")
+
+# ARGV: session_id, now_ms, timeout_s
+# KEYS[3]=終了通知キー, KEYS[4]=イベント
+RESUME_SCRIPT = LuaScript("""
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then return 'not_found' end
+if status ~= 'paused' then return 'not_paused' end
+local now = tonumber(ARGV[2])
+local fields = redis.call('HMGET', KEYS[1], 'end_ms', 'paused_ms')
+local end_ms = tonumber(fields[1]) + (now - tonumber(fields[2]))
+redis.call('HSET', KEYS[1], 'status', 'running', 'end_ms', end_ms)
+redis.call('HDEL', KEYS[1], 'paused_ms')
+local v = redis.call('HINCRBY', KEYS[1], 'v', 1)
+redis.call('PEXPIRE', KEYS[1], end_ms - now + ARGV[3] * 1000)
+redis.call('ZADD', KEYS[2], end_ms, ARGV[1])
+redis.call('SET', KEYS[3], 1, 'PX', math.max(end_ms - now, 1))
+redis.call('RPUSH', KEYS[4], ARGV[1] .. '|resumed|' .. now .. '|' .. v)
+return redis.call('HGETALL', KEYS[1])
+""")
+
+# 実行中かつ終了時刻を過ぎている場合のみ完了にする（ARGV[4]='1' ならスキップとして即時完了）
+# 完了・完了できないことの確認をもって終了時刻インデックスから取り除く（scheduler.py のリースの確認応答）
+# 次区間（next）があれば、この区間の終了時刻ちょうどを開始時刻として起動する
+# バンド・タイマーのインデックスと次区間のキーは、呼び出し側がハッシュから読んで渡す（_complete_calls）。
+# 読んだ後にハッシュが作り直されていれば何もしない（スケジューラのリースが切れた後に再び取り出される）
+# ARGV: session_id, now_ms, timeout_s, force, band_id, timer_id, next, next_timer_id
+# KEYS[3]=終了通知キー, KEYS[4]=イベント, KEYS[5]=バンド別インデックス, KEYS[6]=タイマー別インデックス,
+# KEYS[7]=全体インデックス, 次区間があれば KEYS[8]=次区間のセッション, KEYS[9]=次区間の終了通知キー,
+# KEYS[10]=次区間のタイマー別インデックス
+COMPLETE_SCRIPT = LuaScript("""
+local fields = redis.call('HMGET', KEYS[1], 'status', 'end_ms', 'band_id', 'timer_id', 'next')
+local now = tonumber(ARGV[2])
+local boundary
+if ARGV[4] == '1' then
+    if fields[1] ~= 'running' and fields[1] ~= 'paused' then return false end
+    boundary = now
+else
+    if fields[1] ~= 'running' then
+        -- 実行中でない（一時停止・完了済み・失効）ものが終了時刻インデックスに残っていれば取り除く
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        return false
+    end
+    boundary = tonumber(fields[2])
+    if boundary > now then
+        -- スケジューラが取り出した（リースでスコアを進めた）場合は本来の終了時刻に戻す
+        redis.call('ZADD', KEYS[2], 'XX', boundary, ARGV[1])
+        return false
+    end
+end
+if fields[3] ~= ARGV[5] or fields[4] ~= ARGV[6] or (fields[5] or '') ~= ARGV[7] then return false end
+local nf
+if fields[5] then
+    nf = redis.call('HMGET', KEYS[8], 'status', 'total_s', 'timer_id')
+    if nf[1] == 'scheduled' and nf[3] ~= ARGV[8] then return false end
+end
+redis.call('HSET', KEYS[1], 'status', 'completed', 'done_ms', now)
+redis.call('HDEL', KEYS[1], 'paused_ms')
+local v = redis.call('HINCRBY', KEYS[1], 'v', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('RPUSH', KEYS[4], ARGV[1] .. '|' .. (ARGV[4] == '1' and 'skipped' or 'completed') .. '|' .. now .. '|' .. v)
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+redis.call('SREM', KEYS[5], ARGV[1])
+redis.call('SREM', KEYS[6], ARGV[1])
+redis.call('SREM', KEYS[7], ARGV[1])
+if nf and nf[1] == 'scheduled' then
+    local end_ms = boundary + tonumber(nf[2]) * 1000
+    redis.call('HSET', KEYS[8], 'status', 'running', 'start_ms', boundary, 'end_ms', end_ms)
+    local nv = redis.call('HINCRBY', KEYS[8], 'v', 1)
+    redis.call('PEXPIRE', KEYS[8], end_ms - now + ARGV[3] * 1000)
+    redis.call('RPUSH', KEYS[4], fields[5] .. '|started|' .. boundary .. '|' .. nv)
+    redis.call('ZADD', KEYS[2], end_ms, fields[5])
+    redis.call('SET', KEYS[9], 1, 'PX', math.max(end_ms - now, 1))
+    redis.call('SADD', KEYS[5], fields[5])
+    redis.call('SADD', KEYS[10], fields[5])
+    redis.call('SADD', KEYS[7], fields[5])
+end
+return redis.call('HGETALL', KEYS[1])
+""")
+
+
+# ---- 変換（I/Oなし。同期・非同期の両方から使う） ----
+
+def to_session_data(raw, now=None):
+    """
+    ハッシュ（HGETALLの結果）をAPI用の辞書に変換
+    残り秒数はここで整数演算のみで計算する
+    """
+    if not raw:
+        return None
+    if isinstance(raw, list):
+        raw = dict(zip(raw[::2], raw[1::2]))
+
+    session_data = {'status': raw['status']}
+    for field in INT_FIELDS:
+        if field in raw:
+            session_data[field] = int(raw[field])
+    session_data['total_seconds'] = session_data.pop('total_s')
+    session_data['version'] = session_data.pop('v')
+    if 'next' in raw:
+        session_data['next_session_id'] = raw['next']
+
+    status = session_data['status']
+    if status == 'running':
+        remaining_ms = session_data['end_ms'] - (now or now_ms())
+    elif status == 'paused':
+        remaining_ms = session_data['end_ms'] - session_data['paused_ms']
+    elif status == 'scheduled':
+        remaining_ms = session_data['total_seconds'] * 1000
+    else:
+        remaining_ms = 0
+    session_data['remaining_seconds'] = max(0, remaining_ms // 1000)
+    return session_data
+
+
+def _transition_result(result):
+    """遷移スクリプトの戻り値を辞書に変換（エラーコードはTransitionError）"""
+    if isinstance(result, str):
+        raise TransitionError(TRANSITION_ERRORS[result])
+    return to_session_data(result)
+
+
+def _start_args(session_id, timer_id, total_seconds, band_id):
+    band_id = band_id if band_id is not None else 0
+    keys = [session_key(session_id), DEADLINES_KEY, band_index_key(band_id), timer_index_key(timer_id),
+            LIVE_SESSIONS_KEY, deadline_key(session_id), EVENTS_KEY]
+    args = [session_id, now_ms(), timer_id, band_id, total_seconds, SESSION_TIMEOUT]
+    return keys, args
+
+
+def _live_sessions(session_ids, raws):
+    """
+    インデックスの各メンバーを稼働中セッションに変換
+    期限切れ（TTL失効）や完了済みのメンバーは取り除くべきIDとして返す
+    """
+    sessions, stale = [], []
+    for session_id, raw in zip(session_ids, raws):
+        session_data = to_session_data(raw)
+        if session_data is None or session_data['status'] not in LIVE_STATUSES:
+            stale.append(session_id)
+            continue
+        session_data['session_id'] = session_id
+        sessions.append(session_data)
+    sessions.sort(key=lambda s: s['start_ms'])
+    return sessions, stale
+
+
+def _split_live(session_ids, statuses):
+    """インデックスのメンバーを状態（HGET status の結果）で稼働中と取り除くべきものに分ける"""
+    live, stale = [], []
+    for session_id, status in zip(session_ids, statuses):
+        (live if status in LIVE_STATUSES else stale).append(session_id)
+    return live, stale
+
+
+def _transition_args(session_id):
+    keys = [session_key(session_id), DEADLINES_KEY, deadline_key(session_id), EVENTS_KEY]
+    return keys, [session_id, now_ms(), SESSION_TIMEOUT]
+
+
+# 完了スクリプトに渡すキーの元になるフィールド（開始後は変わらない）
+COMPLETE_KEY_FIELDS = ('band_id', 'timer_id', 'next')
+
+
+def _complete_call(session_id, fields, next_timer_id, force):
+    """
+    完了スクリプトの呼び出しを組み立てる
+    fields: セッションの COMPLETE_KEY_FIELDS（HMGETの結果）, next_timer_id: 次区間の timer_id
+    """
+    band_id, timer_id, next_id = (value or '' for value in fields)
+    keys = [session_key(session_id), DEADLINES_KEY, deadline_key(session_id), EVENTS_KEY,
+            band_index_key(band_id), timer_index_key(timer_id), LIVE_SESSIONS_KEY]
+    if next_id:
+        keys += [session_key(next_id), deadline_key(next_id), timer_index_key(next_timer_id or '')]
+    args = [session_id, now_ms(), SESSION_TIMEOUT, int(force), band_id, timer_id, next_id, next_timer_id or '']
+    return COMPLETE_SCRIPT, keys, args
+
+
+def _complete_calls(session_ids, fields, next_timer_ids, force):
+    return [
+        _complete_call(session_id, session_fields, next_timer_ids.get(session_fields[2]), force)
+        for session_id, session_fields in zip(session_ids, fields)
+    ]
+
+
+# 一括操作で使うスクリプト
+BATCH_SCRIPTS = {'pause': PAUSE_SCRIPT, 'resume': RESUME_SCRIPT}
+
+
+def _batch_calls(action, session_ids):
+    script = BATCH_SCRIPTS[action]
+    return [(script, *_transition_args(session_id)) for session_id in session_ids]
+
+
+def _batch_results(session_ids, results):
+    """一括遷移の結果を成功（セッション一覧）と失敗（session_id → メッセージ）に分ける"""
+    sessions, errors = [], {}
+    for session_id, result in zip(session_ids, results):
+        try:
+            session_data = _transition_result(result)
+        except TransitionError as e:
+            errors[session_id] = str(e)
+            continue
+        session_data['session_id'] = session_id
+        sessions.append(session_data)
+    return sessions, errors
+
+
+def _started_sessions(specs, results):
+    """一括開始の結果（session_id → スクリプトの戻り値）を specs の順に並べる"""
+    sessions = []
+    for spec in specs:
+        session_data = to_session_data(results[spec[0]])
+        session_data['session_id'] = spec[0]
+        sessions.append(session_data)
+    return sessions
+
+
+def _index_keys(timer_ids=None, band_ids=None, all_bands=False):
+    """
+    一括操作の対象指定をノードごとの稼働中インデックスのキーに変換（{URL: [キー, ...]}）
+    バンド別は担当ノードのみ、タイマー別・全体は全ノードを対象にする
+    """
+    if all_bands:
+        return {shard: [LIVE_SESSIONS_KEY] for shard in shard_urls()}
+    keys = {}
+    timer_keys = [timer_index_key(timer_id) for timer_id in timer_ids or []]
+    if timer_keys:
+        for shard in shard_urls():
+            keys[shard] = list(timer_keys)
+    for band_id in band_ids or []:
+        keys.setdefault(band_shard(band_id), []).append(band_index_key(band_id))
+    return keys
+
+
+def _merge_sessions(lists):
+    """ノードごとの稼働中セッション一覧を開始時刻順にまとめる"""
+    sessions = [session_data for sessions in lists for session_data in sessions]
+    sessions.sort(key=lambda s: s['start_ms'])
+    return sessions
+
+
+def _session_shard_of_spec(spec):
+    return session_shard(spec[0])
+
+
+# ---- 同期API（Celeryタスク・スケジューラ用） ----
+
+def load_session(session_id):
+    """セッションデータ取得（HGETALL 1回）"""
+    session_data = to_session_data(get_redis(session_shard(session_id)).hgetall(session_key(session_id)))
+    record_lookup(session_data is not None)
+    return session_data
+
+
+def start_session(session_id, timer_id, total_seconds, band_id=None):
+    """セッション開始"""
+    keys, args = _start_args(session_id, timer_id, total_seconds, band_id)
+    return to_session_data(START_SCRIPT(get_redis(session_shard(session_id)), keys, args))
+
+
+def pause_session(session_id):
+    """タイマー一時停止（遷移できない場合はTransitionError）"""
+    keys, args = _transition_args(session_id)
+    return _transition_result(PAUSE_SCRIPT(get_redis(session_shard(session_id)), keys, args))
+
+
+def resume_session(session_id):
+    """タイマー再開（一時停止時間分だけ終了時刻を延長）"""
+    keys, args = _transition_args(session_id)
+    return _transition_result(RESUME_SCRIPT(get_redis(session_shard(session_id)), keys, args))
+
+
+def complete_session(session_id, force=False):
+    """
+    終了時刻を過ぎていれば完了にする（force=Trueなら即時完了＝スキップ）
+    完了にした場合はセッションデータを返す
+    """
+    return to_session_data(_complete(get_redis(session_shard(session_id)), [session_id], force)[0])
+
+
+def complete_sessions(session_ids, shard=None):
+    """
+    終了時刻を過ぎた複数セッション（同じノード）を1つのパイプラインで完了にする
+    完了にできたものを [(session_id, セッションデータ), ...] で返す
+    """
+    if not session_ids:
+        return []
+    results = _complete(get_redis(shard), session_ids)
+    return [
+        (session_id, session_data)
+        for session_id, session_data in zip(session_ids, map(to_session_data, results))
+        if session_data is not None
+    ]
+
+
+def _complete(client, session_ids, force=False):
+    """
+    完了スクリプトを1つのパイプラインで実行（往復はキーの読み取りを含めて2〜3回）
+    インデックス・次区間のキーはハッシュの値で決まるため、先に読んでから KEYS で渡す
+    """
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hmget(session_key(session_id), *COMPLETE_KEY_FIELDS)
+    fields = pipe.execute()
+    next_ids = [session_fields[2] for session_fields in fields if session_fields[2]]
+    next_timer_ids = {}
+    if next_ids:
+        pipe = client.pipeline(transaction=False)
+        for next_id in next_ids:
+            pipe.hget(session_key(next_id), 'timer_id')
+        next_timer_ids = dict(zip(next_ids, pipe.execute()))
+    return run_scripts(client, _complete_calls(session_ids, fields, next_timer_ids, force))
+
+
+def load_sessions(session_ids, shard=None):
+    """複数セッション（同じノード）を1つのパイプラインで取得。{session_id: セッションデータ}"""
+    if not session_ids:
+        return {}
+    pipe = get_redis(shard).pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(session_key(session_id))
+    return dict(zip(session_ids, map(to_session_data, pipe.execute())))
+
+
+def get_session_status(session_id):
+    """
+    タイマーの現在状態を取得
+    Celeryを経由せず、HGETALL 1回でプロセス内計算する（読み取り専用）
+    """
+    return load_session(session_id) or dict(NOT_FOUND)
+
+
+def list_indexed_sessions(index_key, shard=None):
+    """ノードのインデックス（バンド別・タイマー別）から稼働中セッション一覧を取得"""
+    client = get_redis(shard)
+    session_ids = list(client.smembers(index_key))
+    if not session_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(session_key(session_id))
+    sessions, stale = _live_sessions(session_ids, pipe.execute())
+    if stale:
+        client.srem(index_key, *stale)
+    return sessions
+
+
+def _prune_index(client, keys, session_ids):
+    """
+    インデックス（keys）のメンバーのうち稼働中のものを返す
+    TTLで失効した・完了済みのメンバーは keys から取り除く
+    """
+    if not session_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hget(session_key(session_id), 'status')
+    live, stale = _split_live(session_ids, pipe.execute())
+    if stale:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.srem(key, *stale)
+        pipe.execute()
+    return live
+
+
+def prune_live_sessions(shard=None):
+    """
+    ノードの全体インデックスとバンド別インデックスから失効したメンバーを取り除き、稼働中の数を返す
+    メンバー数に比例するため、スケジューラが TIMER_INDEX_PRUNE_INTERVAL 秒ごとに実行する（メトリクスはSCARDのみ）
+    """
+    client = get_redis(shard)
+    session_ids = list(client.smembers(LIVE_SESSIONS_KEY))
+    if not session_ids:
+        return 0
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hget(session_key(session_id), 'status')
+    live, stale = _split_live(session_ids, pipe.execute())
+    if stale:
+        pipe = client.pipeline(transaction=False)
+        pipe.srem(LIVE_SESSIONS_KEY, *stale)
+        for session_id in stale:
+            pipe.srem(band_index_key(session_band_id(session_id) or 0), session_id)
+        pipe.execute()
+    return len(live)
+
+
+def resolve_session_ids(timer_ids=None, band_ids=None, all_bands=False):
+    """
+    タイマー・バンド・全体の指定から稼働中のsession_idを取得（ノードごとにSUNION 1回）
+    失効したメンバーはここでインデックスから取り除く
+    """
+    session_ids = set()
+    for shard, keys in _index_keys(timer_ids, band_ids, all_bands).items():
+        client = get_redis(shard)
+        session_ids.update(_prune_index(client, keys, list(client.sunion(keys))))
+    return sorted(session_ids)
+
+
+def transition_sessions(action, session_ids):
+    """
+    複数セッションを一括で一時停止・再開（action: pause / resume）
+    ノードごとに1つのパイプラインで各セッションのスクリプトを実行する。(成功一覧, 失敗) を返す
+    """
+    if not session_ids:
+        return [], {}
+    results = {}
+    for shard, ids in group_by_shard(session_ids, session_shard).items():
+        results.update(zip(ids, run_scripts(get_redis(shard), _batch_calls(action, ids))))
+    return _batch_results(session_ids, [results[session_id] for session_id in session_ids])
+
+
+def start_sessions(specs):
+    """
+    複数セッションを一括開始
+    specs: [(session_id, timer_id, total_seconds, band_id), ...]
+    """
+    if not specs:
+        return []
+    results = {}
+    for shard, shard_specs in group_by_shard(specs, _session_shard_of_spec).items():
+        calls = [(START_SCRIPT, *_start_args(*spec)) for spec in shard_specs]
+        results.update(zip((spec[0] for spec in shard_specs), run_scripts(get_redis(shard), calls)))
+    return _started_sessions(specs, results)
+
+
+def list_band_sessions(band_id):
+    """バンドの稼働中セッション一覧"""
+    return list_indexed_sessions(band_index_key(band_id), band_shard(band_id))
+
+
+def list_timer_sessions(timer_id):
+    """タイマーの稼働中セッション一覧（全ノード）"""
+    return _merge_sessions(
+        list_indexed_sessions(timer_index_key(timer_id), shard) for shard in shard_urls()
+    )
+
+
+# ---- 非同期API（async view / Consumer用。スレッドを占有しない） ----
+
+async def aload_session(session_id):
+    client = get_async_redis(session_shard(session_id))
+    session_data = to_session_data(await client.hgetall(session_key(session_id)))
+    record_lookup(session_data is not None)
+    return session_data
+
+
+async def astart_session(session_id, timer_id, total_seconds, band_id=None):
+    keys, args = _start_args(session_id, timer_id, total_seconds, band_id)
+    return to_session_data(await START_SCRIPT.acall(get_async_redis(session_shard(session_id)), keys, args))
+
+
+async def apause_session(session_id):
+    keys, args = _transition_args(session_id)
+    return _transition_result(await PAUSE_SCRIPT.acall(get_async_redis(session_shard(session_id)), keys, args))
+
+
+async def aresume_session(session_id):
+    keys, args = _transition_args(session_id)
+    return _transition_result(await RESUME_SCRIPT.acall(get_async_redis(session_shard(session_id)), keys, args))
+
+
+async def acomplete_session(session_id, force=False):
+    results = await _acomplete(get_async_redis(session_shard(session_id)), [session_id], force)
+    return to_session_data(results[0])
+
+
+async def _acomplete(client, session_ids, force=False):
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hmget(session_key(session_id), *COMPLETE_KEY_FIELDS)
+    fields = await pipe.execute()
+    next_ids = [session_fields[2] for session_fields in fields if session_fields[2]]
+    next_timer_ids = {}
+    if next_ids:
+        pipe = client.pipeline(transaction=False)
+        for next_id in next_ids:
+            pipe.hget(session_key(next_id), 'timer_id')
+        next_timer_ids = dict(zip(next_ids, await pipe.execute()))
+    return await arun_scripts(client, _complete_calls(session_ids, fields, next_timer_ids, force))
+
+
+async def aget_session_status(session_id):
+    return await aload_session(session_id) or dict(NOT_FOUND)
+
+
+async def alist_indexed_sessions(index_key, shard=None):
+    client = get_async_redis(shard)
+    session_ids = list(await client.smembers(index_key))
+    if not session_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hgetall(session_key(session_id))
+    sessions, stale = _live_sessions(session_ids, await pipe.execute())
+    if stale:
+        await client.srem(index_key, *stale)
+    return sessions
+
+
+async def _aprune_index(client, keys, session_ids):
+    if not session_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for session_id in session_ids:
+        pipe.hget(session_key(session_id), 'status')
+    live, stale = _split_live(session_ids, await pipe.execute())
+    if stale:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.srem(key, *stale)
+        await pipe.execute()
+    return live
+
+
+async def _aresolve_shard(shard, keys):
+    client = get_async_redis(shard)
+    return await _aprune_index(client, keys, list(await client.sunion(keys)))
+
+
+async def aresolve_session_ids(timer_ids=None, band_ids=None, all_bands=False):
+    # ノードへの問い合わせは並行に行う
+    results = await asyncio.gather(*(
+        _aresolve_shard(shard, keys) for shard, keys in _index_keys(timer_ids, band_ids, all_bands).items()
+    ))
+    return sorted(set().union(*results))
+
+
+async def atransition_sessions(action, session_ids):
+    if not session_ids:
+        return [], {}
+    groups = group_by_shard(session_ids, session_shard)
+    shard_results = await asyncio.gather(*(
+        arun_scripts(get_async_redis(shard), _batch_calls(action, ids)) for shard, ids in groups.items()
+    ))
+    results = {}
+    for ids, shard_result in zip(groups.values(), shard_results):
+        results.update(zip(ids, shard_result))
+    return _batch_results(session_ids, [results[session_id] for session_id in session_ids])
+
+
+async def astart_sessions(specs):
+    if not specs:
+        return []
+    groups = group_by_shard(specs, _session_shard_of_spec)
+    shard_results = await asyncio.gather(*(
+        arun_scripts(get_async_redis(shard), [(START_SCRIPT, *_start_args(*spec)) for spec in shard_specs])
+        for shard, shard_specs in groups.items()
+    ))
+    results = {}
+    for shard_specs, shard_result in zip(groups.values(), shard_results):
+        results.update(zip((spec[0] for spec in shard_specs), shard_result))
+    return _started_sessions(specs, results)
+
+
+async def alist_band_sessions(band_id):
+    return await alist_indexed_sessions(band_index_key(band_id), band_shard(band_id))
+
+
+async def alist_timer_sessions(timer_id):
+    return _merge_sessions(await asyncio.gather(*(
+        alist_indexed_sessions(timer_index_key(timer_id), shard) for shard in shard_urls()
+    )))
@@ -0,0 +1,82 @@
+"""
+band_id による複数Redisノードへの振り分け（コンシステントハッシュ）
+
+1つのバンドのセッション・インデックス・ランシートと、WebSocket配信のグループは
+すべて同じノードに置く（Luaスクリプト・グループ送信が1ノードで完結する）。
+ノードを追加・削除しても、移動するのはおよそ 1/ノード数 のバンドのみ。
+"""
+
+from bisect import bisect
+import hashlib
+import re
+from channels_redis.core import RedisChannelLayer
+from .redis_pools import AsyncInstrumentedConnectionPool
+
+# 1ノードあたりの仮想ノード数（多いほど偏りが小さい）
+DEFAULT_REPLICAS = 512
+
+BAND_GROUP_PATTERN = re.compile(r'^timer_band_(\d+)$')
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """ノード名のリストから作るハッシュリング"""
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        if not nodes:
+            raise ValueError('ノードが1つ以上必要です')
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """キーを担当するノード名"""
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def band_shard_key(band_id):
+    """バンドの振り分けキー（セッション・チャンネルレイヤーで共通）"""
+    return f'band:{band_id}'
+
+
+class ShardedChannelLayer(RedisChannelLayer):
+    """
+    バンドのグループ（timer_band_<id>）を、セッションと同じ規則でノードに割り当てるチャンネルレイヤー
+    それ以外のグループ・チャンネルは名前そのものでリング上のノードを選ぶ
+    ノードへの接続は用途別の上限付きプール（redis_pools.py）を使う
+    """
+
+    def __init__(self, hosts=None, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self._host_names = [self._host_name(index, host) for index, host in enumerate(self.hosts)]
+        self._ring = HashRing(self._host_names)
+        self._host_index = {name: index for index, name in enumerate(self._host_names)}
+
+    @staticmethod
+    def _host_name(index, host):
+        # TIMER_REDIS_SHARDS と同じURLを名前にする（ノード順を入れ替えても割り当ては変わらない）
+        address = host.get('address')
+        return address if isinstance(address, str) else f'host{index}'
+
+    def create_pool(self, index):
+        """上限・計測付きのプール（redis_pools の 'channels'）"""
+        host = dict(self.hosts[index])
+        if 'address' not in host:
+            return super().create_pool(index)
+        return AsyncInstrumentedConnectionPool.from_url(host.pop('address'), role='channels', **host)
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        match = BAND_GROUP_PATTERN.match(value)
+        key = band_shard_key(match.group(1)) if match else value
+        return self._host_index[self._ring.node_for(key)]
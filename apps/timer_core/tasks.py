@@ -1,12 +1,43 @@
 from celery import shared_task
-from django.core.cache import cache
-from django.utils import timezone
-from datetime import datetime, timedelta
+from celery.signals import worker_ready
+from django.core.exceptions import ImproperlyConfigured
 import logging
-import json
+from .session_store import (
+    TransitionError, start_session, pause_session, resume_session,
+    complete_session, get_session_status, start_sessions, transition_sessions,
+)
+from .broadcast import broadcast_session, broadcast_batch
+from .scheduler import announce_completion
+from .persistence import rehydrate_sessions
+from .backends import get_backend
+from .backends.redis_celery import RedisCeleryBackend
 
 logger = logging.getLogger(__name__)
 
+def uses_redis_backend():
+    """Redisのセッションを使うバックエンド（redis またはその派生）か"""
+    return isinstance(get_backend(), RedisCeleryBackend)
+
+def require_redis_backend():
+    """
+    セッションを操作するタスクは Redis のセッションを直接扱うため、redis バックエンドでのみ実行できる
+    （asyncio バックエンドのセッションはdaphneプロセス内にあり、ワーカーからは見えない）
+    """
+    if not uses_redis_backend():
+        raise ImproperlyConfigured(
+            f"タイマーのCeleryタスクは TIMER_BACKEND='redis' でのみ使用できます（現在: {get_backend().__class__.__name__}）"
+        )
+
+@worker_ready.connect
+def rehydrate_on_worker_ready(**kwargs):
+    """ワーカー起動時に保存済みの稼働中セッションをRedisへ復元（スケジューラ側と重複しても無害）"""
+    if not uses_redis_backend():
+        return
+    try:
+        rehydrate_sessions()
+    except Exception as e:
+        logger.error(f"セッション復元エラー: {e}")
+
 @shared_task
 def test_celery():
     """Celery動作テスト用タスク"""
@@ -14,184 +45,105 @@ def test_celery():
     return "Celery is working!"
 
 @shared_task(bind=True)
-def start_timer_session(self, session_id, timer_id, total_seconds):
+def start_timer_session(self, session_id, timer_id, total_seconds, band_id=None):
     """
     タイマーセッション開始
     長時間実行ではなく、開始時刻を記録するだけ
     """
+    require_redis_backend()
     logger.info(f"タイマーセッション開始: session_id={session_id}, timer_id={timer_id}, total_seconds={total_seconds}")
     
-    # 開始時刻を記録
-    start_time = timezone.now()
-    end_time = start_time + timedelta(seconds=total_seconds)
-    
-    cache_key = f"timer_session:{session_id}"
-    
-    # セッション状態をキャッシュに保存
-    session_data = {
-        'status': 'running',
-        'timer_id': timer_id,
-        'start_time': start_time.isoformat(),
-        'end_time': end_time.isoformat(),
-        'total_seconds': total_seconds,
-        'created_at': timezone.now().isoformat()
-    }
-    
-    # 1時間キャッシュ（十分なリハーサル時間）
-    cache.set(cache_key, session_data, timeout=3600)
+    session_data = start_session(session_id, timer_id, total_seconds, band_id)
+    broadcast_session(session_id, session_data, 'started')
     
+    # 完了検知はスケジューラ（run_timer_scheduler）が終了時刻インデックスから行う
     logger.info(f"タイマーセッション開始完了: session_id={session_id}")
     
-    # 定期チェックタスクを開始
-    check_timer_completion.apply_async(args=[session_id], countdown=5)
-    
     return {
         'success': True,
         'session_id': session_id,
-        'start_time': start_time.isoformat(),
-        'end_time': end_time.isoformat()
+        'start_ms': session_data['start_ms'],
+        'end_ms': session_data['end_ms']
     }
 
 @shared_task(bind=True)
 def check_timer_completion(self, session_id):
     """
-    タイマー完了チェック（定期実行）
-    リアルタイムではなく定期的にチェック
+    タイマー完了チェック（単発）
+    通常はスケジューラが完了させるため、手動確認用に残している。再スケジュールはしない
     """
-    cache_key = f"timer_session:{session_id}"
-    session_data = cache.get(cache_key)
-    
-    if not session_data:
-        logger.warning(f"セッションが見つかりません: {session_id}")
-        return
-    
-    if session_data.get('status') != 'running':
-        logger.info(f"セッションが停止中: {session_id}")
-        return
+    require_redis_backend()
+    session_data = complete_session(session_id)
     
-    # 現在時刻と終了時刻を比較
-    now = timezone.now()
-    end_time = datetime.fromisoformat(session_data['end_time'].replace('Z', '+00:00'))
+    if session_data is None:
+        return {'status': get_session_status(session_id).get('status'), 'session_id': session_id}
     
-    if timezone.is_aware(end_time):
-        end_time = timezone.make_naive(end_time, timezone.utc)
-        now = timezone.make_naive(now, timezone.utc)
-    
-    if now >= end_time:
-        # タイマー完了
-        session_data['status'] = 'completed'
-        session_data['completed_at'] = timezone.now().isoformat()
-        cache.set(cache_key, session_data, timeout=3600)
-        
-        logger.info(f"タイマー完了: session_id={session_id}")
-        
-        # WebSocket通知（将来実装）
-        # notify_timer_completion.delay(session_id)
-        
-        return {'status': 'completed', 'session_id': session_id}
-    else:
-        # まだ継続中 - 10秒後に再チェック
-        remaining_seconds = (end_time - now).total_seconds()
-        session_data['remaining_seconds'] = max(0, int(remaining_seconds))
-        cache.set(cache_key, session_data, timeout=3600)
-        
-        # 10秒後に再チェック
-        check_timer_completion.apply_async(args=[session_id], countdown=10)
-        
-        return {'status': 'running', 'remaining_seconds': remaining_seconds}
+    logger.info(f"タイマー完了: session_id={session_id}")
+    announce_completion(session_id, session_data)
+    return {'status': 'completed', 'session_id': session_id}
 
 @shared_task
 def get_timer_status(session_id):
     """
     タイマーの現在状態を取得（同期処理）
+    実処理はsession_store側。ビューからは直接呼び出す
     """
-    cache_key = f"timer_session:{session_id}"
-    session_data = cache.get(cache_key)
-    
-    if not session_data:
-        return {'status': 'not_found', 'message': 'セッションが見つかりません'}
-    
-    # 現在の残り時間を計算
-    if session_data.get('status') == 'running':
-        now = timezone.now()
-        end_time_str = session_data.get('end_time')
-        
-        if end_time_str:
-            try:
-                end_time = datetime.fromisoformat(end_time_str.replace('Z', '+00:00'))
-                if timezone.is_aware(end_time):
-                    end_time = timezone.make_naive(end_time, timezone.utc)
-                    now = timezone.make_naive(now, timezone.utc)
-                
-                remaining_seconds = max(0, int((end_time - now).total_seconds()))
-                session_data['remaining_seconds'] = remaining_seconds
-                
-                # 残り時間が0になった場合は完了状態に更新
-                if remaining_seconds == 0:
-                    session_data['status'] = 'completed'
-                    cache.set(cache_key, session_data, timeout=3600)
-                    
-            except (ValueError, TypeError) as e:
-                logger.error(f"時刻解析エラー: {e}")
-                session_data['remaining_seconds'] = 0
-    
-    return session_data
+    require_redis_backend()
+    return get_session_status(session_id)
 
 @shared_task
 def pause_timer_session(session_id):
     """タイマー一時停止"""
-    cache_key = f"timer_session:{session_id}"
-    session_data = cache.get(cache_key)
-    
-    if not session_data:
-        return {'success': False, 'message': 'セッションが見つかりません'}
-    
-    if session_data.get('status') != 'running':
-        return {'success': False, 'message': 'タイマーが実行中ではありません'}
-    
-    # 一時停止時刻を記録
-    session_data['status'] = 'paused'
-    session_data['paused_at'] = timezone.now().isoformat()
-    cache.set(cache_key, session_data, timeout=3600)
+    require_redis_backend()
+    try:
+        session_data = pause_session(session_id)
+    except TransitionError as e:
+        return {'success': False, 'message': str(e)}
     
+    broadcast_session(session_id, session_data, 'paused')
     logger.info(f"タイマー一時停止: session_id={session_id}")
     return {'success': True, 'status': 'paused'}
 
 @shared_task  
 def resume_timer_session(session_id):
     """タイマー再開"""
-    cache_key = f"timer_session:{session_id}"
-    session_data = cache.get(cache_key)
-    
-    if not session_data:
-        return {'success': False, 'message': 'セッションが見つかりません'}
-    
-    if session_data.get('status') != 'paused':
-        return {'success': False, 'message': 'タイマーが一時停止中ではありません'}
-    
-    # 一時停止時間を計算して終了時刻を延長
-    now = timezone.now()
-    paused_at = datetime.fromisoformat(session_data['paused_at'].replace('Z', '+00:00'))
-    if timezone.is_aware(paused_at):
-        paused_at = timezone.make_naive(paused_at, timezone.utc)
-        now = timezone.make_naive(now, timezone.utc)
-    
-    pause_duration = (now - paused_at).total_seconds()
-    
-    # 終了時刻を延長
-    end_time = datetime.fromisoformat(session_data['end_time'].replace('Z', '+00:00'))
-    if timezone.is_aware(end_time):
-        end_time = timezone.make_naive(end_time, timezone.utc)
-    
-    new_end_time = end_time + timedelta(seconds=pause_duration)
+    require_redis_backend()
+    try:
+        session_data = resume_session(session_id)
+    except TransitionError as e:
+        return {'success': False, 'message': str(e)}
     
-    session_data['status'] = 'running'
-    session_data['end_time'] = new_end_time.isoformat()
-    session_data.pop('paused_at', None)
-    cache.set(cache_key, session_data, timeout=3600)
-    
-    # 定期チェック再開
-    check_timer_completion.apply_async(args=[session_id], countdown=5)
+    broadcast_session(session_id, session_data, 'resumed')
     
     logger.info(f"タイマー再開: session_id={session_id}")
-    return {'success': True, 'status': 'running'}
\ No newline at end of file
+    return {'success': True, 'status': 'running'}
+
+@shared_task
+def start_timer_sessions(specs):
+    """
+    タイマー一括開始
+    specs: [[session_id, timer_id, total_seconds, band_id], ...]
+    """
+    require_redis_backend()
+    sessions = start_sessions([tuple(spec) for spec in specs])
+    broadcast_batch(sessions, 'started')
+    logger.info(f"タイマー一括開始: {len(sessions)}件")
+    return {'success': True, 'session_ids': [s['session_id'] for s in sessions]}
+
+@shared_task
+def pause_timer_sessions(session_ids):
+    """タイマー一括一時停止"""
+    require_redis_backend()
+    sessions, errors = transition_sessions('pause', session_ids)
+    broadcast_batch(sessions, 'paused')
+    logger.info(f"タイマー一括一時停止: 成功={len(sessions)}, 失敗={len(errors)}")
+    return {'success': True, 'session_ids': [s['session_id'] for s in sessions], 'errors': errors}
+
+@shared_task
+def resume_timer_sessions(session_ids):
+    """タイマー一括再開"""
+    require_redis_backend()
+    sessions, errors = transition_sessions('resume', session_ids)
+    broadcast_batch(sessions, 'resumed')
+    logger.info(f"タイマー一括再開: 成功={len(sessions)}, 失敗={len(errors)}")
+    return {'success': True, 'session_ids': [s['session_id'] for s in sessions], 'errors': errors}
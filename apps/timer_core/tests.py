@@ -1,3 +1,1293 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from contextlib import contextmanager
+from unittest import mock, skipIf
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import REGISTRY
+import asyncio
+import json
+import redis
+import threading
+import time
+from .backends import asyncio_engine
+from .backends.asyncio_engine import AsyncioBackend
+from .backpressure import AckWindow, OutboundQueue, QueueFull, TokenBucket
+from .broadcast import MSGPACK_SUBPROTOCOL, abroadcast_session, band_group_name, msgpack
+from .consumers import CLOSE_SLOW_CONSUMER, CLOSE_TRY_AGAIN, resume_band_ids, resume_token
+from .models import Band, Timer, TimerSession, TimerSessionEvent
+from .persistence import flush_session_events, rehydrate_sessions
+from .redis_client import band_shard, session_shard
+from .routing import websocket_urlpatterns
+from .schedule import reorder_timers
+from .scheduler import process_due, prune_indexes
+from .session_store import TransitionError, new_session_id
+from .sharding import HashRing, ShardedChannelLayer, band_shard_key
+from . import backpressure, consumers, expiry, metadata_cache, redis_client, redis_pools, runsheet, session_store
 
-# Create your tests here.
+try:
+    import fakeredis  # fakeredis[lua]（Luaスクリプト対応）
+except ImportError:
+    fakeredis = None
+
+# Redisなしで動かす（セッションはプロセス内、キャッシュ・チャンネルレイヤーはメモリ）
+NO_REDIS = override_settings(
+    TIMER_BACKEND='asyncio',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+
+
+# Redisバックエンドをfakeredisで動かす（ノード1台）
+FAKE_REDIS = override_settings(
+    TIMER_BACKEND='redis',
+    TIMER_REDIS_SHARDS=['fakeredis://0'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+
+
+@contextmanager
+def clock(at_ms):
+    """セッション操作の現在時刻を固定する（epochミリ秒）"""
+    with mock.patch.object(session_store, 'now_ms', return_value=at_ms):
+        yield
+
+
+def create_bands(band_count, timers_per_band):
+    """バンドごとに順序 1..N のタイマーを作成"""
+    for b in range(band_count):
+        band = Band.objects.create(name=f'バンド{b}')
+        Timer.objects.bulk_create(
+            Timer(band=band, name=f'タイマー{i}', duration_minutes=5, order=i)
+            for i in range(1, timers_per_band + 1)
+        )
+
+
+@NO_REDIS
+class QueryCountTestCase(TestCase):
+    """
+    主要画面・APIのクエリ数（行数が増えても変わらないこと）
+    件数が変わった場合は N+1 の混入を疑う
+    """
+
+    def setUp(self):
+        metadata_cache.clear()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def test_timer_main(self):
+        # データを含まないページ（一覧は構成APIから取得）
+        create_bands(2, 3)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('timer_core:timer_main'))
+
+    def test_timer_schedule(self):
+        create_bands(2, 3)
+        url = reverse('timer_core:timer_schedule')
+        # バンドのページ・有効なタイマー
+        with self.assertNumQueries(2):
+            self.client.get(url)
+        create_bands(3, 5)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        # ETagが一致すればバンドのページのみ
+        with self.assertNumQueries(1):
+            self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_start_timer(self):
+        create_bands(1, 2)
+        timer = Timer.objects.first()
+        url = reverse('timer_core:start_timer')
+        body = json.dumps({'timer_id': timer.id})
+        # 初回のみタイマー情報（バンド名を含む）を1クエリで取得し、以降はキャッシュ
+        with self.assertNumQueries(1):
+            response = self.client.post(url, body, content_type='application/json')
+        self.assertTrue(response.json()['success'])
+        with self.assertNumQueries(0):
+            response = self.client.post(url, body, content_type='application/json')
+        self.assertTrue(response.json()['success'])
+
+    def assertChangelistQueries(self, url, num, add_rows):
+        self.client.force_login(self.user)
+        with self.assertNumQueries(num):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        add_rows()
+        with self.assertNumQueries(num):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_band_changelist(self):
+        create_bands(2, 0)
+        # ユーザー・件数（絞り込み後と全体）・一覧
+        self.assertChangelistQueries(
+            reverse('admin:timer_core_band_changelist'), 4, lambda: create_bands(5, 0)
+        )
+
+    def test_timer_changelist(self):
+        create_bands(2, 3)
+        # ユーザー・バンドの絞り込み候補・件数（絞り込み後と全体）・一覧（バンドをJOIN）
+        self.assertChangelistQueries(
+            reverse('admin:timer_core_timer_changelist'), 5, lambda: create_bands(3, 5)
+        )
+
+    def test_timer_session_changelist(self):
+        create_bands(2, 3)
+
+        def add_sessions():
+            for timer in Timer.objects.all():
+                TimerSession.objects.create(
+                    session_id=f'{timer.band_id}.{timer.id}', timer=timer, band_id=timer.band_id,
+                    status='completed', start_ms=0, end_ms=300000, total_seconds=300,
+                )
+
+        add_sessions()
+        # ユーザー・件数（絞り込み後と全体）・一覧（タイマーとそのバンド、セッションのバンドをJOIN）
+        self.assertChangelistQueries(
+            reverse('admin:timer_core_timersession_changelist'), 4, lambda: (TimerSession.objects.all().delete(), add_sessions())
+        )
+
+
+@NO_REDIS
+class ScheduleAPITestCase(TestCase):
+    """タイマー構成API（ページング・項目選択・ETag）"""
+
+    url = reverse('timer_core:timer_schedule')
+
+    def get(self, **params):
+        return self.client.get(self.url, params)
+
+    def test_cursor_pagination(self):
+        create_bands(5, 2)
+        names, cursor = [], None
+        while True:
+            data = self.get(limit=2, **({'cursor': cursor} if cursor else {})).json()
+            names += [band['name'] for band in data['bands']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, [f'バンド{i}' for i in range(5)])
+
+    def test_fields_and_bands(self):
+        create_bands(2, 3)
+        band = Band.objects.get(name='バンド1')
+        Timer.objects.filter(band=band, order=3).update(is_active=False)
+        data = self.get(bands=band.id, fields='order').json()
+        self.assertEqual(len(data['bands']), 1)
+        self.assertEqual(data['bands'][0]['timers'], [{'id': t.id, 'order': t.order} for t in band.timer_set.filter(is_active=True)])
+        self.assertFalse(self.get(fields='band').json()['success'])
+        self.assertFalse(self.get(limit=0).json()['success'])
+        self.assertFalse(self.get(cursor='!!').json()['success'])
+
+    def test_etag(self):
+        create_bands(1, 2)
+        response = self.get()
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # タイマーの変更でバンドの構成バージョンが進み、ETagが変わる
+        timer = Timer.objects.first()
+        timer.duration_minutes = 10
+        timer.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # 並び替え（bulk_update）でも進む
+        etag = response['ETag']
+        reorder_timers(timer.band_id, [t.id for t in Timer.objects.order_by('-order')])
+        self.assertNotEqual(self.get()['ETag'], etag)
+        # 選択項目が違えば別のETag
+        self.assertNotEqual(self.get(fields='name')['ETag'], self.get()['ETag'])
+
+    def test_etag_after_band_saves(self):
+        # 保存のたびにバージョンが進む（読み込み時の古いバージョンを書き戻さない）
+        band = Band.objects.create(name='A')
+        etags = [self.get()['ETag']]
+        for name in ('B', 'C'):
+            band.name = name
+            band.save()
+            etags.append(self.get()['ETag'])
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        for name in ('D', 'E'):
+            response = self.client.post(
+                reverse('admin:timer_core_band_change', args=[band.id]),
+                {'name': name, 'description': ''},
+            )
+            self.assertEqual(response.status_code, 302)
+            etags.append(self.get()['ETag'])
+        self.assertEqual(len(set(etags)), 5)
+        self.assertEqual(Band.objects.get().schedule_version, 6)
+        self.assertEqual(self.get().json()['bands'][0]['name'], 'E')
+
+    def test_changelist_is_active(self):
+        # 管理画面の一覧で有効/無効を切り替えると、構成APIから外れる
+        create_bands(1, 2)
+        timers = list(Timer.objects.order_by('order'))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        etag = self.get()['ETag']
+        data = {'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '2', '_save': '保存'}
+        for index, timer in enumerate(timers):
+            data[f'form-{index}-id'] = str(timer.id)
+            if index == 0:
+                data[f'form-{index}-is_active'] = 'on'
+        response = self.client.post(reverse('admin:timer_core_timer_changelist'), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(Timer.objects.order_by('order').values_list('is_active', flat=True)), [True, False])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t['id'] for t in response.json()['bands'][0]['timers']], [timers[0].id])
+
+
+@FAKE_REDIS
+@skipIf(fakeredis is None, 'fakeredis[lua] が必要です')
+class RedisTestCase(TestCase):
+    """fakeredis（テストごとに空のサーバー）でRedisのセッションを扱うテストの基底"""
+
+    def setUp(self):
+        metadata_cache.clear()
+        server = fakeredis.FakeServer()
+        redis_client.override_clients(
+            lambda url: fakeredis.FakeRedis(server=server, decode_responses=True),
+            lambda url: fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+        )
+        self.addCleanup(
+            redis_client.override_clients,
+            redis_client._default_sync_client, redis_client._default_async_client,
+        )
+        self.redis = redis_client.get_redis()
+
+    def events(self):
+        """未保存イベントの (session_id, event) 一覧"""
+        return [tuple(record.split('|')[:2]) for record in self.redis.lrange(session_store.EVENTS_KEY, 0, -1)]
+
+    def deadline(self, session_id):
+        return self.redis.zscore(session_store.DEADLINES_KEY, session_id)
+
+
+class StopListening(BaseException):
+    """無効化通知の受信ループ（metadata_cache._listen）をテストで止める"""
+
+
+class MetadataCacheTestCase(RedisTestCase):
+    """バンド・タイマー情報キャッシュの無効化（自プロセスと Redis Pub/Sub 経由の他プロセス）"""
+
+    def setUp(self):
+        super().setUp()
+        create_bands(1, 2)
+        self.band = Band.objects.get()
+        self.timer = Timer.objects.filter(band=self.band).first()
+        # 受信スレッドは各テストで明示的に動かす
+        patcher = mock.patch.object(metadata_cache, '_ensure_listener')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cached(self):
+        return metadata_cache._bands.get(self.band.id), metadata_cache._timers.get(self.timer.id)
+
+    def test_local_invalidation_and_publish(self):
+        metadata_cache.get_timer_info(self.timer.id)
+        self.assertEqual(metadata_cache.get_band_info(self.band.id)['name'], 'バンド0')
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(metadata_cache.INVALIDATE_CHANNEL)
+
+        with override_settings(TIMER_BACKEND='redis'), self.captureOnCommitCallbacks(execute=True):
+            self.band.name = '改名'
+            self.band.save()
+            # 自プロセスはコミットを待たずに無効化（バンド名を含むタイマー情報も）
+            self.assertEqual(self.cached(), (None, None))
+            self.assertIsNone(pubsub.get_message(timeout=0.1))
+        # 他プロセスへの通知はコミット後
+        self.assertEqual(pubsub.get_message(timeout=1)['data'], f'band:{self.band.id}')
+        self.assertEqual(metadata_cache.get_timer_info(self.timer.id)['band_name'], '改名')
+
+    def test_listener_applies_published_invalidation(self):
+        metadata_cache.get_band_info(self.band.id)
+        metadata_cache.get_timer_info(self.timer.id)
+        apply_invalidation = metadata_cache.apply_invalidation
+
+        def apply_or_stop(message):
+            if message == 'stop:0':
+                raise StopListening
+            apply_invalidation(message)
+
+        def listen():
+            try:
+                metadata_cache._listen()
+            except StopListening:
+                pass
+
+        with mock.patch.object(metadata_cache, 'apply_invalidation', apply_or_stop):
+            listener = threading.Thread(target=listen, daemon=True)
+            listener.start()
+            while self.redis.pubsub_numsub(metadata_cache.INVALIDATE_CHANNEL)[0][1] == 0:
+                time.sleep(0.01)
+            # 他プロセスからの通知（タイマー単位）
+            self.redis.publish(metadata_cache.INVALIDATE_CHANNEL, f'timer:{self.timer.id}')
+            self.redis.publish(metadata_cache.INVALIDATE_CHANNEL, 'stop:0')
+            listener.join(timeout=5)
+        self.assertFalse(listener.is_alive())
+        band_info, timer_info = self.cached()
+        self.assertEqual((band_info['id'], timer_info), (self.band.id, None))
+
+
+class SessionStateMachineTestCase(RedisTestCase):
+    """遷移スクリプト（開始・一時停止・再開・完了）の状態遷移"""
+
+    T0 = 1_700_000_000_000
+
+    def test_pause_resume(self):
+        with clock(self.T0):
+            started = session_store.start_session('1.a', 10, 60, 1)
+        self.assertEqual((started['status'], started['end_ms'], started['version']), ('running', self.T0 + 60000, 1))
+        with clock(self.T0 + 10000):
+            paused = session_store.pause_session('1.a')
+            with self.assertRaises(TransitionError):
+                session_store.pause_session('1.a')
+        self.assertEqual((paused['status'], paused['remaining_seconds'], paused['version']), ('paused', 50, 2))
+        self.assertIsNone(self.deadline('1.a'))
+        # 一時停止していた15秒だけ終了時刻が延びる
+        with clock(self.T0 + 25000):
+            resumed = session_store.resume_session('1.a')
+            with self.assertRaises(TransitionError):
+                session_store.resume_session('1.a')
+        self.assertEqual((resumed['status'], resumed['end_ms'], resumed['version']), ('running', self.T0 + 75000, 3))
+        self.assertEqual(self.deadline('1.a'), self.T0 + 75000)
+        self.assertEqual([event for _, event in self.events()], ['started', 'paused', 'resumed'])
+        with self.assertRaises(TransitionError):
+            session_store.pause_session('1.missing')
+
+    def test_complete_only_when_running_and_due(self):
+        with clock(self.T0):
+            session_store.start_session('1.a', 10, 60, 1)
+        # 終了時刻前は完了しない（スケジューラのリースで進めたスコアは終了時刻に戻す）
+        self.redis.zadd(session_store.DEADLINES_KEY, {'1.a': self.T0 + 90000}, xx=True)
+        with clock(self.T0 + 30000):
+            self.assertIsNone(session_store.complete_session('1.a'))
+        self.assertEqual(self.deadline('1.a'), self.T0 + 60000)
+        # 取り出した直後に一時停止された：完了せず、インデックスから取り除く
+        with clock(self.T0 + 59000):
+            session_store.pause_session('1.a')
+        self.redis.zadd(session_store.DEADLINES_KEY, {'1.a': self.T0 + 60000})
+        with clock(self.T0 + 61000):
+            self.assertIsNone(session_store.complete_session('1.a'))
+        self.assertIsNone(self.deadline('1.a'))
+        self.assertEqual(session_store.load_session('1.a')['status'], 'paused')
+
+    def test_complete_is_idempotent(self):
+        with clock(self.T0):
+            session_store.start_session('1.a', 10, 60, 1)
+        with clock(self.T0 + 60000):
+            completed = session_store.complete_session('1.a')
+            self.assertIsNone(session_store.complete_session('1.a'))
+        self.assertEqual((completed['status'], completed['done_ms'], completed['version']), ('completed', self.T0 + 60000, 2))
+        self.assertEqual(session_store.load_session('1.a')['version'], 2)
+        self.assertEqual([event for _, event in self.events()], ['started', 'completed'])
+        self.assertIsNone(self.deadline('1.a'))
+        with self.assertRaises(TransitionError):
+            session_store.resume_session('1.a')
+
+    def test_skip_paused_session(self):
+        with clock(self.T0):
+            session_store.start_session('1.a', 10, 60, 1)
+            session_store.pause_session('1.a')
+            skipped = session_store.complete_session('1.a', force=True)
+        self.assertEqual(skipped['status'], 'completed')
+        self.assertNotIn('paused_ms', skipped)
+        self.assertEqual(self.events()[-1], ('1.a', 'skipped'))
+
+
+class SessionIndexTestCase(RedisTestCase):
+    """バンド別・タイマー別・全体の稼働中インデックス"""
+
+    def setUp(self):
+        super().setUp()
+        session_store.start_session('1.a', 10, 60, 1)
+        session_store.start_session('1.b', 11, 60, 1)
+        session_store.start_session('2.c', 10, 60, 2)
+
+    def test_resolve(self):
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[1]), ['1.a', '1.b'])
+        self.assertEqual(session_store.resolve_session_ids(timer_ids=[10]), ['1.a', '2.c'])
+        self.assertEqual(session_store.resolve_session_ids(all_bands=True), ['1.a', '1.b', '2.c'])
+        self.assertEqual([s['session_id'] for s in session_store.list_band_sessions(2)], ['2.c'])
+
+    def test_paused_stays_and_completed_leaves(self):
+        session_store.pause_session('1.a')
+        session_store.complete_session('1.b', force=True)
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[1]), ['1.a'])
+        self.assertFalse(self.redis.sismember(session_store.LIVE_SESSIONS_KEY, '1.b'))
+        self.assertFalse(self.redis.sismember(session_store.timer_index_key(11), '1.b'))
+
+    def test_expired_members_are_pruned(self):
+        # TTLで失効したセッションはインデックスに残るが、参照時に取り除く
+        self.redis.delete(session_store.session_key('1.a'), session_store.session_key('2.c'))
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[1]), ['1.b'])
+        self.assertEqual(self.redis.smembers(session_store.band_index_key(1)), {'1.b'})
+        self.assertEqual(session_store.prune_live_sessions(), 1)
+        self.assertEqual(self.redis.smembers(session_store.LIVE_SESSIONS_KEY), {'1.b'})
+        self.assertEqual(self.redis.scard(session_store.band_index_key(2)), 0)
+        self.assertEqual(session_store.list_timer_sessions(10), [])
+        self.assertEqual(self.redis.scard(session_store.timer_index_key(10)), 0)
+
+
+class StatusRequestTestCase(RedisTestCase):
+    """WebSocketの timer_status_request（購読中のバンドのみ）"""
+
+    def test_only_subscribed_bands(self):
+        band = Band.objects.create(name='バンド')
+        other = Band.objects.create(name='別のバンド')
+        session_store.start_session(f'{band.id}.a', 1, 60, band.id)
+        session_store.start_session(f'{other.id}.b', 1, 60, other.id)
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+            await communicator.connect()
+            await communicator.receive_from()
+            responses = []
+            for band_id in (None, band.id, other.id, f'{other.id}'):
+                await communicator.send_to(json.dumps({'type': 'timer_status_request', 'band_id': band_id}))
+                responses.append(json.loads(await communicator.receive_from()))
+            await communicator.disconnect()
+            return responses
+
+        own, own_explicit, not_subscribed, not_subscribed_str = async_to_sync(run)()
+        self.assertEqual([s['session_id'] for s in own['sessions']], [f'{band.id}.a'])
+        self.assertEqual(own_explicit['sessions'], own['sessions'])
+        for response in (not_subscribed, not_subscribed_str):
+            self.assertEqual(response['type'], 'error')
+            self.assertNotIn('sessions', response)
+
+
+class MetricsTestCase(RedisTestCase):
+    """メトリクス（取得時はRedisを数えるだけで書き換えない）"""
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels)
+
+    def test_live_sessions_by_band(self):
+        band = Band.objects.create(name='バンド')
+        other = Band.objects.create(name='別のバンド')
+        session_store.start_session(f'{band.id}.a', 1, 60, band.id)
+        session_store.start_session(f'{band.id}.b', 1, 60, band.id)
+        session_store.start_session(f'{other.id}.c', 1, 60, other.id)
+        session_store.pause_session(f'{other.id}.c')
+        self.assertEqual(self.sample('timer_live_sessions'), 3)
+        self.assertEqual(self.sample('timer_running_sessions'), 2)
+        self.assertEqual(self.sample('timer_band_live_sessions', band=str(band.id)), 2)
+        self.assertEqual(self.sample('timer_band_live_sessions', band=str(other.id)), 1)
+        # 失効したメンバーは取得では取り除かない（スケジューラの定期処理で取り除く）
+        self.redis.delete(session_store.session_key(f'{band.id}.a'))
+        self.assertEqual(self.sample('timer_band_live_sessions', band=str(band.id)), 2)
+        prune_indexes()
+        self.assertEqual(self.sample('timer_live_sessions'), 2)
+        self.assertEqual(self.sample('timer_band_live_sessions', band=str(band.id)), 1)
+
+    def test_websocket_connections_by_band(self):
+        band = Band.objects.create(name='バンド')
+        other = Band.objects.create(name='別のバンド')
+        before = self.sample('timer_websocket_connections', band=str(other.id)) or 0
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+            await communicator.connect()
+            await communicator.receive_from()
+            await communicator.send_to(json.dumps({'type': 'subscribe', 'band_ids': [other.id]}))
+            await communicator.receive_from()
+            counts = (
+                self.sample('timer_websocket_connections', band=str(band.id)),
+                self.sample('timer_websocket_connections', band=str(other.id)),
+            )
+            await communicator.disconnect()
+            return counts
+
+        self.assertEqual(async_to_sync(run)(), (1, before + 1))
+        self.assertEqual(self.sample('timer_websocket_connections', band=str(band.id)), 0)
+        self.assertEqual(self.sample('timer_websocket_connections', band=str(other.id)), before)
+
+
+@skipIf(fakeredis is None, 'fakeredis が必要')
+class PoolMetricsTestCase(SimpleTestCase):
+    """用途別プールの取得待ち時間・使用中の数・枯渇回数"""
+
+    def sample(self, name, role):
+        return REGISTRY.get_sample_value(name, {'role': role}) or 0
+
+    def test_sync_pool(self):
+        role = 'test_sync'
+        pool = redis_pools.InstrumentedConnectionPool(
+            role=role, connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer(),
+            max_connections=1, timeout=1,
+        )
+        connection = pool.get_connection()
+        self.assertEqual(self.sample('timer_redis_pool_connections_in_use', role), 1)
+
+        # 上限に達している間は空きを待つ（別スレッドが0.2秒後に返却）
+        threading.Timer(0.2, pool.release, [connection]).start()
+        waited = pool.get_connection()
+        self.assertEqual(self.sample('timer_redis_pool_wait_seconds_count', role), 2)
+        self.assertGreaterEqual(self.sample('timer_redis_pool_wait_seconds_sum', role), 0.2)
+        self.assertEqual(self.sample('timer_redis_pool_connections_in_use', role), 1)
+
+        # 待ち時間内に空かなければ枯渇として数える
+        pool.timeout = 0.05
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            pool.get_connection()
+        self.assertEqual(self.sample('timer_redis_pool_exhausted_total', role), 1)
+        pool.release(waited)
+        self.assertEqual(self.sample('timer_redis_pool_connections_in_use', role), 0)
+
+    def test_async_pool(self):
+        role = 'test_async'
+
+        async def run():
+            pool = redis_pools.AsyncInstrumentedConnectionPool(
+                role=role, connection_class=fakeredis.aioredis.FakeConnection, server=fakeredis.FakeServer(),
+                max_connections=1, timeout=0.05,
+            )
+            connection = await pool.get_connection()
+            in_use = self.sample('timer_redis_pool_connections_in_use', role)
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                await pool.get_connection()
+            await pool.release(connection)
+            return in_use
+
+        self.assertEqual(async_to_sync(run)(), 1)
+        self.assertEqual(self.sample('timer_redis_pool_wait_seconds_count', role), 2)
+        self.assertEqual(self.sample('timer_redis_pool_exhausted_total', role), 1)
+        self.assertEqual(self.sample('timer_redis_pool_connections_in_use', role), 0)
+
+
+class ExpiryTestCase(RedisTestCase):
+    """終了通知キーの失効による完了検知（TIMER_COMPLETION_MODE='keyspace'）"""
+
+    def start_due(self, session_id):
+        """終了時刻を1秒過ぎた実行中セッション（終了通知キーはまだ残っている）"""
+        with clock(session_store.now_ms() - 61000):
+            session_store.start_session(session_id, 10, 60, 1)
+
+    def until(self, seconds):
+        deadline = time.monotonic() + seconds
+        return lambda: time.monotonic() > deadline
+
+    def completed_events(self, session_id):
+        return [event for sid, event in self.events() if sid == session_id and event == 'completed']
+
+    def test_deadline_session_id(self):
+        self.assertEqual(expiry.deadline_session_id(session_store.DEADLINE_KEY.format('1.a')), '1.a')
+        self.assertIsNone(expiry.deadline_session_id(session_store.session_key('1.a')))
+
+    def test_expired_key_completes_once(self):
+        self.start_due('1.a')
+        key = session_store.DEADLINE_KEY.format('1.a')
+        shard = redis_client.shard_urls()[0]
+        channel = expiry.expired_channel(self.redis)
+        stop = threading.Event()
+        listener = threading.Thread(target=expiry._listen, args=(shard, stop.is_set))
+        listener.start()
+        self.addCleanup(listener.join)
+        self.addCleanup(stop.set)
+        while self.redis.pubsub_numsub(channel)[0][1] == 0:
+            time.sleep(0.01)
+        self.redis.pexpire(key, 1)
+        time.sleep(0.01)
+        self.assertFalse(self.redis.exists(key))
+        # fakeredis は失効通知を発行しないため、Redisと同じ通知を送る（重複して届いても完了は1回）
+        self.redis.publish(channel, key)
+        self.redis.publish(channel, key)
+        self.redis.publish(channel, session_store.session_key('1.a'))  # 対象外のキー
+        for _ in range(100):
+            if session_store.load_session('1.a')['status'] == 'completed':
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(session_store.load_session('1.a')['status'], 'completed')
+        self.assertEqual(self.completed_events('1.a'), ['completed'])
+        self.assertIsNone(self.deadline('1.a'))
+        expiry.handle_expired(key)
+        self.assertEqual(self.completed_events('1.a'), ['completed'])
+
+    @override_settings(TIMER_EXPIRY_SWEEP_INTERVAL=0.05)
+    def test_sweep_completes_missed_notification(self):
+        self.start_due('1.a')
+        # 通知を取りこぼした（キーは失効済み、通知は届かない）
+        self.redis.delete(session_store.DEADLINE_KEY.format('1.a'))
+        expiry.run_expiry_listener(stop=self.until(0.3))
+        self.assertEqual(session_store.load_session('1.a')['status'], 'completed')
+        self.assertEqual(TimerSessionEvent.objects.filter(session_id='1.a', event='completed').count(), 1)
+
+
+class BatchControlTestCase(RedisTestCase):
+    """一括開始・一時停止・再開（1パイプライン、失敗はセッションごと）"""
+
+    def post(self, action, data):
+        url = reverse('timer_core:batch_control', args=[action])
+        return self.client.post(url, json.dumps(data), content_type='application/json').json()
+
+    def test_batch_api(self):
+        create_bands(2, 3)
+        band = Band.objects.get(name='バンド0')
+        data = self.post('start', {'band_id': band.id})
+        self.assertTrue(data['success'])
+        session_ids = [s['session_id'] for s in data['sessions']]
+        self.assertEqual(len(session_ids), 3)
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[band.id]), sorted(session_ids))
+
+        session_store.pause_session(session_ids[0])
+        data = self.post('pause', {'band_id': band.id})
+        self.assertEqual(sorted(s['session_id'] for s in data['sessions']), sorted(session_ids[1:]))
+        self.assertEqual(list(data['errors']), [session_ids[0]])
+
+        data = self.post('resume', {'session_ids': session_ids + [f'{band.id}.missing']})
+        self.assertEqual(len(data['sessions']), 3)
+        self.assertEqual(list(data['errors']), [f'{band.id}.missing'])
+
+    def test_noscript_retry(self):
+        # Redis再起動などでスクリプトが消えていても、登録し直して該当分だけ再実行する
+        session_store.start_sessions([('1.a', 10, 60, 1), ('1.b', 10, 60, 1)])
+        self.redis.script_flush()
+        sessions, errors = session_store.transition_sessions('pause', ['1.a', '1.b'])
+        self.assertEqual([s['status'] for s in sessions], ['paused', 'paused'])
+        self.assertEqual(errors, {})
+        self.redis.script_flush()
+        data = self.post('resume', {'session_ids': ['1.a', '1.b']})
+        self.assertEqual([s['status'] for s in data['sessions']], ['running', 'running'])
+
+
+class RunsheetTestCase(RedisTestCase):
+    """ランシート（区間の連結と自動進行）"""
+
+    def setUp(self):
+        super().setUp()
+        create_bands(1, 3)  # 各5分
+        self.band = Band.objects.get()
+
+    def start(self, at_ms):
+        with mock.patch.object(runsheet, 'now_ms', return_value=at_ms):
+            return async_to_sync(runsheet.astart_runsheet)(self.band.id)
+
+    def test_chaining(self):
+        started_at = session_store.now_ms() - 301000  # 先頭区間は1秒前に終了済み
+        timeline = self.start(started_at)
+        first, second, third = [s['session_id'] for s in timeline['segments']]
+        self.assertEqual([s['status'] for s in timeline['segments']], ['running', 'scheduled', 'scheduled'])
+        # スケジューラに登録するのは実行中の区間のみ
+        self.assertEqual(self.redis.zrange(session_store.DEADLINES_KEY, 0, -1), [first])
+
+        self.assertEqual(process_due(), 1)
+        timeline = async_to_sync(runsheet.aget_runsheet)(self.band.id)
+        self.assertEqual([s['status'] for s in timeline['segments']], ['completed', 'running', 'scheduled'])
+        # 次区間は前区間の終了時刻ちょうどに開始する
+        self.assertEqual(timeline['segments'][1]['start_ms'], started_at + 300000)
+        self.assertEqual(timeline['segments'][2]['start_ms'], started_at + 600000)
+        self.assertEqual(self.redis.zrange(session_store.DEADLINES_KEY, 0, -1), [second])
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[self.band.id]), [second])
+
+        async_to_sync(runsheet.askip_runsheet)(self.band.id)
+        timeline = async_to_sync(runsheet.apause_runsheet)(self.band.id)
+        self.assertEqual([s['status'] for s in timeline['segments']], ['completed', 'completed', 'paused'])
+        self.assertEqual((timeline['status'], timeline['current_index']), ('paused', 2))
+        self.assertEqual(self.redis.zcard(session_store.DEADLINES_KEY), 0)
+        self.assertEqual(session_store.resolve_session_ids(band_ids=[self.band.id]), [third])
+
+    def test_start_while_running(self):
+        self.start(session_store.now_ms())
+        with self.assertRaises(TransitionError):
+            self.start(session_store.now_ms())
+
+
+class WriteBehindTestCase(RedisTestCase):
+    """セッションイベントのDBへの一括保存"""
+
+    def test_flush(self):
+        create_bands(1, 1)
+        timer = Timer.objects.get()
+        session_store.start_session(f'{timer.band_id}.a', timer.id, 60, timer.band_id)
+        session_store.pause_session(f'{timer.band_id}.a')
+        self.assertEqual(flush_session_events(), 2)
+        self.assertEqual(self.redis.llen(session_store.EVENTS_KEY), 0)
+        # セッションは保存時点のRedisの状態（最新）
+        session = TimerSession.objects.get()
+        self.assertEqual((session.status, session.version, session.band_id), ('paused', 2, timer.band_id))
+        self.assertEqual(
+            list(TimerSessionEvent.objects.values_list('event', 'version')), [('started', 1), ('paused', 2)]
+        )
+        session_store.resume_session(f'{timer.band_id}.a')
+        self.assertEqual(flush_session_events(), 1)
+        self.assertEqual(TimerSession.objects.get().status, 'running')
+
+    def test_failed_flush_is_retried(self):
+        session_store.start_session('1.a', 10, 60, 1)
+        session_store.start_session('1.b', 10, 60, 1)
+        records = self.redis.lrange(session_store.EVENTS_KEY, 0, -1)
+        with mock.patch.object(TimerSessionEvent.objects, 'bulk_create', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                flush_session_events()
+        # 取り出したイベントは元の順序で先頭に戻る
+        self.assertEqual(self.redis.lrange(session_store.EVENTS_KEY, 0, -1), records)
+        self.assertFalse(TimerSession.objects.exists())
+        self.assertEqual(flush_session_events(), 2)
+        self.assertEqual(TimerSession.objects.count(), 2)
+
+
+class RehydrateTestCase(RedisTestCase):
+    """保存済みセッション・ランシートのRedisへの復元"""
+
+    def test_rehydrate(self):
+        create_bands(1, 3)
+        band = Band.objects.get()
+        timer = Timer.objects.filter(band=band).first()
+        async_to_sync(runsheet.astart_runsheet)(band.id)
+        async_to_sync(runsheet.askip_runsheet)(band.id)
+        session_store.start_session(f'{band.id}.single', timer.id, 60, band.id)
+        session_store.pause_session(f'{band.id}.single')
+        flush_session_events()
+        before = async_to_sync(runsheet.aget_runsheet)(band.id)
+        paused_ttl = self.redis.pttl(session_store.session_key(f'{band.id}.single'))
+
+        self.redis.flushall()
+        self.assertEqual(rehydrate_sessions(), (3, 3))
+        after = async_to_sync(runsheet.aget_runsheet)(band.id)
+        # 完了済みの区間のハッシュは戻らないが、区間の並びと現在の区間は同じ
+        self.assertEqual([s['session_id'] for s in after['segments']], [s['session_id'] for s in before['segments']])
+        self.assertEqual([s['status'] for s in after['segments'][1:]], ['running', 'scheduled'])
+        self.assertEqual(self.redis.zrange(session_store.DEADLINES_KEY, 0, -1), [before['segments'][1]['session_id']])
+        self.assertEqual(
+            session_store.resolve_session_ids(band_ids=[band.id]),
+            sorted([before['segments'][1]['session_id'], f'{band.id}.single']),
+        )
+        # 一時停止中の期限は延ばさない
+        self.assertLessEqual(self.redis.pttl(session_store.session_key(f'{band.id}.single')), paused_ttl)
+        # Redisに残っているものはそのまま
+        self.assertEqual(rehydrate_sessions(), (3, 0))
+
+    def test_stale_sessions_expire(self):
+        now = session_store.now_ms()
+        old = now - (session_store.SESSION_TIMEOUT + 120) * 1000
+        TimerSession.objects.create(
+            session_id='1.paused', band_id=1, status='paused', start_ms=old - 60000, end_ms=old,
+            paused_ms=old - 30000, total_seconds=60, version=2,
+        )
+        TimerSession.objects.create(
+            session_id='1.scheduled', band_id=1, status='scheduled',
+            start_ms=now - (runsheet.RUNSHEET_TIMEOUT + 60) * 1000, end_ms=now, total_seconds=60,
+        )
+        TimerSession.objects.create(
+            session_id='1.running', band_id=1, status='running', start_ms=old - 60000, end_ms=old, total_seconds=60,
+        )
+        self.assertEqual(rehydrate_sessions(), (1, 1))
+        self.assertEqual(
+            dict(TimerSession.objects.values_list('session_id', 'status')),
+            {'1.paused': 'expired', '1.scheduled': 'expired', '1.running': 'running'},
+        )
+        self.assertEqual(
+            sorted(TimerSessionEvent.objects.filter(event='expired').values_list('session_id', 'version')),
+            [('1.paused', 3), ('1.scheduled', 2)],
+        )
+        self.assertFalse(self.redis.exists(session_store.session_key('1.paused')))
+        # 停止中に終了時刻を過ぎた実行中セッションは、スケジューラが直後に完了させる
+        self.assertEqual(process_due(), 1)
+        self.assertEqual(session_store.load_session('1.running')['status'], 'completed')
+
+
+class DeclaredKeysTestCase(RedisTestCase):
+    """Luaスクリプトが書き換えるキーは、すべて KEYS で渡している"""
+
+    def setUp(self):
+        super().setUp()
+        create_bands(1, 2)
+        self.band = Band.objects.get()
+        self.timer = Timer.objects.filter(band=self.band).first()
+        self.declared = set()
+        script_calls, call, acall = redis_client._script_calls, redis_client.LuaScript.__call__, \
+            redis_client.LuaScript.acall
+
+        def record_calls(pipe, calls):
+            for _, keys, _ in calls:
+                self.declared.update(keys)
+            script_calls(pipe, calls)
+
+        def record_call(script, client, keys, args):
+            self.declared.update(keys)
+            return call(script, client, keys, args)
+
+        async def record_acall(script, client, keys, args):
+            self.declared.update(keys)
+            return await acall(script, client, keys, args)
+
+        for target, name, replacement in (
+            (redis_client, '_script_calls', record_calls),
+            (redis_client.LuaScript, '__call__', record_call),
+            (redis_client.LuaScript, 'acall', record_acall),
+        ):
+            patcher = mock.patch.object(target, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def snapshot(self):
+        """全キーの型と値"""
+        read = {
+            'hash': self.redis.hgetall, 'set': self.redis.smembers, 'list': lambda key: self.redis.lrange(key, 0, -1),
+            'zset': lambda key: self.redis.zrange(key, 0, -1, withscores=True), 'string': self.redis.get,
+        }
+        return {key: (self.redis.type(key), read[self.redis.type(key)](key)) for key in self.redis.keys('*')}
+
+    def assert_declared(self, operation):
+        before = self.snapshot()
+        self.declared.clear()
+        operation()
+        after = self.snapshot()
+        changed = {key for key in before.keys() | after.keys() if before.get(key) != after.get(key)}
+        self.assertTrue(changed)
+        self.assertLessEqual(changed, self.declared)
+
+    def test_session_scripts(self):
+        session_id = f'{self.band.id}.single'
+        self.assert_declared(lambda: session_store.start_session(session_id, self.timer.id, 60, self.band.id))
+        self.assert_declared(lambda: session_store.pause_session(session_id))
+        self.assert_declared(lambda: session_store.resume_session(session_id))
+        self.assert_declared(lambda: session_store.complete_session(session_id, force=True))
+
+    def test_runsheet_and_rehydrate_scripts(self):
+        started_at = session_store.now_ms() - 301000
+        with mock.patch.object(runsheet, 'now_ms', return_value=started_at):
+            self.assert_declared(lambda: async_to_sync(runsheet.astart_runsheet)(self.band.id))
+        # 先頭区間の完了と次区間の起動
+        self.assert_declared(process_due)
+        self.assert_declared(lambda: async_to_sync(runsheet.askip_runsheet)(self.band.id))
+        # 完了済みのランシートがある状態での再開始
+        self.assert_declared(lambda: async_to_sync(runsheet.astart_runsheet)(self.band.id))
+
+        flush_session_events()
+        self.redis.flushall()
+        self.assert_declared(rehydrate_sessions)
+
+
+@NO_REDIS
+class AsyncioBackendTestCase(TestCase):
+    """プロセス内のasyncioエンジン（call_at による完了・一時停止と再開・ランシートの連結）"""
+
+    def setUp(self):
+        self.backend = AsyncioBackend()
+        create_bands(1, 2)  # 各5分
+        self.band = Band.objects.get()
+        self.timer = Timer.objects.filter(band=self.band).first()
+
+    def ending_in(self, ms, total_seconds):
+        """開始時刻（最初に読む現在時刻）だけを過去にずらし、終了時刻を ms ミリ秒後にする"""
+        started = [session_store.now_ms() + ms - total_seconds * 1000]
+        return mock.patch.object(
+            asyncio_engine, 'now_ms', side_effect=lambda: started.pop() if started else session_store.now_ms()
+        )
+
+    async def listen(self):
+        """バンドグループの配信を受け取る関数"""
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(band_group_name(self.band.id), channel)
+
+        async def receive(timeout=2):
+            message = await asyncio.wait_for(layer.receive(channel), timeout)
+            data = json.loads(message['text'])['data']
+            return data['event'], data
+
+        return receive
+
+    def test_call_at_completes(self):
+        async def run():
+            receive = await self.listen()
+            with self.ending_in(100, 60):
+                await self.backend.start_session('1.a', self.timer.id, 60, self.band.id)
+            deadline = self.backend.handles['1.a']
+            event, data = await receive()
+            return deadline, event, data
+
+        deadline, event, data = async_to_sync(run)()
+        self.assertEqual((event, data['session_id'], data['status'], data['version']), ('completed', '1.a', 'completed', 2))
+        # 完了後は終了時刻の予約ではなく保持期間後の破棄の予約
+        self.assertIsNot(self.backend.handles['1.a'], deadline)
+        self.assertEqual(self.backend.band_index[self.band.id], set())
+
+    def test_pause_resume_reschedules(self):
+        async def run():
+            receive = await self.listen()
+            with self.ending_in(150, 60):
+                started = await self.backend.start_session('1.a', self.timer.id, 60, self.band.id)
+            deadline = self.backend.handles['1.a']
+            await self.backend.pause_session('1.a')
+            self.assertTrue(deadline.cancelled())
+            # 一時停止中は終了時刻を過ぎても完了しない
+            with self.assertRaises(asyncio.TimeoutError):
+                await receive(timeout=0.3)
+            self.assertEqual((await self.backend.get_session_status('1.a'))['status'], 'paused')
+            resumed = await self.backend.resume_session('1.a')
+            event, data = await receive()
+            return started, resumed, event, data
+
+        started, resumed, event, data = async_to_sync(run)()
+        self.assertGreaterEqual(resumed['end_ms'] - started['end_ms'], 300)
+        self.assertEqual((event, data['end_ms'], data['version']), ('completed', resumed['end_ms'], 4))
+
+    def test_runsheet_chaining_and_skip(self):
+        async def run():
+            receive = await self.listen()
+            with self.ending_in(100, 300):
+                timeline = await self.backend.start_runsheet(self.band.id)
+            first, second = [s['session_id'] for s in timeline['segments']]
+            events = [await receive() for _ in range(3)]  # 開始・完了・次区間の開始
+            second_deadline = self.backend.handles[second]
+            await self.backend.skip_runsheet(self.band.id)
+            events += [await receive()]
+            with self.assertRaises(asyncio.TimeoutError):
+                await receive(timeout=0.2)
+            return first, second, events, second_deadline, await self.backend.get_runsheet(self.band.id)
+
+        first, second, events, second_deadline, timeline = async_to_sync(run)()
+        self.assertEqual(
+            [(event, data['session_id']) for event, data in events],
+            [('started', first), ('completed', first), ('started', second), ('completed', second)],
+        )
+        # 次区間は前区間の終了時刻ちょうどに開始する
+        self.assertEqual(events[2][1]['end_ms'] - 300000, events[1][1]['end_ms'])
+        # スキップで終了時刻の予約を取り消す
+        self.assertTrue(second_deadline.cancelled())
+        self.assertEqual([s['status'] for s in timeline['segments']], ['completed', 'completed'])
+        self.assertEqual(timeline['status'], 'completed')
+
+
+class ShardingTestCase(SimpleTestCase):
+    """band_id によるノードの振り分け（ハッシュリング）"""
+
+    NODES = [f'redis://redis-{index}:6379/0' for index in range(4)]
+
+    def test_same_key_same_node(self):
+        keys = [band_shard_key(band_id) for band_id in range(1000)]
+        # 別に作ったリング・ノードの並び順が違うリングでも同じノード
+        nodes = [[ring.node_for(key) for key in keys] for ring in (
+            HashRing(self.NODES), HashRing(self.NODES), HashRing(self.NODES[::-1])
+        )]
+        self.assertEqual(nodes[0], nodes[1])
+        self.assertEqual(nodes[0], nodes[2])
+        self.assertEqual(len(set(nodes[0])), 4)
+
+    def test_adding_node_moves_about_one_nth(self):
+        before, after = HashRing(self.NODES[:3]), HashRing(self.NODES)
+        keys = [band_shard_key(band_id) for band_id in range(10000)]
+        moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+        # 移動するのは追加したノードへの分（約1/4）のみ
+        self.assertTrue(0.2 < len(moved) / len(keys) < 0.3, len(moved))
+        self.assertEqual({after.node_for(key) for key in moved}, {self.NODES[3]})
+
+    @override_settings(TIMER_REDIS_SHARDS=NODES)
+    def test_sessions_and_groups_share_a_node(self):
+        layer = ShardedChannelLayer(hosts=[{'address': url} for url in self.NODES])
+        for band_id in range(1, 200):
+            node = layer._host_names[layer.consistent_hash(band_group_name(band_id))]
+            self.assertEqual(node, band_shard(band_id))
+            self.assertEqual(node, session_shard(new_session_id(band_id)))
+            self.assertEqual(node, layer._host_names[layer.consistent_hash(band_group_name(band_id).encode())])
+
+
+class BackpressureTestCase(SimpleTestCase):
+    """受信のトークンバケット・送信キュー・受信確認のウィンドウ"""
+
+    def test_token_bucket(self):
+        with mock.patch.object(backpressure.time, 'monotonic', return_value=100.0) as monotonic:
+            bucket = TokenBucket(rate=2, burst=3)
+            self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+            monotonic.return_value = 100.5  # 0.5秒で1トークン補充
+            self.assertEqual([bucket.consume(), bucket.consume()], [True, False])
+            monotonic.return_value = 110.0
+            self.assertTrue(bucket.full)
+
+    def test_outbound_queue_coalescing(self):
+        queue = OutboundQueue(maxsize=3)
+        self.assertFalse(queue.put('a1', key='a'))
+        self.assertFalse(queue.put('x'))
+        # 同じセッションの未送信フレームは最新の状態で置き換える（位置はそのまま）
+        self.assertTrue(queue.put('a2', key='a'))
+        self.assertFalse(queue.put('b1', key='b'))
+        self.assertTrue(queue.put('b2', key='b'))
+        with self.assertRaises(QueueFull):
+            queue.put('y')
+        self.assertEqual([async_to_sync(queue.get)() for _ in range(3)], ['a2', 'x', 'b2'])
+
+    def test_ack_window(self):
+        window = AckWindow(2)
+
+        async def send_three():
+            sent = []
+            for frame in range(3):
+                await asyncio.wait_for(window.wait(), 0.05)
+                window.on_send()
+                sent.append(frame)
+            return sent
+
+        # 最初の ack までは上限を適用しない
+        self.assertEqual(async_to_sync(send_three)(), [0, 1, 2])
+        self.assertTrue(window.ack(3))
+        with self.assertRaises(asyncio.TimeoutError):
+            async_to_sync(send_three)()
+        self.assertEqual(window.in_flight, 2)
+        window = AckWindow(2)
+        window.on_send()
+        window.on_send()
+        window.ack(0)  # 未確認が上限に達した状態で ack を返し始めた
+        with self.assertRaises(asyncio.TimeoutError):
+            async_to_sync(send_three)()
+        self.assertFalse(window.ack(3))      # 送信数を超える
+        self.assertFalse(window.ack('1'))    # 整数以外
+        self.assertTrue(window.ack(1))
+        self.assertFalse(window.ack(0))      # 減少
+        async_to_sync(window.wait)()
+        self.assertEqual(window.in_flight, 1)
+
+
+class SlowConsumerTestCase(RedisTestCase):
+    """受信確認を返す接続は、確認が止まると送信キューが溢れた時点で切断する（返さない接続には適用しない）"""
+
+    @override_settings(TIMER_WS_ACK_WINDOW=4, TIMER_WS_SEND_QUEUE_SIZE=3)
+    def test_slow_consumer_is_closed(self):
+        band = Band.objects.create(name='バンド')
+
+        async def run(ack_until):
+            """受信累計が ack_until 以下の間だけ2件ごとに ack を返す（None なら一度も返さない）"""
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+            await communicator.connect()
+            received, closed = 1, None
+            established = json.loads(await communicator.receive_from())
+            self.assertEqual(established['ack_window'], 4)
+            for index in range(20):
+                session_id = f'{band.id}.{ack_until}-{index}'
+                session_data = await session_store.astart_session(session_id, 1, 60, band.id)
+                await abroadcast_session(session_id, session_data, 'started')
+                await asyncio.sleep(0.01)
+                while not communicator.output_queue.empty():
+                    message = communicator.output_queue.get_nowait()
+                    if message['type'] == 'websocket.close':
+                        closed = message['code']
+                        break
+                    received += 1
+                    if ack_until is not None and received <= ack_until and received % 2 == 0:
+                        await communicator.send_to(json.dumps({'type': 'ack', 'received': received}))
+                if closed:
+                    break
+            await communicator.disconnect()
+            return received, closed
+
+        self.assertEqual(async_to_sync(run)(100), (21, None))
+        # ack を一度も返さない接続（キャッシュされた旧画面など）は止めない
+        self.assertEqual(async_to_sync(run)(None), (21, None))
+        # 6件目で確認が止まる：未確認のフレームが上限（4）に達した後、送信キュー（3）が溢れて切断
+        received, closed = async_to_sync(run)(6)
+        self.assertEqual(closed, CLOSE_SLOW_CONSUMER)
+        self.assertEqual(received, 10)
+
+
+class ResumeTestCase(RedisTestCase):
+    """再接続時の購読の復元（再開トークン）と差分（timer_delta）"""
+
+    def test_resume_token(self):
+        token = resume_token({'3', '1'})
+        self.assertEqual(resume_band_ids(token), ['1', '3'])
+        # 購読バンド（[2]）の書き換え
+        self.assertIsNone(resume_band_ids('WzJd' + token[token.index(':'):]))
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 7200):
+            self.assertIsNone(resume_band_ids(token))
+
+    def test_delta(self):
+        band = Band.objects.create(name='バンド')
+        other = Band.objects.create(name='別のバンド')
+        for name in ('changed', 'same', 'new'):
+            session_store.start_session(f'{band.id}.{name}', 1, 60, band.id)
+        session_store.start_session(f'{other.id}.other', 1, 60, other.id)
+        session_store.pause_session(f'{band.id}.changed')
+        session_store.pause_session(f'{other.id}.other')
+        versions = {
+            f'{band.id}.changed': 1, f'{band.id}.same': 1, f'{band.id}.gone': 1,
+            f'{other.id}.other': 1,  # 購読していないバンド
+        }
+
+        async def run():
+            path = f'/ws/timer/?resume={resume_token([band.id, 999999])}'
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+            await communicator.connect()
+            established = json.loads(await communicator.receive_from())
+            await communicator.send_to(json.dumps({'type': 'resume', 'versions': versions}))
+            delta = json.loads(await communicator.receive_from())
+            await communicator.disconnect()
+            return established, delta
+
+        established, delta = async_to_sync(run)()
+        # 削除済みのバンドは復元しない
+        self.assertTrue(established['resumed'])
+        self.assertEqual(established['band_ids'], [band.id])
+        self.assertEqual(
+            sorted((s['session_id'], s['event']) for s in delta['sessions']),
+            [(f'{band.id}.changed', 'resync'), (f'{band.id}.new', 'started')],
+        )
+        self.assertEqual(delta['removed'], [f'{band.id}.gone'])
+
+
+@NO_REDIS
+class ClockSyncTestCase(TestCase):
+    """WebSocketの ping/pong による時刻合わせ（NTP方式）"""
+
+    def test_ping_pong(self):
+        band = Band.objects.create(name='バンド')
+        # クライアントの時計はサーバーより5秒遅れ、片道20ms、サーバー内の処理2ms
+        client_send_ms, server_recv_ms, server_send_ms = 1000000, 1005020, 1005022
+        client_recv_ms = server_send_ms - 5000 + 20
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+            await communicator.connect()
+            established = json.loads(await communicator.receive_from())
+            with mock.patch.object(consumers, 'now_ms', side_effect=[server_recv_ms, server_send_ms]):
+                await communicator.send_to(json.dumps({'type': 'ping', 'timestamp': client_send_ms}))
+                pong = json.loads(await communicator.receive_from())
+            await communicator.disconnect()
+            return established, pong
+
+        established, pong = async_to_sync(run)()
+        self.assertIn('server_ms', established)
+        self.assertEqual(pong, {
+            'type': 'pong', 'timestamp': client_send_ms,
+            'server_recv_ms': server_recv_ms, 'server_send_ms': server_send_ms,
+        })
+        offset = ((pong['server_recv_ms'] - pong['timestamp']) + (pong['server_send_ms'] - client_recv_ms)) / 2
+        rtt = (client_recv_ms - pong['timestamp']) - (pong['server_send_ms'] - pong['server_recv_ms'])
+        self.assertEqual((offset, rtt), (5000, 40))
+
+
+@skipIf(msgpack is None, 'msgpack が必要')
+class MsgpackSubprotocolTestCase(RedisTestCase):
+    """サブプロトコル timer.msgpack を選んだ接続はバイナリフレームで送受信する"""
+
+    def test_binary_frames(self):
+        band = Band.objects.create(name='バンド')
+
+        async def run():
+            binary = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/', subprotocols=[MSGPACK_SUBPROTOCOL]
+            )
+            text = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+            _, subprotocol = await binary.connect()
+            await text.connect()
+            established = msgpack.unpackb(await binary.receive_from())
+            await text.receive_from()
+
+            session_data = await session_store.astart_session(f'{band.id}.a', 1, 60, band.id)
+            await abroadcast_session(f'{band.id}.a', session_data, 'started')
+            binary_update = await binary.receive_output()
+            text_update = await text.receive_output()
+
+            await binary.send_to(bytes_data=msgpack.packb({'type': 'ping', 'timestamp': 1}))
+            pong = msgpack.unpackb(await binary.receive_from())
+            await binary.disconnect()
+            await text.disconnect()
+            return subprotocol, established, binary_update, text_update, pong
+
+        subprotocol, established, binary_update, text_update, pong = async_to_sync(run)()
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        self.assertEqual(established['type'], 'connection_established')
+        # 同じ配信が、形式ごとにエンコード済みのフレームで届く
+        self.assertNotIn('text', binary_update)
+        self.assertNotIn('bytes', text_update)
+        self.assertEqual(msgpack.unpackb(binary_update['bytes']), json.loads(text_update['text']))
+        self.assertEqual(msgpack.unpackb(binary_update['bytes'])['data']['session_id'], f'{band.id}.a')
+        self.assertEqual((pong['type'], pong['timestamp']), ('pong', 1))
+
+
+class MultiplexTestCase(RedisTestCase):
+    """1接続で複数バンドを購読（subscribe / unsubscribe）"""
+
+    @override_settings(TIMER_WS_MAX_SUBSCRIPTIONS=2)
+    def test_subscribe_unsubscribe(self):
+        first, second, third = (Band.objects.create(name=f'バンド{i}') for i in range(3))
+
+        async def broadcast(band, name):
+            session_id = f'{band.id}.{name}'
+            session_data = await session_store.astart_session(session_id, 1, 60, band.id)
+            await abroadcast_session(session_id, session_data, 'started')
+
+        async def request(communicator, message):
+            await communicator.send_to(json.dumps(message))
+            return json.loads(await communicator.receive_from())
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/timer/')
+            await communicator.connect()
+            established = json.loads(await communicator.receive_from())
+            responses = [
+                await request(communicator, {'type': 'subscribe', 'band_ids': [first.id, second.id]}),
+                await request(communicator, {'type': 'subscribe', 'band_ids': [999999]}),
+                await request(communicator, {'type': 'subscribe', 'band_ids': [third.id]}),
+            ]
+            await broadcast(first, 'a')
+            await broadcast(second, 'b')
+            updates = [json.loads(await communicator.receive_from()) for _ in range(2)]
+
+            responses.append(await request(communicator, {'type': 'unsubscribe', 'band_ids': [first.id]}))
+            await broadcast(first, 'c')
+            await broadcast(second, 'd')
+            after = json.loads(await communicator.receive_from())
+            nothing_else = await communicator.receive_nothing()
+            await communicator.disconnect()
+            return established, responses, updates, after, nothing_else
+
+        established, responses, updates, after, nothing_else = async_to_sync(run)()
+        self.assertEqual(established['band_ids'], [])
+        subscribed, unknown, over_limit, unsubscribed = responses
+        self.assertEqual(subscribed['band_ids'], [first.id, second.id])
+        self.assertEqual(resume_band_ids(subscribed['resume_token']), [str(first.id), str(second.id)])
+        # 不明なバンド・上限超過は購読を変えずにエラー
+        self.assertEqual((unknown['type'], unknown['band_ids']), ('error', [999999]))
+        self.assertEqual(over_limit['type'], 'error')
+        # 各バンドの配信は band_id 付きで届く
+        self.assertEqual(
+            sorted((u['band_id'], u['data']['session_id']) for u in updates),
+            [(first.id, f'{first.id}.a'), (second.id, f'{second.id}.b')],
+        )
+        self.assertEqual(unsubscribed['band_ids'], [second.id])
+        self.assertEqual(after['data']['session_id'], f'{second.id}.d')
+        self.assertTrue(nothing_else)
+
+
+class AdmissionTestCase(RedisTestCase):
+    """新規接続の受け入れ枠を超えた接続は retry_after_ms を送って 1013 で切断する"""
+
+    def setUp(self):
+        super().setUp()
+        consumers._admission = None
+        self.addCleanup(setattr, consumers, '_admission', None)
+
+    @override_settings(TIMER_WS_ADMIT_RATE=0.001, TIMER_WS_ADMIT_BURST=2,
+                       TIMER_WS_RETRY_MIN_MS=1000, TIMER_WS_RETRY_MAX_MS=2000)
+    def test_admission(self):
+        band = Band.objects.create(name='バンド')
+        closed_before = REGISTRY.get_sample_value('timer_websocket_closed_total', {'reason': 'admission'}) or 0
+
+        async def run():
+            communicators, replies = [], []
+            for _ in range(3):
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/timer/{band.id}/')
+                await communicator.connect()
+                replies.append(json.loads(await communicator.receive_from()))
+                communicators.append(communicator)
+            sockets = REGISTRY.get_sample_value('timer_websocket_sockets')
+            close = await communicators[2].receive_output()
+            for communicator in communicators[:2]:
+                await communicator.disconnect()
+            return replies, sockets, close
+
+        sockets_before = REGISTRY.get_sample_value('timer_websocket_sockets')
+        replies, sockets, close = async_to_sync(run)()
+        self.assertEqual([reply['type'] for reply in replies], ['connection_established'] * 2 + ['retry'])
+        self.assertTrue(1000 <= replies[2]['retry_after_ms'] <= 2000)
+        self.assertEqual(close, {'type': 'websocket.close', 'code': CLOSE_TRY_AGAIN})
+        # 切断した接続は数えない（グループにも参加しない）
+        self.assertEqual(sockets, sockets_before + 2)
+        self.assertEqual(
+            REGISTRY.get_sample_value('timer_websocket_closed_total', {'reason': 'admission'}), closed_before + 1
+        )
@@ -11,6 +11,15 @@ urlpatterns = [
     path('api/timer-status/<str:session_id>/', views.timer_status, name='timer_status'),  # タイマー状態API
     path('api/pause-timer/<str:session_id>/', views.pause_timer, name='pause_timer'),    # タイマー一時停止API
     path('api/resume-timer/<str:session_id>/', views.resume_timer, name='resume_timer'),  # タイマー再開API
+    path('api/schedule/', views.timer_schedule, name='timer_schedule'),  # タイマー構成API（ページング・ETag）
+    path('api/bands/<int:band_id>/sessions/', views.band_sessions, name='band_sessions'),  # バンドの稼働中セッション一覧API
+    path('api/bands/<int:band_id>/reorder/', views.reorder_band_timers, name='reorder_band_timers'),  # タイマー並び替えAPI
+    path('api/batch/<str:action>/', views.batch_control, name='batch_control'),  # 一括開始・一時停止・再開API
+    path('api/bands/<int:band_id>/runsheet/', views.runsheet_status, name='runsheet_status'),  # ランシート時間割API
+    path('api/bands/<int:band_id>/runsheet/<str:action>/', views.runsheet_control, name='runsheet_control'),  # ランシート操作API
+    
+    # 監視
+    path('metrics', views.metrics, name='metrics'),  # Prometheusメトリクス
     
     # テスト用エンドポイント
     path('api/test-celery/', views.test_celery_connection, name='test_celery'),  # Celery接続テスト
@@ -1,26 +1,41 @@
+from django.conf import settings
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.cache import cache_control
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import json
-import uuid
 import logging
 from .models import Band, Timer
-from .tasks import start_timer_session, get_timer_status, pause_timer_session, resume_timer_session, test_celery
+from .tasks import test_celery
+from .backends import get_backend
+from .session_store import TransitionError, new_session_id
+from .broadcast import abroadcast_session, abroadcast_batch
+from .metrics import observe_view
+from .metadata_cache import aget_timer_info
+from .schedule import (
+    ScheduleError, reorder_timers, schedule_params, aschedule_page, schedule_etag, aschedule_bands,
+)
 
 logger = logging.getLogger(__name__)
 
+@cache_control(public=True, max_age=settings.TIMER_PAGE_MAX_AGE)
 def timer_main(request):
-    """メインタイマー画面"""
-    # 全ての有効なタイマーを取得
-    timers = Timer.objects.filter(is_active=True).select_related('band').order_by('band__name', 'order')
-    
-    return render(request, 'timer_core/timer_main.html', {
-        'timers': timers
-    })
+    """
+    メインタイマー画面（データを含まないページ。DBを参照しない）
+    タイマー一覧はページ側で構成API（/api/schedule/）から取得する
+    """
+    return render(request, 'timer_core/timer_main.html')
+
+def async_csrf_exempt(view_func):
+    """csrf_exemptの非同期ビュー版（Django 4.2のcsrf_exemptはコルーチンを包めないため）"""
+    view_func.csrf_exempt = True
+    return view_func
 
-@csrf_exempt
-def start_timer(request):
+@async_csrf_exempt
+@observe_view
+async def start_timer(request):
     """タイマー開始API"""
     if request.method == 'POST':
         try:
@@ -29,32 +44,28 @@ def start_timer(request):
             
             logger.info(f"タイマー開始リクエスト: timer_id={timer_id}")
             
-            # タイマー情報取得
-            timer = Timer.objects.get(id=timer_id)
-            total_seconds = timer.duration_minutes * 60
+            # タイマー情報取得（プロセス内キャッシュ。バンド名を含む）
+            timer = await aget_timer_info(timer_id)
+            if timer is None:
+                raise Timer.DoesNotExist
+            total_seconds = timer['duration_minutes'] * 60
             
             # セッションID生成
-            session_id = str(uuid.uuid4())
-            
-            logger.info(f"タイマー開始: timer_id={timer_id}, duration={timer.duration_minutes}分, session_id={session_id}")
+            session_id = new_session_id(timer['band_id'])
             
-            # 🔧 新しいタスクでタイマー開始
-            result = start_timer_session.delay(session_id, timer_id, total_seconds)
+            logger.info(f"タイマー開始: timer_id={timer_id}, duration={timer['duration_minutes']}分, session_id={session_id}")
             
-            # タスクの完了を待機（短時間）
-            try:
-                task_result = result.get(timeout=10)  # 10秒でタイムアウト
-                logger.info(f"タイマー開始タスク完了: {task_result}")
-            except Exception as e:
-                logger.warning(f"タスク完了待機エラー（継続実行中）: {e}")
+            # バックエンドへ直接書き込み（完了検知はバックエンドが行う）
+            session_data = await get_backend().start_session(session_id, timer['id'], total_seconds, timer['band_id'])
+            await abroadcast_session(session_id, session_data, 'started')
             
             return JsonResponse({
                 'success': True,
                 'session_id': session_id,
-                'message': f'{timer.band.name}のタイマーを開始しました（{timer.duration_minutes}分）',
-                'duration': timer.duration_minutes,
-                'timer_name': timer.name,
-                'band_name': timer.band.name
+                'message': f"{timer['band_name']}のタイマーを開始しました（{timer['duration_minutes']}分）",
+                'duration': timer['duration_minutes'],
+                'timer_name': timer['name'],
+                'band_name': timer['band_name']
             })
             
         except Timer.DoesNotExist:
@@ -69,13 +80,14 @@ def start_timer(request):
     
     return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
 
-def timer_status(request, session_id):
+@observe_view
+async def timer_status(request, session_id):
     """タイマー状態取得API"""
     try:
         logger.debug(f"タイマー状態取得: session_id={session_id}")
         
-        # 🔧 同期でタイマー状態取得
-        status = get_timer_status.delay(session_id).get(timeout=5)
+        # Celeryを経由せずバックエンドから直接取得
+        status = await get_backend().get_session_status(session_id)
         
         return JsonResponse({
             'success': True,
@@ -88,32 +100,226 @@ def timer_status(request, session_id):
             'message': str(e)
         })
 
-@csrf_exempt
-def pause_timer(request, session_id):
+@async_csrf_exempt
+@observe_view
+async def pause_timer(request, session_id):
     """タイマー一時停止API"""
     if request.method == 'POST':
         try:
-            result = pause_timer_session.delay(session_id).get(timeout=5)
-            return JsonResponse(result)
+            session_data = await get_backend().pause_session(session_id)
+            await abroadcast_session(session_id, session_data, 'paused')
+            logger.info(f"タイマー一時停止: session_id={session_id}")
+            return JsonResponse({'success': True, 'status': 'paused'})
+        except TransitionError as e:
+            return JsonResponse({'success': False, 'message': str(e)})
         except Exception as e:
             logger.error(f"タイマー一時停止エラー: {e}")
             return JsonResponse({'success': False, 'message': str(e)})
     
     return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
 
-@csrf_exempt  
-def resume_timer(request, session_id):
+@async_csrf_exempt
+@observe_view
+async def resume_timer(request, session_id):
     """タイマー再開API"""
     if request.method == 'POST':
         try:
-            result = resume_timer_session.delay(session_id).get(timeout=5)
-            return JsonResponse(result)
+            session_data = await get_backend().resume_session(session_id)
+            await abroadcast_session(session_id, session_data, 'resumed')
+            logger.info(f"タイマー再開: session_id={session_id}")
+            return JsonResponse({'success': True, 'status': 'running'})
+        except TransitionError as e:
+            return JsonResponse({'success': False, 'message': str(e)})
         except Exception as e:
             logger.error(f"タイマー再開エラー: {e}")
             return JsonResponse({'success': False, 'message': str(e)})
     
     return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
 
+BATCH_EVENTS = {'start': 'started', 'pause': 'paused', 'resume': 'resumed'}
+
+async def batch_start_specs(data):
+    """一括開始の対象タイマーを取得（timer_ids / band_id(s) / all）"""
+    timers = Timer.objects.only('id', 'band_id', 'duration_minutes')
+    if data.get('timer_ids'):
+        timers = timers.filter(id__in=data['timer_ids'])
+    elif data.get('band_ids') or data.get('band_id'):
+        timers = timers.filter(band_id__in=data.get('band_ids') or [data['band_id']], is_active=True)
+    elif data.get('all'):
+        timers = timers.filter(is_active=True)
+    else:
+        return []
+    return [
+        (new_session_id(timer.band_id), timer.id, timer.duration_minutes * 60, timer.band_id)
+        async for timer in timers.order_by('band_id', 'order')
+    ]
+
+async def batch_session_ids(data):
+    """一括一時停止・再開の対象セッションを取得（session_ids / timer_ids / band_id(s) / all）"""
+    if data.get('session_ids'):
+        return [str(session_id) for session_id in data['session_ids']]
+    band_ids = data.get('band_ids') or ([data['band_id']] if data.get('band_id') else None)
+    return await get_backend().resolve_session_ids(
+        timer_ids=data.get('timer_ids'),
+        band_ids=band_ids,
+        all_bands=bool(data.get('all'))
+    )
+
+@async_csrf_exempt
+@observe_view
+async def batch_control(request, action):
+    """
+    一括操作API（action: start / pause / resume）
+    Redisバックエンドでは1パイプラインで適用し、WebSocket配信はバンドごとに1回
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
+    if action not in BATCH_EVENTS:
+        return JsonResponse({'success': False, 'message': f'不明な操作です: {action}'})
+    
+    try:
+        data = json.loads(request.body)
+        
+        if action == 'start':
+            specs = await batch_start_specs(data)
+            sessions, errors = await get_backend().start_sessions(specs), {}
+        else:
+            session_ids = await batch_session_ids(data)
+            sessions, errors = await get_backend().transition_sessions(action, session_ids)
+        
+        await abroadcast_batch(sessions, BATCH_EVENTS[action])
+        logger.info(f"一括操作: action={action}, 成功={len(sessions)}, 失敗={len(errors)}")
+        
+        return JsonResponse({
+            'success': True,
+            'action': action,
+            'sessions': sessions,
+            'errors': errors
+        })
+    except json.JSONDecodeError:
+        return JsonResponse({'success': False, 'message': '不正なJSONデータです'})
+    except Exception as e:
+        logger.error(f"一括操作エラー: action={action}, error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+RUNSHEET_ACTIONS = {
+    'start': 'start_runsheet',
+    'pause': 'pause_runsheet',
+    'resume': 'resume_runsheet',
+    'skip': 'skip_runsheet',
+}
+
+@async_csrf_exempt
+@observe_view
+async def runsheet_control(request, band_id, action):
+    """ランシート操作API（action: start / pause / resume / skip）"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
+    if action not in RUNSHEET_ACTIONS:
+        return JsonResponse({'success': False, 'message': f'不明な操作です: {action}'})
+    
+    try:
+        runsheet = await getattr(get_backend(), RUNSHEET_ACTIONS[action])(band_id)
+        logger.info(f"ランシート操作: band_id={band_id}, action={action}")
+        return JsonResponse({'success': True, 'runsheet': runsheet})
+    except TransitionError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    except Exception as e:
+        logger.error(f"ランシート操作エラー: band_id={band_id}, action={action}, error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+@observe_view
+async def runsheet_status(request, band_id):
+    """ランシートの時間割取得API"""
+    try:
+        runsheet = await get_backend().get_runsheet(band_id)
+        if runsheet is None:
+            return JsonResponse({'success': False, 'message': 'ランシートがありません'})
+        return JsonResponse({'success': True, 'runsheet': runsheet})
+    except Exception as e:
+        logger.error(f"ランシート取得エラー: band_id={band_id}, error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+@async_csrf_exempt
+@observe_view
+async def reorder_band_timers(request, band_id):
+    """
+    タイマー並び替えAPI（{"timer_ids": [...], "is_active": {"<timer_id>": bool}}）
+    timer_ids の順に順序を振り直し、1回の bulk_update で保存する。is_active は省略可
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'POSTメソッドが必要です'})
+    
+    try:
+        data = json.loads(request.body)
+        timer_ids = data.get('timer_ids')
+        if not isinstance(timer_ids, list):
+            return JsonResponse({'success': False, 'message': 'timer_idsが必要です'})
+        
+        timers = await sync_to_async(reorder_timers)(band_id, timer_ids, data.get('is_active'))
+        return JsonResponse({
+            'success': True,
+            'message': 'タイマーの順序を更新しました',
+            'band_id': band_id,
+            'timers': timers
+        })
+    except json.JSONDecodeError:
+        return JsonResponse({'success': False, 'message': '不正なJSONデータです'})
+    except ScheduleError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    except Exception as e:
+        logger.error(f"タイマー並び替えエラー: band_id={band_id}, error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+@observe_view
+async def timer_schedule(request):
+    """
+    タイマー構成API（?bands=1,2&fields=name,order&limit=50&cursor=...）
+    バンド名順のカーソルページング。有効なタイマーを order 順に返す
+    ページ内のバンドの構成バージョンから強いETagを作り、If-None-Match が一致すれば304（タイマーは読まない）
+    """
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'message': 'GETメソッドが必要です'})
+    
+    try:
+        params = schedule_params(request.GET)
+        bands, next_cursor = await aschedule_page(**params)
+        etag = schedule_etag(bands, params['fields'], next_cursor)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse({
+                'success': True,
+                'bands': await aschedule_bands(bands, params['fields']),
+                'next_cursor': next_cursor
+            })
+        response['ETag'] = etag
+        # ブラウザは本文を保持し、毎回ETagで再検証する
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    except ScheduleError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    except Exception as e:
+        logger.error(f"タイマー構成取得エラー: error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+@observe_view
+async def band_sessions(request, band_id):
+    """バンドの稼働中セッション一覧API（インデックス参照のみ、SCANなし）"""
+    try:
+        sessions = await get_backend().list_band_sessions(band_id)
+        return JsonResponse({
+            'success': True,
+            'band_id': band_id,
+            'sessions': sessions
+        })
+    except Exception as e:
+        logger.error(f"セッション一覧取得エラー: band_id={band_id}, error={e}")
+        return JsonResponse({'success': False, 'message': str(e)})
+
+def metrics(request):
+    """Prometheusメトリクス（テキスト形式）"""
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 def test_celery_connection(request):
     """Celery接続テスト用エンドポイント"""
     try:
@@ -8,16 +8,16 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.development')
 # Create Celery app
 app = Celery('kanri_timer')
 
+# ブローカー・結果バックエンドのURLとコネクション数の上限は Django の設定（CELERY_*）から読み込む
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
 # Configure Celery with Redis - explicit transport
 app.conf.update(
     # Broker settings with explicit Redis transport
-    broker_url='redis://redis:6379/1',
     broker_transport='redis',
-    broker_transport_options={'visibility_timeout': 3600},
     broker_connection_retry_on_startup=True,
     
     # Result backend settings
-    result_backend='redis://redis:6379/2',
     result_backend_transport_options={'visibility_timeout': 3600},
     result_expires=3600,
     
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
@@ -31,7 +31,7 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'config.middleware.AsyncWhiteNoiseMiddleware',  # 非同期ビュー対応
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -73,17 +73,42 @@ DATABASES = {
     }
 }
 
+# Redis
+# タイマーセッション用Redis（非同期クライアントから直接アクセス）。キャッシュも同じRedisを使う
+TIMER_REDIS_URL = config('REDIS_URL', default='redis://redis:6379/0')
+
+# セッション・チャンネルレイヤーを分散するRedisノード（カンマ区切り。band_id のコンシステントハッシュで振り分け）
+# ノードを変更したら rehydrate_timers で稼働中セッションを新しい担当ノードへ復元する
+TIMER_REDIS_SHARDS = config('TIMER_REDIS_SHARDS', default=TIMER_REDIS_URL, cast=Csv())
+
+# Redisコネクションプール（apps/timer_core/redis_pools.py）
+# 用途ごと・プロセスごとのコネクション数の上限。使用中が上限に達すると
+# TIMER_REDIS_POOL_TIMEOUT 秒まで空きを待ち、取得できなければエラーにする
+# 待ち時間・枯渇回数・使用中の数は timer_redis_pool_* メトリクスで確認する
+TIMER_REDIS_POOL_TIMEOUT = config('TIMER_REDIS_POOL_TIMEOUT', default=5, cast=float)
+TIMER_REDIS_POOLS = {
+    'session': config('TIMER_REDIS_POOL_SESSION', default=50, cast=int),  # タイマーセッション（ノード・イベントループごと）
+    'cache': config('TIMER_REDIS_POOL_CACHE', default=10, cast=int),  # Djangoキャッシュ・セッション
+    'channels': config('TIMER_REDIS_POOL_CHANNELS', default=50, cast=int),  # チャンネルレイヤー（ノードごと）
+    'broker': config('TIMER_REDIS_POOL_BROKER', default=10, cast=int),  # Celeryブローカー
+    'result': config('TIMER_REDIS_POOL_RESULT', default=10, cast=int),  # Celery結果バックエンド
+}
+
 # Cache & Session (Redis)
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://redis:6379/0',
+        'LOCATION': TIMER_REDIS_URL,
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_CLASS': 'apps.timer_core.redis_pools.InstrumentedConnectionPool',
             'CONNECTION_POOL_KWARGS': {
                 'retry_on_timeout': True,
                 'socket_connect_timeout': 5,
                 'socket_timeout': 5,
+                'role': 'cache',
+                'max_connections': TIMER_REDIS_POOLS['cache'],
+                'timeout': TIMER_REDIS_POOL_TIMEOUT,
             }
         },
         'KEY_PREFIX': 'band_timer',
@@ -95,19 +120,89 @@ SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'default'
 SESSION_COOKIE_AGE = 86400  # 24 hours
 
+# タイマー操作のバックエンド（redis: Redis + スケジューラ・Celery / asyncio: daphne内で完結、単一プロセス）
+TIMER_BACKEND = config('TIMER_BACKEND', default='redis')
+
+# 残り時間をWebSocketへ定期配信するか（状態変化は常に配信）
+TIMER_PUSH_TICKS = config('TIMER_PUSH_TICKS', default=False, cast=bool)
+TIMER_TICK_SECONDS = 10
+
+# 終了時刻スケジューラ（run_timer_scheduler）
+TIMER_SCHEDULER_INTERVAL = 0.1  # 最大待機秒数（完了検知の遅れの上限）
+TIMER_SCHEDULER_BATCH_SIZE = 500  # 1回に取り出す期限切れセッション数
+TIMER_SCHEDULER_LEASE = 30  # 取り出したが完了を確認できなかったセッションを再び取り出すまでの秒数
+TIMER_INDEX_PRUNE_INTERVAL = 60  # 稼働中インデックスからTTLで失効したメンバーを取り除く間隔（秒）
+
+# 完了検知の方式（scheduler: 終了時刻インデックスの監視 / keyspace: 終了通知キーの失効通知）
+TIMER_COMPLETION_MODE = config('TIMER_COMPLETION_MODE', default='scheduler')
+TIMER_EXPIRY_SWEEP_INTERVAL = 1.0  # keyspace時の取りこぼし確認間隔（秒）
+
+# セッションイベントのDB保存（スケジューラが一定間隔でまとめて保存）
+TIMER_EVENT_FLUSH_INTERVAL = 1.0  # 秒
+TIMER_EVENT_FLUSH_BATCH_SIZE = 1000
+TIMER_REHYDRATE_CHUNK_SIZE = 1000  # 起動時の復元でスクリプト1回に渡すセッション数
+
+# 1つのWebSocket接続で購読できるバンド数の上限（ws/timer/ の subscribe）
+TIMER_WS_MAX_SUBSCRIPTIONS = 100
+
+# WebSocket接続ごとの受信レート制限（トークンバケット）。超過分はパースせずに破棄し、
+# 破棄が TIMER_WS_MAX_DROPPED 件に達したら切断する（バケットが満杯に戻ればリセット）
+TIMER_WS_RATE = config('TIMER_WS_RATE', default=5, cast=float)  # 1秒あたりのメッセージ数
+TIMER_WS_BURST = config('TIMER_WS_BURST', default=20, cast=int)
+TIMER_WS_MAX_DROPPED = 50
+TIMER_WS_MAX_MESSAGE_BYTES = 4096  # 超えるフレームは即切断
+# 接続ごとの送信待ちフレームの上限（同じセッションの timer_update は最新のみ残す）。超えたら切断
+TIMER_WS_SEND_QUEUE_SIZE = config('TIMER_WS_SEND_QUEUE_SIZE', default=256, cast=int)
+# 送信済みでクライアントの受信確認（ack）がないフレームの上限。達したら ack まで送信を止める
+# （クライアントは受信累計数を、未確認が半分に達するごとに ack で返す）
+TIMER_WS_ACK_WINDOW = config('TIMER_WS_ACK_WINDOW', default=64, cast=int)
+
+# WebSocketの再接続（daphne再起動時などに一斉に再接続しないよう分散させる）
+# 接続時に再開トークン（購読中のバンド。署名付き）と再接続までの待ち時間のヒント（範囲内でランダム）を渡す
+TIMER_WS_RESUME_MAX_AGE = 3600  # 再開トークンの有効期間（秒）
+TIMER_WS_RESUME_MAX_SESSIONS = 100  # resume で差分を確認するセッション数の上限
+TIMER_WS_RETRY_MIN_MS = 1000
+TIMER_WS_RETRY_MAX_MS = 15000
+# プロセスあたりの新規接続の受け入れ（トークンバケット）。超過した接続は待ち時間のヒントを送って 1013 で切断
+TIMER_WS_ADMIT_RATE = config('TIMER_WS_ADMIT_RATE', default=50, cast=float)  # 1秒あたりの接続数
+TIMER_WS_ADMIT_BURST = config('TIMER_WS_ADMIT_BURST', default=100, cast=int)
+
+# バンド・タイマー情報のプロセス内キャッシュ（変更時はシグナルで無効化）
+TIMER_METADATA_CACHE_SIZE = 2048
+TIMER_METADATA_CACHE_TTL = 300  # 秒
+
+# タイマー構成API（/api/schedule/）の1ページあたりのバンド数（既定・上限）
+TIMER_SCHEDULE_PAGE_SIZE = config('TIMER_SCHEDULE_PAGE_SIZE', default=50, cast=int)
+TIMER_SCHEDULE_PAGE_MAX = 200
+# メイン画面（データを含まない静的なページ）のブラウザキャッシュ秒数
+TIMER_PAGE_MAX_AGE = config('TIMER_PAGE_MAX_AGE', default=300, cast=int)
+
+# Celeryワーカー・スケジューラのメトリクス公開ポート（0なら公開しない。daphneは /metrics）
+TIMER_METRICS_PORT = config('TIMER_METRICS_PORT', default=0, cast=int)
+
 # Channels (WebSocket)
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # バンドのグループはセッションと同じノードに置く（apps/timer_core/sharding.py）
+        'BACKEND': 'apps.timer_core.sharding.ShardedChannelLayer',
         'CONFIG': {
-            'hosts': ['redis://redis:6379/0'],
+            'hosts': [
+                {'address': url, 'max_connections': TIMER_REDIS_POOLS['channels'], 'timeout': TIMER_REDIS_POOL_TIMEOUT}
+                for url in TIMER_REDIS_SHARDS
+            ],
         },
     },
 }
 
-# Celery
-CELERY_BROKER_URL = 'redis://redis:6379/1'
-CELERY_RESULT_BACKEND = 'redis://redis:6379/2'
+# Celery（config/celery.py は CELERY_ の設定を読み込む）
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://redis:6379/1')
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://redis:6379/2')
+CELERY_BROKER_POOL_LIMIT = TIMER_REDIS_POOLS['broker']
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': 3600,
+    'max_connections': TIMER_REDIS_POOLS['broker'],
+}
+CELERY_REDIS_MAX_CONNECTIONS = TIMER_REDIS_POOLS['result']
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'